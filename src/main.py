@@ -1,14 +1,42 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile, Query
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, File, UploadFile, Query, Header, WebSocket, Body
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from adb_shell.adb_device import AdbDeviceTcp
 import os
 import json
 import re
+import time
+import uuid
+import shlex
+import io
+import struct
+import hashlib
+import asyncio
+import codecs
+import threading
+import bisect
+import random
+import socket
+import sys
+import signal
+import sqlite3
+from collections import deque
+from urllib.parse import urlsplit, parse_qs, urlencode
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, closing
 from typing import Optional
 from datetime import datetime
 import logging
 from pathlib import Path
-from functools import wraps
+from functools import wraps, partial
+from dataclasses import dataclass, asdict
+from PIL import Image, ImageChops
+from pydantic import BaseModel, Field
+
+# El transporte asyncio de adb_shell requiere el extra "async" (aiofiles)
+try:
+    from adb_shell.adb_device_async import AdbDeviceTcpAsync
+except ImportError:
+    AdbDeviceTcpAsync = None
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -32,6 +60,7 @@ app = FastAPI(
     
     - **200 OK**: Operación exitosa
     - **400 Bad Request**: Error de validación de parámetros
+    - **429 Too Many Requests**: Cola de comandos del dispositivo llena (`ADB_MAX_QUEUE`)
     - **503 Service Unavailable**: Error durante ejecución de comando ADB
     
     ## Documentación:
@@ -49,6 +78,276 @@ app = FastAPI(
 # Diccionario para almacenar conexiones
 devices = {}
 
+# Locks por IP que serializan el alta/reconexión de un dispositivo en el
+# registro, para que dos primeras peticiones no abran dos conexiones
+registry_locks = {}
+
+# Máximo de peticiones en cola por dispositivo (0 = sin límite). Al superarlo
+# se responde 429 en lugar de acumular peticiones.
+ADB_MAX_QUEUE = int(os.getenv("ADB_MAX_QUEUE", 0))
+
+# Claves ADB: directorio de adbkey/adbkey.pub y firmante del handshake.
+# "auto" usa `cryptography` (RSA en OpenSSL) si está instalado y si no el
+# firmante en Python puro de adb_shell. Un solo firmante por proceso,
+# compartido por todas las conexiones.
+ADB_KEYS_DIR = os.getenv("ADB_KEYS_DIR", "/app/.android")
+ADB_SIGNER = os.getenv("ADB_SIGNER", "auto").lower()
+adb_keys = []
+adb_keys_lock = threading.Lock()
+
+# Sockets ADB por dispositivo. adb_shell no admite varios streams
+# simultáneos sobre un mismo transporte, así que el paralelismo se logra
+# abriendo canales adicionales (bajo demanda) solo para comandos de lectura.
+# Los eventos de entrada (KEYCODE_*) siempre van por el canal principal, en orden.
+ADB_CHANNELS_PER_DEVICE = max(1, int(os.getenv("ADB_CHANNELS_PER_DEVICE", 1)))
+
+# Caché por dispositivo (segundos). Las propiedades de getprop (modelo,
+# fabricante, versión, serie) no cambian mientras sigue conectado; batería,
+# almacenamiento y RAM se refrescan más seguido. Se invalida al reconectar.
+PROPS_CACHE_TTL = float(os.getenv("PROPS_CACHE_TTL", 3600))
+VOLATILE_CACHE_TTL = float(os.getenv("VOLATILE_CACHE_TTL", 10))
+
+# Transmisión continua de pantalla (/screenshot/stream): un bucle de captura
+# por dispositivo, compartido por todos sus espectadores
+STREAM_MAX_FPS = float(os.getenv("STREAM_MAX_FPS", 10))
+STREAM_FIRST_FRAME_TIMEOUT = 15
+frame_streams = {}
+
+# Bloques de salida que un comando en streaming (logcat) puede adelantar al
+# cliente. Con la cola llena se deja de leer y el control de flujo de ADB
+# frena al proceso en el dispositivo: la memoria no crece con la duración.
+STREAM_QUEUE_CHUNKS = 16
+# Espera máxima de adb_shell entre bloques de un comando en streaming: un
+# logcat puede pasar mucho tiempo sin líneas nuevas (adb_shell no admite
+# "sin límite", así que se usa un año)
+STREAM_READ_TIMEOUT = 365 * 24 * 3600
+
+# Colector de logcat en segundo plano: un buffer circular por dispositivo en
+# memoria del servidor, acotado por tamaño (bytes aproximados) y antigüedad
+LOGCAT_COLLECTOR = os.getenv("LOGCAT_COLLECTOR", "false").lower() in ("1", "true", "yes")
+LOGCAT_BUFFER_BYTES = int(os.getenv("LOGCAT_BUFFER_BYTES", 8 * 1024 * 1024))
+LOGCAT_BUFFER_MAX_AGE = float(os.getenv("LOGCAT_BUFFER_MAX_AGE", 3600))
+LOGCAT_COLLECTOR_RETRY = 5
+logcat_collectors = {}
+
+# Supervisor de conexiones: sondeo keepalive barato (`:`, el comando nulo del
+# shell) a los dispositivos sin tráfico reciente y reconexión proactiva con
+# espera exponencial y jitter. KEEPALIVE_INTERVAL=0 lo desactiva.
+KEEPALIVE_INTERVAL = float(os.getenv("KEEPALIVE_INTERVAL", 30))
+KEEPALIVE_TIMEOUT = float(os.getenv("KEEPALIVE_TIMEOUT", 5))
+KEEPALIVE_BACKOFF_BASE = 2.0
+KEEPALIVE_BACKOFF_MAX = float(os.getenv("KEEPALIVE_BACKOFF_MAX", 300))
+KEEPALIVE_TICK = 1.0
+KEEPALIVE_COMMAND = ":"
+# Plazo total de /devices?refresh=true: sondea todos los dispositivos en
+# paralelo y reporta como "timeout" los que no respondieron a tiempo
+DEVICES_REFRESH_TIMEOUT = float(os.getenv("DEVICES_REFRESH_TIMEOUT", 5))
+
+# Vigilante de la app en primer plano: un `logcat -b events` por dispositivo
+# con los eventos de actividad reanudada (Android 10+, 7-9 y anteriores), así
+# /device/current-app responde desde memoria sin ejecutar dumpsys cada vez
+FOREGROUND_WATCHER = os.getenv("FOREGROUND_WATCHER", "true").lower() in ("1", "true", "yes")
+FOREGROUND_EVENT_TAGS = ("wm_set_resumed_activity", "am_set_resumed_activity", "am_resume_activity")
+# Eventos de pantalla encendida/apagada y nivel de batería, para el bus de eventos
+STATE_EVENT_TAGS = ("screen_toggled", "battery_level")
+# Se sigue desde la hora del dispositivo tomada junto con la consulta de foco
+# ({since}): los eventos anteriores ya están reflejados en esa consulta
+FOREGROUND_WATCH_COMMAND = "logcat -b events -v brief -T {since} " + " ".join(
+    f"{t}:I" for t in FOREGROUND_EVENT_TAGS + STATE_EVENT_TAGS) + " '*:S'"
+# Hora del dispositivo en el formato que acepta `logcat -T`
+DEVICE_CLOCK_COMMAND = "date '+%m-%d %H:%M:%S.000'"
+DEVICE_CLOCK = re.compile(r"^\d\d-\d\d \d\d:\d\d:\d\d\.\d{3}$")
+# Línea de `logcat -b events -v brief`: "I/screen_toggled( 1234): 1"
+EVENT_LOG_LINE = re.compile(r"^[VDIWEF]/(\w+)\(\s*\d+\): (.*)$")
+FOREGROUND_QUERY_COMMAND = "dumpsys window windows | grep 'mCurrentFocus'"
+# Componente "paquete/actividad": el paquete tiene al menos un punto, para no
+# confundirlo con el prefijo "I/tag" del formato brief de logcat
+FOREGROUND_COMPONENT = re.compile(r"(\w+(?:\.\w+)+)/([\w.$]+)")
+FOREGROUND_READY_TIMEOUT = 10
+FOREGROUND_RETRY = 5
+# Eventos pendientes por suscriptor de /device/current-app/stream; si se
+# llena se descartan los más viejos (solo importa el estado más reciente)
+FOREGROUND_QUEUE_EVENTS = 32
+foreground_watchers = {}
+
+# Bus de eventos: cambios de estado observados por la API, con historial
+# para retomar (?since_seq=, Last-Event-ID) y suscriptores SSE/WebSocket
+EVENT_TYPES = ("device", "app", "screen", "volume", "battery")
+EVENT_HISTORY = int(os.getenv("EVENT_HISTORY", 1000))
+EVENT_QUEUE_EVENTS = 256
+EVENT_KEEPALIVE = 15
+# Webhooks: los eventos se agrupan durante WEBHOOK_BATCH_DELAY segundos (hasta
+# WEBHOOK_BATCH_SIZE por POST) y cada lote se reintenta con espera exponencial
+WEBHOOK_URLS = [u.strip() for u in os.getenv("WEBHOOK_URLS", "").split(",") if u.strip()]
+WEBHOOK_BATCH_SIZE = 100
+WEBHOOK_BATCH_DELAY = float(os.getenv("WEBHOOK_BATCH_DELAY", 1))
+WEBHOOK_MAX_RETRIES = int(os.getenv("WEBHOOK_MAX_RETRIES", 5))
+WEBHOOK_RETRY_BASE = 1.0
+WEBHOOK_RETRY_MAX = 60.0
+WEBHOOK_TIMEOUT = 10
+WEBHOOK_QUEUE_EVENTS = 1000
+
+# Flota: etiquetas por dispositivo para seleccionar grupos en /fleet/*
+# (DEVICE_TAGS="sala=ip1,ip2;cocina=ip3") y máximo de dispositivos atendidos
+# a la vez por una operación de flota
+DEVICE_TAGS = os.getenv("DEVICE_TAGS", "")
+FLEET_MAX_PARALLEL = max(1, int(os.getenv("FLEET_MAX_PARALLEL", 16)))
+device_tags = {}
+
+# Escalado horizontal: con CLUSTER_DB cada dispositivo tiene un solo dueño
+# (hash consistente sobre los nodos vivos de una tabla SQLite compartida,
+# más un lease por dispositivo) y los demás nodos reenvían sus peticiones
+# al dueño. CLUSTER_WORKERS > 1 arranca ese número de procesos worker.
+CLUSTER_WORKERS = max(1, int(os.getenv("CLUSTER_WORKERS", 1)))
+CLUSTER_DB = os.getenv("CLUSTER_DB", "/tmp/adb-api-cluster.sqlite" if CLUSTER_WORKERS > 1 else "")
+CLUSTER_NODE_URL = os.getenv("CLUSTER_NODE_URL", "")
+# Puerto privado del primer worker (los siguientes, consecutivos); por
+# defecto PORT+1. Con CLUSTER_NODE_URL los demás hosts llegan a cada worker
+# por ese host y su puerto privado
+CLUSTER_WORKER_PORT = os.getenv("CLUSTER_WORKER_PORT", "")
+CLUSTER_HEARTBEAT = float(os.getenv("CLUSTER_HEARTBEAT", 5))
+CLUSTER_NODE_TTL = float(os.getenv("CLUSTER_NODE_TTL", 15))
+CLUSTER_FORWARD_TIMEOUT = float(os.getenv("CLUSTER_FORWARD_TIMEOUT", 300))
+CLUSTER_VNODES = 64
+CLUSTER_FORWARD_HEADER = "x-adb-api-forwarded"
+cluster = None
+
+# Pipeline de /device/batch: operaciones admitidas, límites por petición y
+# nombres de tecla aceptados (se insertan en el script shell del lote)
+BATCH_OPS = ("keyevent", "shell", "play", "stop", "exit", "volume", "current_app", "volume_current", "wait")
+BATCH_MAX_STEPS = 50
+BATCH_MAX_WAIT_MS = 60000
+KEYCODE_NAME = re.compile(r"^(KEYCODE_[A-Z0-9_]+|\d+)$")
+
+# Datos de /device/info obtenidos del volcado de getprop
+DEVICE_INFO_PROPERTIES = {
+    "model": "ro.product.model",
+    "manufacturer": "ro.product.manufacturer",
+    "android_version": "ro.build.version.release",
+    "api_level": "ro.build.version.sdk",
+    "serial_number": "ro.serialno"
+}
+
+# Motor de volumen: stream controlado (STREAM_MUSIC) y comandos para fijar y
+# leer el nivel con una sola invocación, según el método soportado por la API
+AUDIO_STREAM_MUSIC = 3
+VOLUME_SET_COMMANDS = {
+    "media_session": f"cmd media_session volume --stream {AUDIO_STREAM_MUSIC} --set {{level}}",
+    "media": f"media volume --stream {AUDIO_STREAM_MUSIC} --set {{level}}"
+}
+# Método a probar cuando el elegido no está disponible en el dispositivo
+VOLUME_METHOD_FALLBACK = {"media_session": "media", "media": "keyevent"}
+# Estado de volumen de todos los streams: solo las líneas de `dumpsys audio`
+# que interesan al parser, para no transferir el volcado completo
+AUDIO_STATE_COMMAND = "dumpsys audio | grep -E '^- STREAM_|^ +(Muted|Mute count|Min|Max|streamVolume|Current|Devices):'"
+# Segundos que el estado de volumen se considera vigente
+VOLUME_CACHE_TTL = float(os.getenv("VOLUME_CACHE_TTL", 5))
+# Pasos usados para llevar el volumen a 0 con teclas cuando no se conoce el máximo
+VOLUME_KEYEVENT_MAX_STEPS = 15
+
+# Índice de paquetes instalados: listado completo en un solo round trip
+# (sistema y terceros por separado, con ruta del APK y uid) y marca de
+# cambios barata, porque packages.xml se reescribe en cada instalación,
+# actualización o desinstalación
+PACKAGE_LIST_COMMANDS = {
+    "system": "pm list packages -f -U -s",
+    "third_party": "pm list packages -f -U -3"
+}
+PACKAGES_STAMP_COMMAND = "stat -c %Y /data/system/packages.xml"
+# Segundos entre comprobaciones de la marca de cambios del índice
+PACKAGES_CACHE_TTL = float(os.getenv("PACKAGES_CACHE_TTL", 300))
+PACKAGE_SORTS = ("name", "-name", "uid", "-uid")
+# Metadatos de todas las apps en un solo volcado, leído en streaming
+PACKAGE_DETAILS_COMMAND = "dumpsys package packages"
+PACKAGE_DETAILS_TIMEOUT = float(os.getenv("PACKAGE_DETAILS_TIMEOUT", 120))
+PACKAGE_HEADER = re.compile(r"^  Package \[([^\]]+)\]")
+PACKAGE_FIELD = re.compile(r"(\w+)=(\S+)")
+# Campos de `dumpsys package`: {clave: (atributo de PackageDetails, conversión)}
+PACKAGE_DETAIL_FIELDS = {
+    "versionName": ("version_name", str),
+    "versionCode": ("version_code", int),
+    "minSdk": ("min_sdk", int),
+    "targetSdk": ("target_sdk", int),
+    "firstInstallTime": ("first_install_time", str),
+    "lastUpdateTime": ("last_update_time", str),
+    "installerPackageName": ("installer", str)
+}
+
+# Cabecera de todo archivo PNG
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Formatos de salida de /screenshot codificados en el servidor: (Pillow, media type)
+SCREENSHOT_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+# Logcat en formato threadtime: "MM-DD HH:MM:SS.mmm  PID  TID N Tag: mensaje"
+LOGCAT_THREADTIME = re.compile(
+    r"^(\d\d-\d\d \d\d:\d\d:\d\d\.\d{3}) +(\d+) +(\d+) ([VDIWEF]) (.+?): (.*)$",
+    re.M
+)
+LOGCAT_LEVELS = "VDIWEF"
+LOGCAT_TIME = re.compile(r"^\d\d-\d\d \d\d:\d\d:\d\d(\.\d{3})?$")
+LOGCAT_MAX_LINES = 10000
+
+# Detección de cambios de pantalla (changed_since): el último frame de cada
+# dispositivo se guarda en escala de grises a 1/SCREEN_DIFF_SCALE de
+# resolución y se compara en una grilla de SCREEN_DIFF_GRID x SCREEN_DIFF_GRID
+SCREEN_DIFF_SCALE = 2
+SCREEN_DIFF_GRID = 8
+
+# Formatos de píxel de `screencap` en crudo (PixelFormat de Android): (modo, rawmode)
+RAW_PIXEL_FORMATS = {
+    1: ("RGBA", "RGBA"),  # RGBA_8888
+    2: ("RGB", "RGBX"),   # RGBX_8888
+    5: ("RGBA", "BGRA"),  # BGRA_8888
+}
+
+# Datos volátiles de /device/info
+DEVICE_INFO_VOLATILE_COMMANDS = {
+    "total_ram": "cat /proc/meminfo | grep MemTotal",
+    "storage_info": "df /data",
+    "battery_info": "dumpsys battery | grep 'level'"
+}
+
+def registry_lock(ip: str) -> asyncio.Lock:
+    """Obtener el lock de registro asociado a una IP"""
+    return registry_locks.setdefault(ip, asyncio.Lock())
+
+# Pool acotado de hilos donde se ejecuta toda la E/S bloqueante de adb_shell.
+# Así un dispositivo lento (timeout de conexión, dumpsys largo) no congela el
+# event loop de uvicorn ni las peticiones al resto de dispositivos.
+# El pool se crea al arrancar (o en el primer uso) y se descarta al apagar,
+# así la aplicación puede arrancar otra vez en el mismo proceso.
+ADB_EXECUTOR_WORKERS = int(os.getenv("ADB_EXECUTOR_WORKERS", 32))
+adb_executor = None
+
+def adb_pool() -> ThreadPoolExecutor:
+    """Pool de hilos ADB, creándolo si no existe"""
+    global adb_executor
+    if adb_executor is None:
+        adb_executor = ThreadPoolExecutor(max_workers=ADB_EXECUTOR_WORKERS, thread_name_prefix="adb-io")
+    return adb_executor
+
+# Modo de transporte ADB:
+# - "thread": AdbDeviceTcp bloqueante ejecutado en el pool de hilos (por defecto)
+# - "async": AdbDeviceTcpAsync nativo, sin hilos, para flotas de cientos de dispositivos
+ADB_TRANSPORT_MODES = ("thread", "async")
+ADB_TRANSPORT = os.getenv("ADB_TRANSPORT", "thread").strip().lower()
+if ADB_TRANSPORT not in ADB_TRANSPORT_MODES:
+    logger.warning(f"ADB_TRANSPORT '{ADB_TRANSPORT}' no válido, usando 'thread'")
+    ADB_TRANSPORT = "thread"
+elif ADB_TRANSPORT == "async" and AdbDeviceTcpAsync is None:
+    logger.warning("ADB_TRANSPORT 'async' requiere adb-shell[async], usando 'thread'")
+    ADB_TRANSPORT = "thread"
+
+async def run_blocking(func, *args, **kwargs):
+    """Ejecutar una llamada bloqueante en el pool de hilos ADB y esperar su resultado"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(adb_pool(), partial(func, *args, **kwargs))
+
 def validate_ip_address(ip: str) -> bool:
     """Validar que el formato de IP sea válido"""
     if not ip or not isinstance(ip, str):
@@ -90,167 +389,2627 @@ def validate_device_ip(device_ip: str) -> bool:
             detail="device_ip no puede estar vacío"
         )
     
-    if not validate_ip_address(device_ip):
-        raise HTTPException(
-            status_code=400,
-            detail=f"device_ip '{device_ip}' no es una dirección IP o hostname válido"
-        )
+    if not validate_ip_address(device_ip):
+        raise HTTPException(
+            status_code=400,
+            detail=f"device_ip '{device_ip}' no es una dirección IP o hostname válido"
+        )
+    
+    return True
+
+async def ensure_connected(device_ip: str, port: int = 5555):
+    """
+    Asegurar que el dispositivo esté registrado y conectado, conectando o
+    reconectando si hace falta. Lanza HTTPException 400 si no se puede.
+    """
+    # Validar device_ip
+    validate_device_ip(device_ip)
+    
+    if device_ip not in devices or not devices[device_ip].connected:
+        # Serializar el alta/reconexión: la primera petición conecta y las
+        # concurrentes esperan y reutilizan esa misma conexión
+        async with registry_lock(device_ip):
+            # Verificar si el dispositivo existe en el diccionario
+            if device_ip not in devices:
+                logger.info(f"Dispositivo {device_ip} no encontrado en conexiones, conectando automáticamente...")
+                # Intentar conectar automáticamente
+                result = await register_device(device_ip, port)
+                if result.get("status") == "error":
+                    raise HTTPException(status_code=400, detail=f"No se pudo conectar al dispositivo: {result.get('message')}")
+            
+            # Si el dispositivo existe pero no está conectado, reconectar
+            if not devices[device_ip].connected:
+                logger.info(f"Dispositivo {device_ip} desconectado, reconectando...")
+                reconnect_result = await devices[device_ip].connect()
+                if reconnect_result["status"] == "error":
+                    raise HTTPException(status_code=400, detail=f"No se pudo reconectar al dispositivo: {reconnect_result.get('message')}")
+
+def ensure_device_connection(func):
+    """
+    Decorador que asegura que el dispositivo esté conectado.
+    Si no está conectado, intenta conectar automáticamente.
+    
+    El parámetro device_ip debe estar presente en los argumentos de la función.
+    """
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        device_ip = kwargs.get('device_ip') or (args[0] if args else None)
+        port = kwargs.get('port', 5555)
+        await ensure_connected(device_ip, port)
+        
+        # Llamar a la función original
+        return await func(*args, **kwargs)
+    
+    return wrapper
+
+def create_adb_signer(key_path: str, backend: Optional[str] = None):
+    """
+    Construir el firmante RSA de adb_shell para una clave privada, con el
+    backend indicado (ADB_SIGNER por defecto): "cryptography", "python" o
+    "auto" (cryptography si está disponible).
+    """
+    backend = backend or ADB_SIGNER
+    if backend in ("auto", "cryptography"):
+        try:
+            from adb_shell.auth.sign_cryptography import CryptographySigner
+            return CryptographySigner(key_path)
+        except ImportError:
+            if backend == "cryptography":
+                logger.warning("ADB_SIGNER=cryptography pero el paquete no está instalado, usando PythonRSASigner")
+    from adb_shell.auth.sign_pythonrsa import PythonRSASigner
+    return PythonRSASigner.FromRSAKeyPath(key_path)
+
+def generate_adb_keys():
+    """Generar claves RSA para ADB si no existen"""
+    try:
+        # Directorio para almacenar claves
+        keys_dir = Path(ADB_KEYS_DIR)
+        keys_dir.mkdir(parents=True, exist_ok=True)
+        
+        adbkey_path = keys_dir / "adbkey"
+        
+        # Si las claves no existen, generarlas
+        if not adbkey_path.exists():
+            logger.info(f"Generando nuevas claves RSA en {adbkey_path}")
+            try:
+                from adb_shell.auth.keygen import keygen
+                keygen(str(adbkey_path))
+                logger.info("Claves RSA generadas exitosamente")
+            except Exception as e:
+                logger.error(f"Error al generar claves: {str(e)}")
+                import traceback
+                logger.error(traceback.format_exc())
+                return []
+        else:
+            logger.info(f"Claves ADB encontradas en {adbkey_path}")
+        
+        # Cargar las claves
+        try:
+            signer = create_adb_signer(str(adbkey_path))
+            logger.info(f"Claves ADB cargadas exitosamente ({type(signer).__name__})")
+            return [signer]
+        except Exception as e:
+            logger.error(f"Error al cargar claves: {str(e)}")
+            import traceback
+            logger.error(traceback.format_exc())
+            return []
+    except Exception as e:
+        logger.error(f"Error al generar/cargar claves ADB: {str(e)}")
+        import traceback
+        logger.error(traceback.format_exc())
+        return []
+
+def load_adb_keys() -> list:
+    """
+    Claves ADB compartidas por todas las conexiones: adbkey se lee y el
+    firmante se construye una sola vez por proceso. Si la carga falla se
+    vuelve a intentar en la próxima conexión.
+    """
+    with adb_keys_lock:
+        if not adb_keys:
+            adb_keys.extend(generate_adb_keys())
+        return adb_keys
+
+def parse_getprop(output: str) -> dict:
+    """Convertir la salida de `getprop` ([clave]: [valor]) en un diccionario"""
+    return dict(re.findall(r"^\[([^\]]+)\]: \[(.*)\]\r?$", output, re.M))
+
+def volume_method_for_api(api_level) -> str:
+    """
+    Elegir cómo fijar el volumen según el nivel de API:
+    `cmd media_session` (Android 11+), `media` (Android 4.4-10) o teclas.
+    """
+    try:
+        api = int(api_level)
+    except (TypeError, ValueError):
+        return "keyevent"
+    if api >= 30:
+        return "media_session"
+    if api >= 19:
+        return "media"
+    return "keyevent"
+
+def keyevent_command(*keycodes: str) -> str:
+    """Enviar varias teclas con una sola invocación de `input` (una sola JVM)"""
+    return "input keyevent " + " ".join(keycodes)
+
+def play_command(video_url: str) -> str:
+    """Abrir una URL de video con la app que la maneje (YouTube)"""
+    return f'am start -a android.intent.action.VIEW -d "{video_url}"'
+
+@dataclass
+class VolumeStream:
+    """Estado de un stream de audio según `dumpsys audio`"""
+    name: str
+    level: Optional[int] = None
+    min: int = 0
+    max: Optional[int] = None
+    muted: bool = False
+    device: Optional[str] = None
+
+def parse_audio_streams(output: str) -> dict:
+    """
+    Convertir la sección "Stream volumes" de `dumpsys audio` en un
+    diccionario {nombre: VolumeStream} (music, ring, alarm, notification...).
+    El nivel es el de `streamVolume` en las versiones que lo informan, o el
+    del dispositivo de salida activo (Devices:) dentro de la línea Current.
+    """
+    streams = {}
+    levels = {}
+    current = None
+    for line in output.splitlines():
+        header = re.match(r"^- STREAM_(\w+):", line)
+        if header:
+            current = VolumeStream(name=header.group(1).lower())
+            streams[current.name] = current
+            levels[current.name] = {}
+            continue
+        if current is None or not line[:1].isspace():
+            current = None
+            continue
+        key, _, value = line.strip().partition(":")
+        value = value.strip()
+        if key == "Muted":
+            current.muted = value == "true"
+        elif key == "Mute count":
+            current.muted = value.isdigit() and int(value) > 0
+        elif key == "Min" and value.isdigit():
+            current.min = int(value)
+        elif key == "Max" and value.isdigit():
+            current.max = int(value)
+        elif key == "streamVolume" and value.isdigit():
+            current.level = int(value)
+        elif key == "Current":
+            # "2 (speaker): 5, 400 (hdmi): 8, 40000000 (default): 8"
+            for device_id, name, index in re.findall(r"([0-9a-f]+)(?: \(([^)]*)\))?: (\d+)", value):
+                levels[current.name][name or device_id] = int(index)
+        elif key == "Devices":
+            current.device = value.split(",")[0].strip() or None
+    
+    for stream in streams.values():
+        by_device = levels[stream.name]
+        if stream.level is None and by_device:
+            stream.level = by_device.get(stream.device, by_device.get("default", next(iter(by_device.values()))))
+    return streams
+
+@dataclass
+class InstalledPackage:
+    """Paquete instalado según `pm list packages -f -U`"""
+    package_name: str
+    is_system_app: bool
+    apk_path: Optional[str] = None
+    uid: Optional[int] = None
+
+def parse_package_list(output: str, is_system_app: bool) -> list:
+    """
+    Convertir la salida de `pm list packages -f -U` en una lista de
+    InstalledPackage. Las líneas tienen el formato
+    "package:/data/app/~~x/com.app-y/base.apk=com.app uid:10123"; la ruta
+    puede contener "=", por eso se separa por el último.
+    """
+    packages = []
+    for line in output.splitlines():
+        line = line.strip()
+        if not line.startswith("package:"):
+            continue
+        entry, _, uid = line[8:].partition(" uid:")
+        path, _, name = entry.rpartition("=")
+        uid = uid.split(",")[0]
+        packages.append(InstalledPackage(
+            package_name=name,
+            is_system_app=is_system_app,
+            apk_path=path or None,
+            uid=int(uid) if uid.isdigit() else None
+        ))
+    return packages
+
+@dataclass
+class PackageDetails:
+    """Metadatos de una app según `dumpsys package`"""
+    version_name: Optional[str] = None
+    version_code: Optional[int] = None
+    min_sdk: Optional[int] = None
+    target_sdk: Optional[int] = None
+    first_install_time: Optional[str] = None
+    last_update_time: Optional[str] = None
+    installer: Optional[str] = None
+    enabled: Optional[bool] = None
+
+class PackageDetailsParser:
+    """
+    Parser incremental de `dumpsys package packages`: recibe el volcado
+    línea a línea y arma un PackageDetails por paquete sin guardar el texto.
+    Solo se leen los bloques "Package [...]" de la sección "Packages:"; los
+    de "Hidden system packages:" son las versiones de fábrica de apps
+    actualizadas.
+    """
+    
+    def __init__(self):
+        self.details = {}
+        self.current = None
+        self.in_packages = False
+    
+    def feed(self, line: str):
+        """Procesar una línea del volcado"""
+        if line and not line[0].isspace():
+            self.in_packages = line.startswith("Packages:")
+            self.current = None
+            return
+        if not self.in_packages:
+            return
+        header = PACKAGE_HEADER.match(line)
+        if header:
+            self.current = self.details.setdefault(header.group(1), PackageDetails())
+            return
+        if self.current is None:
+            return
+        line = line.strip()
+        if line.startswith("User "):
+            # "User 0: ceDataInode=... installed=true ... enabled=0 ..."; se
+            # usa el primer usuario. 0 (por defecto) y 1 son estados habilitados
+            if self.current.enabled is None:
+                fields = dict(PACKAGE_FIELD.findall(line))
+                if fields.get("enabled", "").isdigit():
+                    self.current.enabled = int(fields["enabled"]) in (0, 1)
+            return
+        if line.startswith(("firstInstallTime=", "lastUpdateTime=")):
+            # Las fechas tienen espacios: "lastUpdateTime=2024-01-31 10:20:30"
+            fields = [line.split("=", 1)]
+        else:
+            fields = PACKAGE_FIELD.findall(line)
+        for key, value in fields:
+            if key in PACKAGE_DETAIL_FIELDS and value != "null":
+                attribute, convert = PACKAGE_DETAIL_FIELDS[key]
+                try:
+                    setattr(self.current, attribute, convert(value))
+                except ValueError:
+                    pass
+
+class PackageIndex:
+    """
+    Índice en memoria de los paquetes de un dispositivo, ordenado por nombre
+    para buscar por prefijo con búsqueda binaria. Guarda la marca de cambios
+    con la que se construyó y las diferencias con el índice anterior.
+    """
+    
+    def __init__(self, packages: list, stamp: Optional[str] = None, previous: "PackageIndex" = None):
+        self.packages = sorted(packages, key=lambda p: p.package_name)
+        self.names = [p.package_name for p in self.packages]
+        self.stamp = stamp
+        self.checked = time.monotonic()
+        self.built_at = datetime.now().isoformat()
+        old = set(previous.names) if previous else set()
+        new = set(self.names)
+        self.added = sorted(new - old) if previous else []
+        self.removed = sorted(old - new)
+        # Metadatos de `dumpsys package`, se cargan al pedirlos por primera vez
+        self.details = None
+        self.details_lock = asyncio.Lock()
+    
+    def query(self, prefix: Optional[str] = None, system: Optional[bool] = None,
+              sort: str = "name", offset: int = 0, limit: int = 20) -> tuple:
+        """Filtrar, ordenar y paginar: retorna (total de coincidencias, página)"""
+        if sort not in PACKAGE_SORTS:
+            raise ValueError(f"sort debe ser uno de: {', '.join(PACKAGE_SORTS)}")
+        packages = self.packages
+        if prefix:
+            start = bisect.bisect_left(self.names, prefix)
+            end = bisect.bisect_right(self.names, prefix + "\U0010ffff", lo=start)
+            packages = packages[start:end]
+        if system is not None:
+            packages = [p for p in packages if p.is_system_app == system]
+        if sort.lstrip("-") == "uid":
+            packages = sorted(packages, key=lambda p: (p.uid is None, p.uid or 0, p.package_name))
+        if sort.startswith("-"):
+            packages = packages[::-1]
+        return len(packages), packages[offset:offset + limit]
+    
+    def stats(self) -> dict:
+        """Resumen del índice para las respuestas"""
+        return {
+            "packages": len(self.packages),
+            "built_at": self.built_at,
+            "added": self.added,
+            "removed": self.removed
+        }
+
+def parse_foreground_component(text: str) -> tuple:
+    """
+    Extraer (paquete, actividad) de una línea con un componente Android,
+    como mCurrentFocus=Window{1a2b u0 com.app/com.app.Main} o el evento
+    wm_set_resumed_activity: [0,com.app/.Main,reason]. Las actividades
+    abreviadas (".Main") se expanden con el paquete.
+    """
+    match = FOREGROUND_COMPONENT.search(text)
+    if not match:
+        return None, None
+    package, activity = match.groups()
+    if activity.startswith("."):
+        activity = package + activity
+    return package, activity
+
+def parse_raw_screencap(data: bytes) -> Image.Image:
+    """
+    Convertir la salida de `screencap` sin -p en una imagen.
+    La cabecera tiene ancho, alto y formato (uint32 little endian) y, desde
+    Android 9, el espacio de color: 12 o 16 bytes según la versión.
+    """
+    if len(data) < 12:
+        raise ValueError(f"Salida de screencap demasiado corta ({len(data)} bytes)")
+    width, height, pixel_format = struct.unpack_from("<III", data)
+    if pixel_format not in RAW_PIXEL_FORMATS:
+        raise ValueError(f"Formato de píxel no soportado: {pixel_format}")
+    header = len(data) - width * height * 4
+    if header not in (12, 16):
+        raise ValueError(f"Tamaño inesperado para {width}x{height}: {len(data)} bytes")
+    mode, rawmode = RAW_PIXEL_FORMATS[pixel_format]
+    return Image.frombuffer(mode, (width, height), memoryview(data)[header:], "raw", rawmode, 0, 1)
+
+def encode_image(image: Image.Image, image_format: str, quality: int = 80,
+                 width: Optional[int] = None) -> bytes:
+    """Reducir (opcional, manteniendo proporción) y codificar en png, jpeg o webp"""
+    if width and width < image.width:
+        height = max(1, round(image.height * width / image.width))
+        image = image.resize((width, height), Image.BILINEAR)
+    pil_format = SCREENSHOT_FORMATS[image_format][0]
+    if pil_format == "JPEG" and image.mode != "RGB":
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    if pil_format == "PNG":
+        image.save(buffer, pil_format, compress_level=1)
+    else:
+        image.save(buffer, pil_format, quality=quality)
+    return buffer.getvalue()
+
+@dataclass
+class LogcatEntry:
+    """Línea de logcat (-v threadtime) separada en sus campos"""
+    timestamp: str
+    pid: int
+    tid: int
+    level: str
+    tag: str
+    message: str
+
+def parse_logcat(output: str) -> list:
+    """
+    Convertir la salida de `logcat -v threadtime` en una lista de LogcatEntry.
+    Se ignoran las líneas sin cabecera (p. ej. "--------- beginning of main").
+    Un único findall sobre toda la salida es bastante más rápido que
+    recorrerla línea a línea; el tag viene rellenado con espacios.
+    """
+    return [
+        LogcatEntry(timestamp, int(pid), int(tid), level, tag.rstrip(), message.rstrip("\r"))
+        for timestamp, pid, tid, level, tag, message in LOGCAT_THREADTIME.findall(output)
+    ]
+
+def parse_logcat_line(line: str) -> Optional[LogcatEntry]:
+    """Convertir una línea de `logcat -v threadtime` (None si no tiene cabecera)"""
+    match = LOGCAT_THREADTIME.match(line)
+    if not match:
+        return None
+    timestamp, pid, tid, level, tag, message = match.groups()
+    return LogcatEntry(timestamp, int(pid), int(tid), level, tag.rstrip(), message.rstrip("\r"))
+
+def logcat_filter(level: Optional[str] = None, tags: Optional[list] = None, pid: Optional[int] = None,
+                  pattern: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None,
+                  text: Optional[str] = None):
+    """
+    Construir un filtro de LogcatEntry con las condiciones indicadas (todas
+    deben cumplirse). El regex se compila una sola vez; los tiempos usan el
+    formato de logcat ("MM-DD HH:MM:SS.mmm"), que se compara como texto.
+    Lanza ValueError si algún parámetro es inválido.
+    """
+    checks = []
+    if level:
+        if level.upper() not in LOGCAT_LEVELS:
+            raise ValueError(f"Nivel inválido: {level}. Usa uno de {', '.join(LOGCAT_LEVELS)}")
+        allowed = LOGCAT_LEVELS[LOGCAT_LEVELS.index(level.upper()):]
+        checks.append(lambda e: e.level in allowed)
+    if tags:
+        tag_set = set(tags)
+        checks.append(lambda e: e.tag in tag_set)
+    if pid is not None:
+        checks.append(lambda e: e.pid == pid)
+    if pattern:
+        try:
+            search = re.compile(pattern).search
+        except re.error as e:
+            raise ValueError(f"Regex inválido: {e}")
+        checks.append(lambda e: search(e.message) is not None)
+    for name, value in (("since", since), ("until", until)):
+        if value and not LOGCAT_TIME.match(value):
+            raise ValueError(f"{name} debe tener el formato MM-DD HH:MM:SS[.mmm]")
+    if since:
+        checks.append(lambda e: e.timestamp >= since)
+    if until:
+        # Sin milisegundos, until incluye todo ese segundo
+        limit = until if "." in until else until + ".999"
+        checks.append(lambda e: e.timestamp <= limit)
+    if text:
+        checks.append(lambda e: text in e.message or text in e.tag)
+    
+    def matches(entry: LogcatEntry) -> bool:
+        for check in checks:
+            if not check(entry):
+                return False
+        return True
+    return matches
+
+def logcat_command(lines: int, level: Optional[str] = None, tags: Optional[list] = None,
+                   since: Optional[str] = None) -> str:
+    """
+    Comando `logcat` con los filtros nativos (filterspecs) que reducen lo que
+    envía el dispositivo: nivel mínimo, tags y momento de inicio.
+    """
+    parts = ["logcat", "-v", "threadtime"]
+    parts += ["-t", shlex.quote(since if "." in since else since + ".000")] if since else ["-t", str(lines)]
+    priority = level.upper() if level else "V"
+    if tags:
+        parts += [shlex.quote(f"{tag}:{priority}") for tag in tags] + ["'*:S'"]
+    elif level:
+        parts.append(shlex.quote(f"*:{priority}"))
+    return " ".join(parts)
+
+def frame_digest(data: bytes) -> str:
+    """Hash rápido del contenido de un frame (PNG o framebuffer en crudo)"""
+    return hashlib.blake2b(data, digest_size=10).hexdigest()
+
+def screenshot_etag(frame_hash: str, *variant) -> str:
+    """
+    ETag de una captura: el hash del frame más un sufijo por cada variante
+    (origen, formato, calidad, ancho), ya que cada una produce otros bytes.
+    """
+    suffix = hashlib.blake2b(repr(variant).encode(), digest_size=3).hexdigest()
+    return f'"{frame_hash}-{suffix}"'
+
+def etag_frame_hash(etag: str) -> str:
+    """Extraer el hash del frame de un ETag generado por screenshot_etag"""
+    return etag.strip().removeprefix("W/").strip('"').split("-")[0]
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Comparar una cabecera If-None-Match (lista, comodín o ETag débil) con un ETag"""
+    if not if_none_match:
+        return False
+    candidates = [c.strip().removeprefix("W/") for c in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+def screen_thumbnail(image: Image.Image) -> Image.Image:
+    """Versión reducida en escala de grises de un frame, para detectar cambios"""
+    return image.convert("L").reduce(SCREEN_DIFF_SCALE)
+
+def changed_regions(previous: Image.Image, current: Image.Image, size: tuple) -> list:
+    """
+    Regiones de la grilla que cambiaron entre dos miniaturas, en coordenadas
+    de la pantalla completa (size = ancho y alto reales).
+    """
+    full_width, full_height = size
+    if previous.size != current.size:
+        return [{"x": 0, "y": 0, "width": full_width, "height": full_height}]
+    diff = ImageChops.difference(previous, current)
+    if diff.getbbox() is None:
+        return []
+    regions = []
+    tile_width = -(-current.width // SCREEN_DIFF_GRID)
+    tile_height = -(-current.height // SCREEN_DIFF_GRID)
+    for top in range(0, current.height, tile_height):
+        for left in range(0, current.width, tile_width):
+            box = (left, top, min(left + tile_width, current.width), min(top + tile_height, current.height))
+            if diff.crop(box).getbbox():
+                x, y = box[0] * SCREEN_DIFF_SCALE, box[1] * SCREEN_DIFF_SCALE
+                regions.append({
+                    "x": x,
+                    "y": y,
+                    "width": min(box[2] * SCREEN_DIFF_SCALE, full_width) - x,
+                    "height": min(box[3] * SCREEN_DIFF_SCALE, full_height) - y,
+                })
+    return regions
+
+def build_batch_script(commands: list, token: str, stop_on_error: bool = False) -> str:
+    """
+    Construir un único script shell que ejecuta varios comandos en orden.
+    Cada salida queda entre marcadores con el token del lote, el índice del
+    comando y su código de salida, para separarlas después. Con
+    stop_on_error el script termina en el primer comando que falla y los
+    siguientes quedan sin sección. Cada comando va en sus propias líneas,
+    así un comentario (#) no se come el resto del script.
+    """
+    stop = "; [ $rc -eq 0 ] || exit $rc" if stop_on_error else ""
+    parts = []
+    for index, cmd in enumerate(commands):
+        parts.append(
+            f"echo '@@{token}:{index}@@'\n(\n{cmd}\n)\nrc=$?; echo; echo \"@@{token}:{index}:$rc@@\"{stop}"
+        )
+    return "\n".join(parts)
+
+def parse_batch_output(output: str, count: int, token: str) -> list:
+    """
+    Separar la salida de un script de build_batch_script en un resultado por
+    comando, con el mismo formato que DeviceConnection.execute_command más
+    el código de salida. Las secciones sin marcador de fin se reportan como error.
+    """
+    sections = {}
+    pattern = re.compile(rf"@@{token}:(\d+)@@\r?\n(.*?)\r?\n@@{token}:\1:(\d+)@@", re.S)
+    for match in pattern.finditer(output):
+        sections[int(match.group(1))] = {
+            "status": "success",
+            "output": match.group(2),
+            "exit_code": int(match.group(3))
+        }
+    return [
+        sections.get(index, {"status": "error", "message": "Sección sin salida completa en el lote"})
+        for index in range(count)
+    ]
+
+def batch_section_error(result: dict) -> Optional[str]:
+    """
+    Mensaje de error de una sección de parse_batch_output, o None si el
+    comando terminó con código 0.
+    """
+    if result["status"] != "success":
+        return result["message"]
+    if result["exit_code"] != 0:
+        return result["output"].strip() or f"Código de salida {result['exit_code']}"
+    return None
+
+@dataclass
+class DeviceHealth:
+    """Salud de la conexión de un dispositivo, según los comandos y el supervisor"""
+    last_seen: Optional[str] = None
+    last_seen_at: float = 0.0  # time.monotonic() del último contacto exitoso
+    rtt_ms: Optional[float] = None
+    failures: int = 0  # fallos consecutivos
+    total_failures: int = 0
+    reconnects: int = 0
+    last_error: Optional[str] = None
+    next_check: float = 0.0  # time.monotonic() del próximo sondeo o reintento
+    
+    def seen(self, rtt_ms: Optional[float] = None):
+        """Registrar un contacto exitoso con el dispositivo"""
+        self.last_seen = datetime.now().isoformat()
+        self.last_seen_at = time.monotonic()
+        self.failures = 0
+        if rtt_ms is not None:
+            self.rtt_ms = round(rtt_ms, 2)
+    
+    def failed(self, error: str):
+        """Registrar un fallo de comando, sondeo o conexión"""
+        self.failures += 1
+        self.total_failures += 1
+        self.last_error = error
+    
+    def backoff(self) -> float:
+        """Espera antes del próximo reintento: exponencial con jitter (50-100 %)"""
+        delay = min(KEEPALIVE_BACKOFF_MAX, KEEPALIVE_BACKOFF_BASE * 2 ** max(self.failures - 1, 0))
+        return delay * random.uniform(0.5, 1.0)
+    
+    def summary(self) -> dict:
+        now = time.monotonic()
+        return {
+            "last_seen": self.last_seen,
+            "idle_s": round(now - self.last_seen_at, 1) if self.last_seen else None,
+            "rtt_ms": self.rtt_ms,
+            "failures": self.failures,
+            "total_failures": self.total_failures,
+            "reconnects": self.reconnects,
+            "last_error": self.last_error,
+            "next_check_s": round(max(self.next_check - now, 0), 1) if self.next_check else None,
+        }
+
+class DeviceConnection:
+    def __init__(self, ip: str, port: int = 5555, transport: Optional[str] = None):
+        self.ip = ip
+        self.port = port
+        self.transport = transport or ADB_TRANSPORT
+        self.device = None
+        self.connected = False
+        self.rsa_keys = None  # Claves compartidas del proceso, se toman al conectar
+        # Canales adicionales (otras DeviceConnection al mismo ip:port) para
+        # comandos de solo lectura en paralelo; se abren bajo demanda
+        self.read_channels = []
+        # Caché de datos del dispositivo: {clave: (instante, valor)}
+        self.cache = {}
+        # Salud de la conexión (compartida con los canales de lectura)
+        self.health = DeviceHealth()
+        # Una sola reconstrucción del índice de paquetes a la vez
+        self.package_index_lock = asyncio.Lock()
+        # Un solo socket ADB por dispositivo: los comandos se serializan en
+        # orden FIFO (asyncio.Lock despierta a los que esperan en orden)
+        self._lock = asyncio.Lock()
+        self.queue_depth = 0
+        self.commands_run = 0
+        self.total_wait_s = 0.0
+        self.max_wait_s = 0.0
+        self.last_wait_s = 0.0
+    
+    @property
+    def native_async(self) -> bool:
+        """Indica si la conexión usa el transporte asyncio nativo de adb_shell"""
+        return self.transport == "async"
+    
+    def _ensure_keys_loaded(self):
+        """Tomar las claves compartidas del proceso (se cargan en la primera conexión)"""
+        if not self.rsa_keys:
+            self.rsa_keys = load_adb_keys()
+    
+    def _create_device(self):
+        """Crear el objeto adb_shell correspondiente al modo de transporte"""
+        if self.native_async:
+            return AdbDeviceTcpAsync(self.ip, self.port)
+        return AdbDeviceTcp(self.ip, self.port)
+    
+    async def _call(self, method: str, *args, **kwargs):
+        """
+        Invocar un método de adb_shell según el modo de transporte.
+        En modo "async" se espera la corrutina directamente; en modo "thread"
+        la llamada bloqueante se delega al pool de hilos ADB.
+        
+        Si quien espera se cancela (cliente desconectado, flota cancelada) la
+        llamada sigue usando el socket: se espera a que termine antes de
+        propagar la cancelación, así la conexión sigue reservada y el próximo
+        comando no mezcla sus paquetes con los de esta.
+        """
+        func = getattr(self.device, method)
+        if self.native_async:
+            call = asyncio.ensure_future(func(*args, **kwargs))
+        else:
+            call = asyncio.ensure_future(run_blocking(func, *args, **kwargs))
+        try:
+            return await asyncio.shield(call)
+        except asyncio.CancelledError as cancelled:
+            while not call.done():
+                try:
+                    await asyncio.shield(call)
+                except BaseException:
+                    pass
+            raise cancelled
+    
+    @asynccontextmanager
+    async def exclusive(self):
+        """
+        Reservar la conexión ADB para un comando, respetando el orden de llegada.
+        Lanza 429 si la cola del dispositivo supera ADB_MAX_QUEUE.
+        """
+        if ADB_MAX_QUEUE and self.queue_depth >= ADB_MAX_QUEUE:
+            raise HTTPException(
+                status_code=429,
+                detail=f"Dispositivo {self.ip} ocupado: {self.queue_depth} peticiones en cola (máximo {ADB_MAX_QUEUE})"
+            )
+        self.queue_depth += 1
+        start = time.monotonic()
+        try:
+            async with self._lock:
+                wait = time.monotonic() - start
+                self.commands_run += 1
+                self.total_wait_s += wait
+                self.last_wait_s = wait
+                self.max_wait_s = max(self.max_wait_s, wait)
+                yield
+        finally:
+            self.queue_depth -= 1
+    
+    def queue_stats(self) -> dict:
+        """Estadísticas de la cola de comandos del dispositivo (todos sus canales)"""
+        channels = [self] + self.read_channels
+        commands = sum(c.commands_run for c in channels)
+        total_wait = sum(c.total_wait_s for c in channels)
+        return {
+            "depth": sum(c.queue_depth for c in channels),
+            "max_queue": ADB_MAX_QUEUE or None,
+            "channels": len(channels),
+            "commands": commands,
+            "avg_wait_ms": round(total_wait / commands * 1000, 2) if commands else 0.0,
+            "max_wait_ms": round(max(c.max_wait_s for c in channels) * 1000, 2),
+            "last_wait_ms": round(self.last_wait_s * 1000, 2)
+        }
+    
+    def cache_get(self, key: str, ttl: float):
+        """Obtener un valor de la caché si no superó su TTL (None si no hay)"""
+        entry = self.cache.get(key)
+        if entry is not None and time.monotonic() - entry[0] < ttl:
+            return entry[1]
+        return None
+    
+    def cache_set(self, key: str, value):
+        """Guardar un valor en la caché del dispositivo"""
+        self.cache[key] = (time.monotonic(), value)
+    
+    def invalidate_cache(self):
+        """Descartar todos los datos en caché del dispositivo"""
+        self.cache.clear()
+    
+    async def get_properties(self, refresh: bool = False) -> dict:
+        """Propiedades del sistema (volcado de getprop), en caché PROPS_CACHE_TTL"""
+        props = None if refresh else self.cache_get("properties", PROPS_CACHE_TTL)
+        if props is None:
+            result = await self.execute_command("getprop", read_only=True)
+            if result["status"] != "success":
+                return {}
+            props = parse_getprop(result["output"])
+            self.cache_set("properties", props)
+        return props
+    
+    def _read_channel(self) -> "DeviceConnection":
+        """
+        Elegir el canal para un comando de solo lectura: uno libre si lo hay,
+        uno nuevo si aún no se alcanzó ADB_CHANNELS_PER_DEVICE, o el de menor
+        cola. Se prefieren los canales adicionales para dejar libre el
+        principal, por donde van los eventos de entrada.
+        """
+        idle = [c for c in self.read_channels if c.queue_depth == 0 and c.connected]
+        if idle:
+            return idle[0]
+        if self.queue_depth == 0:
+            return self
+        if len(self.read_channels) + 1 < ADB_CHANNELS_PER_DEVICE:
+            channel = DeviceConnection(self.ip, self.port, self.transport)
+            channel.rsa_keys = self.rsa_keys
+            channel.health = self.health
+            self.read_channels.append(channel)
+            logger.info(f"Abriendo canal ADB adicional {len(self.read_channels)} para {self.ip}")
+            return channel
+        return min(self.read_channels + [self], key=lambda c: c.queue_depth)
+    
+    async def connect(self) -> dict:
+        """Conectar al dispositivo"""
+        async with self.exclusive():
+            return await self._connect()
+    
+    async def _connect(self) -> dict:
+        """Conectar al dispositivo (requiere tener la conexión reservada)"""
+        try:
+            # Tomar las claves compartidas. Solo la primera conexión del
+            # proceso lee adbkey del disco: en modo "thread" lo hace en el pool
+            # de hilos, en modo "async" en línea para no depender de él.
+            if self.native_async or adb_keys:
+                self._ensure_keys_loaded()
+            else:
+                await run_blocking(self._ensure_keys_loaded)
+            
+            logger.info(f"Intentando conectar a {self.ip}:{self.port} (transporte {self.transport})")
+            # Crear dispositivo
+            self.device = self._create_device()
+            # Conectar
+            await self._call("connect", rsa_keys=self.rsa_keys)
+            self.connected = True
+            # Una reconexión puede ser otro dispositivo o un reinicio: descartar caché
+            self.invalidate_cache()
+            self.health.seen()
+            self.publish_connection()
+            logger.info(f"Conectado exitosamente a {self.ip}:{self.port}")
+            return {"status": "success", "message": f"Conectado a {self.ip}:{self.port}"}
+        except Exception as e:
+            self.connected = False
+            self.health.failed(str(e))
+            self.publish_connection(str(e))
+            logger.error(f"Error al conectar: {str(e)}")
+            return {"status": "error", "message": str(e)}
+    
+    def publish_connection(self, error: Optional[str] = None):
+        """Publicar el estado de conexión en el bus de eventos (solo la conexión registrada)"""
+        if devices.get(self.ip) is self:
+            data = {"connected": self.connected}
+            if error:
+                data["error"] = error
+            last = event_bus.states.get((self.ip, "device"))
+            if last is None or last["data"]["connected"] != self.connected:
+                event_bus.publish(self.ip, "device", data)
+    
+    async def disconnect(self) -> dict:
+        """Desconectar del dispositivo"""
+        try:
+            for channel in self.read_channels:
+                await channel.disconnect()
+            self.read_channels = []
+            if self.device:
+                async with self.exclusive():
+                    await self._call("close")
+            self.connected = False
+            self.publish_connection()
+            logger.info(f"Desconectado de {self.ip}:{self.port}")
+            return {"status": "success", "message": "Desconectado"}
+        except Exception as e:
+            logger.error(f"Error al desconectar: {str(e)}")
+            return {"status": "error", "message": str(e)}
+    
+    async def execute_command(self, cmd: str, read_only: bool = False) -> dict:
+        """
+        Ejecutar comando ADB.
+        Con read_only=True el comando puede ir por cualquier canal del
+        dispositivo y ejecutarse en paralelo con otros de lectura.
+        """
+        return await self._execute("shell", cmd, read_only)
+    
+    async def exec_out(self, cmd: str, read_only: bool = False) -> dict:
+        """
+        Ejecutar un comando por el servicio `exec` (como `adb exec-out`).
+        La salida llega en bytes, sin la conversión de saltos de línea del
+        servicio shell, así que sirve para datos binarios como imágenes.
+        """
+        return await self._execute("exec_out", cmd, read_only, decode=False)
+    
+    async def _execute(self, method: str, cmd: str, read_only: bool, **kwargs) -> dict:
+        """Ejecutar un comando con el servicio indicado ("shell" o "exec_out")"""
+        if read_only and ADB_CHANNELS_PER_DEVICE > 1:
+            channel = self._read_channel()
+            if channel is not self:
+                return await channel._execute(method, cmd, False, **kwargs)
+        
+        async with self.exclusive():
+            if not self.connected:
+                logger.info(f"Dispositivo no conectado, intentando reconectar")
+                connect_result = await self._connect()
+                if connect_result["status"] == "error":
+                    return connect_result
+            
+            try:
+                logger.info(f"Ejecutando comando en {self.ip}: {cmd}")
+                result = await self._call(method, cmd, **kwargs)
+                self.health.seen()
+                logger.info(f"Comando ejecutado exitosamente")
+                return {"status": "success", "output": result}
+            except Exception as e:
+                self.connected = False
+                self.health.failed(str(e))
+                self.publish_connection(str(e))
+                logger.error(f"Error al ejecutar comando: {str(e)}")
+                return {"status": "error", "message": str(e)}
+    
+    async def probe(self) -> dict:
+        """
+        Sondeo keepalive: ejecutar el comando nulo del shell con tiempos de
+        espera cortos y medir el RTT. No reconecta: si falla, la conexión
+        queda marcada como caída.
+        """
+        async with self.exclusive():
+            if not self.connected:
+                return {"status": "error", "message": "Dispositivo no conectado"}
+            start = time.perf_counter()
+            try:
+                await self._call("shell", KEEPALIVE_COMMAND,
+                                 transport_timeout_s=KEEPALIVE_TIMEOUT, read_timeout_s=KEEPALIVE_TIMEOUT)
+            except Exception as e:
+                self.connected = False
+                self.health.failed(str(e) or type(e).__name__)
+                self.publish_connection(self.health.last_error)
+                logger.warning(f"Keepalive fallido en {self.ip}: {self.health.last_error}")
+                return {"status": "error", "message": self.health.last_error}
+            self.health.seen((time.perf_counter() - start) * 1000)
+            return {"status": "success", "rtt_ms": self.health.rtt_ms}
+    
+    async def execute_batch(self, commands: dict, read_only: bool = False,
+                            stop_on_error: bool = False) -> dict:
+        """
+        Ejecutar varios comandos en un solo round trip ADB.
+        Recibe {clave: comando} y retorna {clave: resultado}, donde cada
+        resultado tiene el formato de execute_command más "exit_code". Con
+        stop_on_error los comandos posteriores al primero que falla no se
+        ejecutan y su resultado es un error.
+        """
+        token = uuid.uuid4().hex[:12]
+        keys = list(commands)
+        script = build_batch_script([commands[k] for k in keys], token, stop_on_error)
+        result = await self.execute_command(script, read_only=read_only)
+        if result["status"] != "success":
+            return {key: result for key in keys}
+        return dict(zip(keys, parse_batch_output(result["output"], len(keys), token)))
+    
+    async def open_stream_channel(self) -> "DeviceConnection":
+        """
+        Abrir una conexión ADB dedicada para un comando de larga duración
+        (p. ej. `logcat`), para no ocupar la conexión principal. Lanza
+        ConnectionError si no se puede conectar.
+        """
+        channel = DeviceConnection(self.ip, self.port, self.transport)
+        channel.rsa_keys = self.rsa_keys
+        result = await channel.connect()
+        if result["status"] == "error":
+            raise ConnectionError(result["message"])
+        return channel
+    
+    async def stream_lines(self, cmd: str):
+        """
+        Ejecutar un comando y generar su salida línea a línea, a medida que
+        llega. Pensado para canales de open_stream_channel: al cerrar el
+        generador se cierra la conexión y adbd termina el proceso en el
+        dispositivo.
+        """
+        logger.info(f"Streaming en {self.ip}: {cmd}")
+        try:
+            decoder = codecs.getincrementaldecoder("utf8")(errors="replace")
+            pending = ""
+            async for chunk in self._stream_chunks(cmd):
+                *lines, pending = (pending + decoder.decode(chunk)).split("\n")
+                for line in lines:
+                    yield line.rstrip("\r")
+            pending += decoder.decode(b"", final=True)
+            if pending:
+                yield pending.rstrip("\r")
+        finally:
+            await self.disconnect()
+            logger.info(f"Streaming finalizado en {self.ip}: {cmd}")
+    
+    async def _stream_chunks(self, cmd: str):
+        """Generar los bloques de salida (bytes) de `streaming_shell` sin límite de tiempo"""
+        kwargs = {"read_timeout_s": STREAM_READ_TIMEOUT, "decode": False}
+        if self.native_async:
+            stream = self.device.streaming_shell(cmd, **kwargs)
+            try:
+                async for chunk in stream:
+                    yield chunk
+            finally:
+                await stream.aclose()
+            return
+        
+        # Modo "thread": un hilo propio por stream (no ocupa el pool ADB) que
+        # entrega los bloques por una cola acotada
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+        finished = object()
+        
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+        
+        def reader():
+            try:
+                for chunk in self.device.streaming_shell(cmd, **kwargs):
+                    put(chunk)
+                item = finished
+            except Exception as e:
+                item = e
+            try:
+                put(item)
+            except RuntimeError:
+                pass  # El event loop ya terminó
+        
+        threading.Thread(target=reader, daemon=True, name=f"adb-stream-{self.ip}").start()
+        try:
+            while True:
+                item = await queue.get()
+                if item is finished:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Cerrar el socket despierta al hilo si está leyendo; vaciar la
+            # cola lo libera si estaba esperando lugar para un bloque
+            self.device.close()
+            while not queue.empty():
+                queue.get_nowait()
+
+async def get_volume_state(device: DeviceConnection, refresh: bool = False) -> dict:
+    """Estado de volumen por stream, en caché VOLUME_CACHE_TTL segundos"""
+    streams = None if refresh else device.cache_get("volume_state", VOLUME_CACHE_TTL)
+    if streams is None:
+        result = await device.execute_command(AUDIO_STATE_COMMAND, read_only=True)
+        if result["status"] != "success":
+            return {}
+        streams = parse_audio_streams(result["output"])
+        device.cache_set("volume_state", streams)
+        publish_volume(device.ip, streams)
+    return streams
+
+async def get_package_index(device: DeviceConnection, refresh: bool = False) -> PackageIndex:
+    """
+    Índice de paquetes del dispositivo. Pasados PACKAGES_CACHE_TTL segundos
+    se consulta solo la marca de cambios de packages.xml y el índice se
+    reconstruye únicamente si cambió (o si no se puede leer la marca).
+    """
+    async with device.package_index_lock:
+        return await _load_package_index(device, refresh)
+
+async def _load_package_index(device: DeviceConnection, refresh: bool) -> PackageIndex:
+    """Cargar o reconstruir el índice de paquetes (requiere package_index_lock)"""
+    index = device.cache_get("package_index", float("inf"))
+    if index is not None and not refresh:
+        if time.monotonic() - index.checked < PACKAGES_CACHE_TTL:
+            return index
+        result = await device.execute_command(PACKAGES_STAMP_COMMAND, read_only=True)
+        stamp = result["output"].strip() if result["status"] == "success" else ""
+        if stamp.isdigit() and stamp == index.stamp:
+            index.checked = time.monotonic()
+            return index
+    
+    results = await device.execute_batch(
+        {"stamp": PACKAGES_STAMP_COMMAND, **PACKAGE_LIST_COMMANDS}, read_only=True
+    )
+    packages = []
+    for key, is_system_app in (("system", True), ("third_party", False)):
+        result = results[key]
+        if result["status"] != "success":
+            raise RuntimeError(result["message"])
+        if result["exit_code"] != 0:
+            raise RuntimeError(result["output"].strip() or f"{PACKAGE_LIST_COMMANDS[key]} falló")
+        packages += parse_package_list(result["output"], is_system_app)
+    stamp = results["stamp"]
+    stamp = stamp["output"].strip() if stamp["status"] == "success" and stamp["exit_code"] == 0 else None
+    index = PackageIndex(packages, stamp, previous=index)
+    device.cache_set("package_index", index)
+    logger.info(f"Índice de paquetes de {device.ip}: {len(packages)} paquetes")
+    return index
+
+async def get_package_details(device: DeviceConnection, index: PackageIndex) -> dict:
+    """
+    Metadatos {paquete: PackageDetails} de todas las apps, con un solo
+    `dumpsys package packages` leído en streaming por un canal dedicado.
+    Se guardan en el índice, así que se descartan cuando este se reconstruye.
+    """
+    async with index.details_lock:
+        if index.details is None:
+            channel = await device.open_stream_channel()
+            parser = PackageDetailsParser()
+            
+            async def collect():
+                async for line in channel.stream_lines(PACKAGE_DETAILS_COMMAND):
+                    parser.feed(line)
+            
+            try:
+                await asyncio.wait_for(collect(), PACKAGE_DETAILS_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise RuntimeError(f"{PACKAGE_DETAILS_COMMAND} no terminó en {PACKAGE_DETAILS_TIMEOUT:g} s")
+            index.details = parser.details
+            logger.info(f"Metadatos de {len(parser.details)} paquetes de {device.ip}")
+    return index.details
+
+async def volume_method(device: DeviceConnection) -> str:
+    """Método para fijar el volumen: el recordado para el dispositivo o el que corresponde a su nivel de API"""
+    method = device.cache_get("volume_method", PROPS_CACHE_TTL)
+    if method is None:
+        props = await device.get_properties()
+        method = volume_method_for_api(props.get("ro.build.version.sdk"))
+    return method
+
+def volume_set_command(method: str, level: Optional[int] = None, keycodes: tuple = ()) -> str:
+    """Comando que fija un nivel absoluto (level) o envía teclas de volumen (keycodes)"""
+    if level is None:
+        return keyevent_command(*keycodes)
+    if method != "keyevent":
+        return VOLUME_SET_COMMANDS[method].format(level=level)
+    return keyevent_command(
+        *["KEYCODE_VOLUME_DOWN"] * VOLUME_KEYEVENT_MAX_STEPS,
+        *["KEYCODE_VOLUME_UP"] * level
+    )
+
+def volume_state_result(device: DeviceConnection, state_result: dict) -> Optional[dict]:
+    """Guardar en caché y publicar el estado de los streams leído; retorna el de música"""
+    if state_result["status"] != "success":
+        return None
+    streams = parse_audio_streams(state_result["output"])
+    device.cache_set("volume_state", streams)
+    publish_volume(device.ip, streams)
+    return asdict(streams["music"]) if "music" in streams else None
+
+async def apply_volume(device: DeviceConnection, level: Optional[int] = None,
+                       keycodes: tuple = ()) -> dict:
+    """
+    Motor de volumen. Fija un nivel absoluto (level) o envía teclas de
+    volumen (keycodes) y, en el mismo round trip ADB, lee el estado de todos
+    los streams, que queda en la caché del dispositivo.
+    Si el método elegido por nivel de API no funciona en el dispositivo se
+    prueba el siguiente (media_session → media → teclas, estas en una sola
+    invocación de `input`) y se recuerda el que funcionó.
+    """
+    method = await volume_method(device)
+    set_command = volume_set_command(method, level, keycodes)
+    
+    results = await device.execute_batch({"set": set_command, "state": AUDIO_STATE_COMMAND})
+    set_result = results["set"]
+    if set_result["status"] != "success":
+        return {"status": "error", "method": method, "message": set_result.get("message")}
+    
+    if level is not None and method != "keyevent" and (
+            set_result["exit_code"] != 0 or "not found" in set_result["output"]):
+        fallback = VOLUME_METHOD_FALLBACK[method]
+        logger.info(f"Método de volumen '{method}' no soportado en {device.ip}, usando '{fallback}'")
+        device.cache_set("volume_method", fallback)
+        return await apply_volume(device, level=level)
+    device.cache_set("volume_method", method)
+    
+    return {"status": "success", "method": method, "volume": volume_state_result(device, results["state"])}
+
+class BatchStep(BaseModel):
+    """Paso de /device/batch; los campos usados dependen de `op`"""
+    op: str = Field(..., description="keyevent, shell, play, stop, exit, volume, current_app, volume_current o wait")
+    keycodes: Optional[list[str]] = Field(None, description="keyevent: teclas en orden (ej: ['KEYCODE_HOME'])")
+    command: Optional[str] = Field(None, description="shell: comando a ejecutar")
+    video_url: Optional[str] = Field(None, description="play: URL de YouTube")
+    level: Optional[int] = Field(None, ge=0, le=15, description="volume: nivel (0-15)")
+    ms: Optional[int] = Field(None, ge=0, le=BATCH_MAX_WAIT_MS, description="wait: milisegundos de espera")
+
+class DeviceBatch(BaseModel):
+    """Cuerpo de /device/batch"""
+    steps: list[BatchStep] = Field(..., description=f"Operaciones en orden (máximo {BATCH_MAX_STEPS})")
+    stop_on_error: bool = Field(False, description="No ejecutar los pasos posteriores al primero que falla")
+
+def validate_batch_step(index: int, step: BatchStep):
+    """Validar que un paso tenga los campos de su operación. Lanza HTTPException 400."""
+    def invalid(message):
+        raise HTTPException(status_code=400, detail=f"Paso {index} ({step.op}): {message}")
+    
+    if step.op not in BATCH_OPS:
+        invalid(f"operación desconocida (válidas: {', '.join(BATCH_OPS)})")
+    if step.op == "keyevent" and (not step.keycodes or not all(KEYCODE_NAME.match(k) for k in step.keycodes)):
+        invalid("keycodes debe ser una lista de teclas KEYCODE_* o códigos numéricos")
+    if step.op == "shell" and (not step.command or not step.command.strip()):
+        invalid("command es requerido")
+    if step.op == "play" and (not step.video_url or ("youtube.com" not in step.video_url and "youtu.be" not in step.video_url)):
+        invalid("video_url debe ser una URL válida de YouTube")
+    if step.op == "volume" and step.level is None:
+        invalid("level es requerido (0-15)")
+    if step.op == "wait" and step.ms is None:
+        invalid("ms es requerido")
+
+def batch_step_commands(step: BatchStep, method: Optional[str]) -> dict:
+    """Comandos shell de un paso: {"run": comando} más "state" en los de volumen"""
+    if step.op == "keyevent":
+        return {"run": keyevent_command(*step.keycodes)}
+    if step.op == "shell":
+        return {"run": step.command}
+    if step.op == "play":
+        return {"run": play_command(step.video_url)}
+    if step.op == "stop":
+        return {"run": keyevent_command("KEYCODE_SPACE")}
+    if step.op == "exit":
+        return {"run": keyevent_command("KEYCODE_BACK")}
+    if step.op == "volume":
+        return {"run": volume_set_command(method, step.level), "state": AUDIO_STATE_COMMAND}
+    if step.op == "current_app":
+        # Sin ventana enfocada grep sale con 1: no es un error del paso
+        return {"run": f"{FOREGROUND_QUERY_COMMAND} || true"}
+    return {"run": AUDIO_STATE_COMMAND}
+
+def batch_step_result(device: DeviceConnection, step: BatchStep, results: dict) -> dict:
+    """Resultado de un paso a partir de las secciones de su lote"""
+    run = results["run"]
+    if run["status"] != "success":
+        return {"status": "error", "message": run["message"]}
+    if step.op == "current_app":
+        package_name, activity = parse_foreground_component(run["output"])
+        event_bus.update(device.ip, "app", {"package": package_name, "activity": activity})
+        return {"status": "success", "package": package_name, "activity": activity}
+    record = {"status": "success" if run["exit_code"] == 0 else "error", "exit_code": run["exit_code"]}
+    if step.op == "volume":
+        record.update(level=step.level, volume=volume_state_result(device, results["state"]))
+    elif step.op == "volume_current":
+        record["volume"] = volume_state_result(device, run)
+    else:
+        record["output"] = run["output"]
+    return record
+
+async def run_device_batch(device: DeviceConnection, steps: list, stop_on_error: bool) -> tuple:
+    """
+    Ejecutar los pasos en orden y retornar (resultados, round trips ADB).
+    Los pasos consecutivos se unen en un solo script (execute_batch): solo
+    cortan el lote las esperas (`wait`) y un `volume` en un dispositivo cuyo
+    método de volumen todavía no se comprobó, que va aparte con apply_volume
+    para detectarlo y recordarlo. Con stop_on_error el script termina en el
+    primer paso que falla y los siguientes se marcan "skipped".
+    """
+    records = []
+    round_trips = 0
+    failed = False
+    
+    def mergeable(step):
+        return step.op != "wait" and (step.op != "volume" or device.cache_get("volume_method", PROPS_CACHE_TTL))
+    
+    while len(records) < len(steps):
+        index = len(records)
+        step = steps[index]
+        if failed:
+            records.append({"index": index, "op": step.op, "status": "skipped"})
+            continue
+        if step.op == "wait":
+            await asyncio.sleep(step.ms / 1000)
+            records.append({"index": index, "op": step.op, "status": "success", "ms": step.ms})
+            continue
+        if not mergeable(step):
+            result = await apply_volume(device, level=step.level)
+            round_trips += 1
+            record = {"index": index, "op": step.op, "level": step.level, **result}
+            records.append(record)
+            failed = stop_on_error and record["status"] != "success"
+            continue
+        
+        group = [index]
+        while group[-1] + 1 < len(steps) and mergeable(steps[group[-1] + 1]):
+            group.append(group[-1] + 1)
+        method = device.cache_get("volume_method", PROPS_CACHE_TTL)
+        commands = {}
+        for i in group:
+            for part, command in batch_step_commands(steps[i], method).items():
+                commands[(i, part)] = command
+        results = await device.execute_batch(commands, stop_on_error=stop_on_error)
+        round_trips += 1
+        for i in group:
+            if failed:
+                records.append({"index": i, "op": steps[i].op, "status": "skipped"})
+                continue
+            step_results = {part: result for (j, part), result in results.items() if j == i}
+            record = {"index": i, "op": steps[i].op, **batch_step_result(device, steps[i], step_results)}
+            records.append(record)
+            failed = stop_on_error and record["status"] != "success"
+    return records, round_trips
+
+class FrameStream:
+    """
+    Bucle de captura de pantalla de un dispositivo, compartido por todos sus
+    espectadores. Captura el framebuffer en crudo al ritmo del espectador más
+    exigente y guarda solo el último frame: quien no alcanza a consumirlos
+    recibe siempre el más reciente y se salta los intermedios. Las capturas
+    van por una conexión dedicada, para que los comandos de control no
+    esperen detrás de la transferencia de un frame.
+    """
+    
+    def __init__(self, device_ip: str):
+        self.device_ip = device_ip
+        self.viewers = {}
+        self.frame = None
+        self.seq = 0
+        self.error = None
+        self.encoded = {}
+        self.updated = asyncio.Condition()
+        self.task = None
+        self.channel = None
+    
+    def subscribe(self, fps: float) -> object:
+        """Registrar un espectador y arrancar el bucle si no está corriendo"""
+        viewer = object()
+        self.viewers[viewer] = min(fps, STREAM_MAX_FPS)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._run())
+        return viewer
+    
+    def unsubscribe(self, viewer: object):
+        """Dar de baja un espectador; sin espectadores el bucle se detiene"""
+        self.viewers.pop(viewer, None)
+        if not self.viewers:
+            if self.task:
+                self.task.cancel()
+            if frame_streams.get(self.device_ip) is self:
+                del frame_streams[self.device_ip]
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self.viewers:
+                start = loop.time()
+                interval = 1 / max(self.viewers.values())
+                try:
+                    device = devices.get(self.device_ip)
+                    if device is None:
+                        raise RuntimeError("Dispositivo no conectado")
+                    if self.channel is None:
+                        self.channel = await device.open_stream_channel()
+                    result = await self.channel.exec_out("screencap")
+                    if result["status"] != "success":
+                        raise RuntimeError(result["message"])
+                    frame = await run_blocking(parse_raw_screencap, result["output"])
+                    async with self.updated:
+                        self.frame, self.seq, self.encoded, self.error = frame, self.seq + 1, {}, None
+                        self.updated.notify_all()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.error = str(e)
+                    logger.warning(f"Error capturando pantalla de {self.device_ip}: {self.error}")
+                    interval = max(interval, 1)
+                    # La conexión dedicada se vuelve a abrir en la próxima captura
+                    await self.close_channel()
+                await asyncio.sleep(max(0, interval - (loop.time() - start)))
+        finally:
+            await self.close_channel()
+    
+    async def close_channel(self):
+        channel, self.channel = self.channel, None
+        if channel is not None:
+            await channel.disconnect()
+    
+    async def next_frame(self, after_seq: int, quality: int, width: Optional[int]) -> tuple:
+        """
+        Esperar un frame posterior a after_seq y retornar (seq, jpeg).
+        Los espectadores con la misma calidad y ancho comparten la codificación.
+        """
+        async with self.updated:
+            await self.updated.wait_for(lambda: self.seq > after_seq)
+            seq, frame = self.seq, self.frame
+        key = (quality, width)
+        cached = self.encoded.get(key)
+        if cached is None or cached[0] != seq:
+            cached = (seq, await run_blocking(encode_image, frame, "jpeg", quality, width))
+            if seq == self.seq:
+                self.encoded[key] = cached
+        return cached
+    
+    async def frames(self, viewer: object, quality: int, width: Optional[int], first: tuple = None):
+        """Generar los frames JPEG de un espectador a su propio ritmo"""
+        loop = asyncio.get_running_loop()
+        interval = 1 / self.viewers[viewer]
+        seq = 0
+        while True:
+            start = loop.time()
+            if first:
+                (seq, jpeg), first = first, None
+            else:
+                seq, jpeg = await self.next_frame(seq, quality, width)
+            yield jpeg
+            await asyncio.sleep(max(0, interval - (loop.time() - start)))
+
+async def pump_websocket(websocket: WebSocket, messages, send):
+    """
+    Enviar por el WebSocket cada elemento del generador `messages` con
+    `send` (send_bytes/send_text) hasta que se agote o el cliente cierre.
+    El envío corre en segundo plano para detectar el cierre aunque no haya
+    nada que enviar; al terminar se cierra el generador.
+    """
+    async def sender():
+        async for message in messages:
+            await send(message)
+    
+    task = asyncio.ensure_future(sender())
+    try:
+        while not task.done():
+            receive = asyncio.ensure_future(websocket.receive())
+            await asyncio.wait({task, receive}, return_when=asyncio.FIRST_COMPLETED)
+            if not receive.done():
+                receive.cancel()
+            elif receive.result()["type"] == "websocket.disconnect":
+                break
+        if task.done() and not task.cancelled() and task.exception() is None:
+            await websocket.close()
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await messages.aclose()
+
+async def open_frame_stream(device_ip: str, fps: float, quality: int, width: Optional[int]) -> tuple:
+    """
+    Suscribirse al bucle de captura del dispositivo y esperar el primer frame.
+    Retorna (stream, espectador, primer frame). Lanza HTTPException 503 si no
+    se obtiene ningún frame a tiempo.
+    """
+    stream = frame_streams.get(device_ip)
+    if stream is None:
+        stream = frame_streams[device_ip] = FrameStream(device_ip)
+    viewer = stream.subscribe(fps)
+    try:
+        first = await asyncio.wait_for(stream.next_frame(0, quality, width), STREAM_FIRST_FRAME_TIMEOUT)
+    except asyncio.TimeoutError:
+        stream.unsubscribe(viewer)
+        raise HTTPException(status_code=503, detail=f"No se pudo capturar la pantalla: {stream.error or 'tiempo agotado'}")
+    except BaseException:
+        stream.unsubscribe(viewer)
+        raise
+    return stream, viewer, first
+
+class LogcatCollector:
+    """
+    Colector de logcat en segundo plano para un dispositivo. Mantiene un
+    `logcat` en una conexión dedicada y guarda cada línea con un número de
+    secuencia en un buffer circular. Las consultas (?since_seq=) se sirven
+    desde memoria, sin ADB. Si la conexión se corta, se reintenta y se
+    retoma desde el último timestamp recibido.
+    """
+    
+    def __init__(self, device_ip: str):
+        self.device_ip = device_ip
+        self.entries = deque()  # (seq, instante de llegada, LogcatEntry, bytes)
+        self.size = 0
+        self.last_seq = 0
+        self.evicted = 0
+        self.error = None
+        self.started_at = datetime.now().isoformat()
+        self.task = None
+        self.channel = None
+        self.stopped = False
+    
+    def start(self):
+        self.stopped = False
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._run())
+    
+    async def stop(self):
+        # En modo "async" además se cierra la conexión de logcat: en Python
+        # 3.11 asyncio.wait_for (usado por adb_shell) puede tragarse la
+        # cancelación si llega junto con un bloque de datos
+        self.stopped = True
+        if self.task:
+            self.task.cancel()
+            if self.channel and self.channel.native_async:
+                await self.channel.disconnect()
+            await asyncio.gather(self.task, return_exceptions=True)
+    
+    async def _run(self):
+        while not self.stopped:
+            try:
+                device = devices.get(self.device_ip)
+                if device is None:
+                    raise RuntimeError("Dispositivo no conectado")
+                last = self.entries[-1][2] if self.entries else None
+                # Al retomar se pide desde el último timestamp y se descartan
+                # las líneas ya guardadas de ese mismo milisegundo
+                seen = []
+                for _, _, entry, _ in reversed(self.entries):
+                    if entry.timestamp != last.timestamp:
+                        break
+                    seen.append(entry)
+                cmd = f"logcat -v threadtime -T {shlex.quote(last.timestamp)}" if last else "logcat -v threadtime -T 1"
+                channel = self.channel = await device.open_stream_channel()
+                self.error = None
+                lines = channel.stream_lines(cmd)
+                try:
+                    async for line in lines:
+                        if self.stopped:
+                            return
+                        entry = parse_logcat_line(line)
+                        if entry is None:
+                            continue
+                        if last and (entry.timestamp < last.timestamp or entry in seen):
+                            continue
+                        self.append(entry)
+                finally:
+                    self.channel = None
+                    await lines.aclose()
+                    await channel.disconnect()
+                if self.stopped:
+                    return
+                raise RuntimeError("logcat terminó")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self.stopped:
+                    return
+                self.error = str(e)
+                logger.warning(f"Colector de logcat de {self.device_ip}: {self.error}; reintentando en {LOGCAT_COLLECTOR_RETRY}s")
+                await asyncio.sleep(LOGCAT_COLLECTOR_RETRY)
+    
+    def append(self, entry: LogcatEntry):
+        """Agregar una línea y descartar las más viejas si se excede el tamaño"""
+        self.last_seq += 1
+        size = len(entry.tag) + len(entry.message) + 96
+        self.entries.append((self.last_seq, time.monotonic(), entry, size))
+        self.size += size
+        while self.size > LOGCAT_BUFFER_BYTES:
+            self._evict()
+        self.expire()
+    
+    def _evict(self):
+        _, _, _, size = self.entries.popleft()
+        self.size -= size
+        self.evicted += 1
+    
+    def expire(self):
+        """Descartar las líneas más antiguas que LOGCAT_BUFFER_MAX_AGE"""
+        limit = time.monotonic() - LOGCAT_BUFFER_MAX_AGE
+        while self.entries and self.entries[0][1] < limit:
+            self._evict()
+    
+    def fetch(self, since_seq: int, limit: int, matches) -> dict:
+        """
+        Líneas con secuencia mayor a since_seq que cumplen el filtro, hasta
+        `limit`. next_seq es la última secuencia revisada (coincida o no),
+        para que la próxima consulta continúe desde ahí.
+        """
+        self.expire()
+        first_seq = self.entries[0][0] if self.entries else self.last_seq + 1
+        start = max(0, since_seq + 1 - first_seq)
+        results = []
+        next_seq = max(since_seq, first_seq - 1)
+        for index in range(start, len(self.entries)):
+            seq, _, entry, _ = self.entries[index]
+            next_seq = seq
+            if matches(entry):
+                results.append({"seq": seq, **asdict(entry)})
+                if len(results) == limit:
+                    break
+        return {
+            "entries": results,
+            "next_seq": next_seq,
+            "first_seq": first_seq,
+            "last_seq": self.last_seq,
+            # El cliente se perdió líneas que ya salieron del buffer
+            "missed": since_seq + 1 < first_seq and since_seq < self.last_seq,
+        }
+    
+    def stats(self) -> dict:
+        return {
+            "running": self.task is not None and not self.task.done(),
+            "lines": len(self.entries),
+            "bytes": self.size,
+            "last_seq": self.last_seq,
+            "evicted": self.evicted,
+            "error": self.error,
+            "started_at": self.started_at,
+        }
+
+class ForegroundWatcher:
+    """
+    Vigilante de la app en primer plano de un dispositivo. Consulta el foco
+    una vez con dumpsys y luego sigue los eventos de actividad reanudada de
+    `logcat -b events` en una conexión dedicada, así que el dispositivo
+    solo trabaja cuando cambia la app. Cada cambio se publica a los
+    suscriptores de /device/current-app/stream.
+    """
+    
+    def __init__(self, device_ip: str):
+        self.device_ip = device_ip
+        self.package = None
+        self.activity = None
+        self.raw = ""
+        self.seq = 0
+        self.changed_at = None
+        self.ready = asyncio.Event()
+        self.subscribers = set()
+        self.error = None
+        self.started_at = datetime.now().isoformat()
+        self.task = None
+        self.channel = None
+        self.stopped = False
+    
+    def start(self):
+        self.stopped = False
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._run())
+    
+    async def stop(self):
+        # Igual que LogcatCollector.stop: en modo "async" se cierra también la
+        # conexión para que la cancelación no se pierda
+        self.stopped = True
+        if self.task:
+            self.task.cancel()
+            if self.channel and self.channel.native_async:
+                await self.channel.disconnect()
+            await asyncio.gather(self.task, return_exceptions=True)
+    
+    async def query(self, device: DeviceConnection) -> str:
+        """
+        Consultar el foco actual con dumpsys (al iniciar y al reconectar).
+        Retorna la hora del dispositivo tomada justo antes, desde la que se
+        siguen los eventos.
+        """
+        results = await device.execute_batch(
+            {"clock": DEVICE_CLOCK_COMMAND, "focus": FOREGROUND_QUERY_COMMAND}, read_only=True
+        )
+        clock, focus = results["clock"], results["focus"]
+        if focus["status"] != "success":
+            raise RuntimeError(focus["message"])
+        since = clock["output"].strip() if batch_section_error(clock) is None else ""
+        if not DEVICE_CLOCK.match(since):
+            raise RuntimeError(f"Hora del dispositivo no válida: {since or batch_section_error(clock)}")
+        raw = focus["output"].strip()
+        self.update(*parse_foreground_component(raw), raw)
+        return since
+    
+    async def _run(self):
+        while not self.stopped:
+            try:
+                device = devices.get(self.device_ip)
+                if device is None:
+                    raise RuntimeError("Dispositivo no conectado")
+                since = await self.query(device)
+                channel = self.channel = await device.open_stream_channel()
+                self.error = None
+                lines = channel.stream_lines(FOREGROUND_WATCH_COMMAND.format(since=shlex.quote(since)))
+                try:
+                    async for line in lines:
+                        if self.stopped:
+                            return
+                        event = EVENT_LOG_LINE.match(line.strip())
+                        if event:
+                            self.handle_event(*event.groups())
+                finally:
+                    self.channel = None
+                    await lines.aclose()
+                    await channel.disconnect()
+                if self.stopped:
+                    return
+                raise RuntimeError("logcat terminó")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self.stopped:
+                    return
+                self.error = str(e)
+                logger.warning(f"Vigilante de app de {self.device_ip}: {self.error}; reintentando en {FOREGROUND_RETRY}s")
+                await asyncio.sleep(FOREGROUND_RETRY)
+    
+    def handle_event(self, tag: str, payload: str):
+        """Procesar un evento de `logcat -b events` (tag y contenido)"""
+        if tag == "screen_toggled":
+            # 0 = apagada; 1 = encendida (2 = doze en algunas versiones)
+            event_bus.update(self.device_ip, "screen", {"on": payload.strip() != "0"})
+        elif tag == "battery_level":
+            # [nivel,voltaje,temperatura]
+            level = payload.strip("[] ").split(",")[0]
+            if level.isdigit():
+                event_bus.update(self.device_ip, "battery", {"level": int(level)})
+        else:
+            package, activity = parse_foreground_component(payload)
+            if package:
+                self.update(package, activity, f"{tag}: {payload}")
+    
+    def update(self, package: Optional[str], activity: Optional[str], raw: str):
+        """Registrar la app en primer plano y avisar a los suscriptores si cambió"""
+        self.raw = raw
+        if self.ready.is_set() and (package, activity) == (self.package, self.activity):
+            return
+        self.package, self.activity = package, activity
+        event_bus.update(self.device_ip, "app", {"package": package, "activity": activity})
+        self.seq += 1
+        self.changed_at = datetime.now().isoformat()
+        self.ready.set()
+        event = self.state()
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+    
+    def state(self) -> dict:
+        return {
+            "package": self.package,
+            "activity": self.activity,
+            "seq": self.seq,
+            "changed_at": self.changed_at,
+        }
+    
+    async def events(self):
+        """Generar el estado actual y luego cada cambio de app"""
+        queue = asyncio.Queue(FOREGROUND_QUEUE_EVENTS)
+        self.subscribers.add(queue)
+        try:
+            await self.ready.wait()
+            last_seq = self.seq
+            yield self.state()
+            while True:
+                event = await queue.get()
+                if event["seq"] > last_seq:
+                    last_seq = event["seq"]
+                    yield event
+        finally:
+            self.subscribers.discard(queue)
+    
+    def stats(self) -> dict:
+        return {
+            "running": self.task is not None and not self.task.done(),
+            "changes": self.seq,
+            "subscribers": len(self.subscribers),
+            "error": self.error,
+            "started_at": self.started_at,
+        }
+
+def foreground_watcher(device_ip: str) -> ForegroundWatcher:
+    """Vigilante de app en primer plano del dispositivo, iniciándolo si hace falta"""
+    watcher = foreground_watchers.get(device_ip)
+    if watcher is None:
+        watcher = foreground_watchers[device_ip] = ForegroundWatcher(device_ip)
+    watcher.start()
+    return watcher
+
+async def stop_foreground_watcher(device_ip: str):
+    """Detener y descartar el vigilante de app de un dispositivo, si existe"""
+    watcher = foreground_watchers.pop(device_ip, None)
+    if watcher:
+        await watcher.stop()
+
+async def stop_logcat_collector(device_ip: str):
+    """Detener y descartar el colector de logcat de un dispositivo, si existe"""
+    collector = logcat_collectors.pop(device_ip, None)
+    if collector:
+        await collector.stop()
+
+def event_filter(device_ips: Optional[str] = None, types: Optional[str] = None) -> tuple:
+    """
+    Convertir los filtros de suscripción (listas separadas por coma) en
+    (conjunto de IPs, conjunto de tipos); None significa "todos". Lanza
+    ValueError si algún tipo no existe.
+    """
+    ips = {ip.strip() for ip in device_ips.split(",") if ip.strip()} if device_ips else None
+    kinds = {t.strip() for t in types.split(",") if t.strip()} if types else None
+    unknown = sorted((kinds or set()) - set(EVENT_TYPES))
+    if unknown:
+        raise ValueError(f"Tipos de evento desconocidos: {', '.join(unknown)} (válidos: {', '.join(EVENT_TYPES)})")
+    return ips, kinds
+
+def event_matches(event: dict, ips: Optional[set], kinds: Optional[set]) -> bool:
+    return (ips is None or event["device"] in ips) and (kinds is None or event["type"] in kinds)
+
+async def post_json(url: str, payload, timeout: float = WEBHOOK_TIMEOUT) -> int:
+    """
+    Enviar un JSON por POST con HTTP/1.1 sobre asyncio, sin dependencias
+    adicionales ni hilos del pool ADB. Retorna el código de estado.
+    """
+    parts = urlsplit(url)
+    secure = parts.scheme == "https"
+    path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+    body = json.dumps(payload).encode()
+    
+    async def request():
+        reader, writer = await asyncio.open_connection(
+            parts.hostname, parts.port or (443 if secure else 80), ssl=True if secure else None
+        )
+        try:
+            writer.write(
+                f"POST {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\nUser-Agent: adb-control-api\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+            status_line = await reader.readline()
+            return int(status_line.split()[1])
+        finally:
+            writer.close()
+    
+    return await asyncio.wait_for(request(), timeout)
+
+class Webhook:
+    """
+    Destino HTTP de eventos. Los eventos se encolan (con la cola llena se
+    descartan los más viejos) y una tarea los envía en lotes como
+    {"events": [...], "dropped": n}, reintentando con espera exponencial.
+    """
+    
+    def __init__(self, url: str, device_ips: Optional[str] = None, types: Optional[str] = None,
+                 webhook_id: Optional[str] = None, source: str = "api"):
+        self.id = webhook_id or uuid.uuid4().hex[:12]
+        self.url = url
+        self.device_ips, self.types = device_ips, types
+        self.source = source  # "api" (POST /webhooks) o "env" (WEBHOOK_URLS)
+        self.ips, self.kinds = event_filter(device_ips, types)
+        self.pending = deque(maxlen=WEBHOOK_QUEUE_EVENTS)
+        self.wake = asyncio.Event()
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        self.unreported_drops = 0
+        self.last_status = None
+        self.last_error = None
+        self.created_at = datetime.now().isoformat()
+        self.task = None
+    
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._run())
+    
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+    
+    def offer(self, event: dict):
+        if not event_matches(event, self.ips, self.kinds):
+            return
+        if len(self.pending) == self.pending.maxlen:
+            self.dropped += 1
+            self.unreported_drops += 1
+        self.pending.append(event)
+        self.wake.set()
+    
+    async def _run(self):
+        while True:
+            await self.wake.wait()
+            # Esperar un poco para juntar en un solo POST los eventos cercanos
+            await asyncio.sleep(WEBHOOK_BATCH_DELAY)
+            while self.pending:
+                batch = [self.pending.popleft() for _ in range(min(WEBHOOK_BATCH_SIZE, len(self.pending)))]
+                payload = {"events": batch, "dropped": self.unreported_drops}
+                self.unreported_drops = 0
+                await self._deliver(payload)
+            self.wake.clear()
+    
+    async def _deliver(self, payload: dict):
+        for attempt in range(WEBHOOK_MAX_RETRIES + 1):
+            try:
+                self.last_status = await post_json(self.url, payload)
+                if 200 <= self.last_status < 300:
+                    self.delivered += len(payload["events"])
+                    self.last_error = None
+                    return
+                self.last_error = f"HTTP {self.last_status}"
+            except Exception as e:
+                self.last_error = str(e) or type(e).__name__
+            if attempt < WEBHOOK_MAX_RETRIES:
+                await asyncio.sleep(min(WEBHOOK_RETRY_BASE * 2 ** attempt, WEBHOOK_RETRY_MAX))
+        self.failed += len(payload["events"])
+        logger.warning(f"Webhook {self.url}: se descartan {len(payload['events'])} eventos ({self.last_error})")
+    
+    def stats(self) -> dict:
+        return {
+            "id": self.id,
+            "url": self.url,
+            "source": self.source,
+            "device_ips": sorted(self.ips) if self.ips else None,
+            "types": sorted(self.kinds) if self.kinds else None,
+            "pending": len(self.pending),
+            "delivered": self.delivered,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "last_status": self.last_status,
+            "last_error": self.last_error,
+            "created_at": self.created_at,
+        }
+
+class EventBus:
+    """
+    Bus de eventos de estado de los dispositivos (conexión, app en primer
+    plano, pantalla, volumen, batería). Solo se publica cuando un estado
+    cambia; el último evento de cada (dispositivo, tipo) queda como foto del
+    estado actual y los recientes en un historial para retomar por seq.
+    """
+    
+    def __init__(self):
+        self.last_seq = 0
+        self.history = deque(maxlen=EVENT_HISTORY)
+        self.states = {}  # (ip, tipo): último evento
+        self.subscribers = {}  # cola: (ips, tipos)
+        self.webhooks = {}
+    
+    def update(self, device_ip: str, kind: str, data: dict):
+        """Publicar un estado si es distinto del último conocido"""
+        last = self.states.get((device_ip, kind))
+        if last is None or last["data"] != data:
+            self.publish(device_ip, kind, data)
+    
+    def publish(self, device_ip: str, kind: str, data: dict) -> dict:
+        self.last_seq += 1
+        event = {
+            "seq": self.last_seq,
+            "type": kind,
+            "device": device_ip,
+            "data": data,
+            "timestamp": datetime.now().isoformat()
+        }
+        self.states[(device_ip, kind)] = event
+        self.history.append(event)
+        for queue, (ips, kinds) in self.subscribers.items():
+            if event_matches(event, ips, kinds):
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(event)
+        for webhook in self.webhooks.values():
+            webhook.offer(event)
+        return event
+    
+    def snapshot(self, ips: Optional[set] = None, kinds: Optional[set] = None) -> list:
+        """Último evento de cada estado que cumple el filtro, en orden de seq"""
+        return sorted(
+            (e for e in self.states.values() if event_matches(e, ips, kinds)),
+            key=lambda e: e["seq"]
+        )
+    
+    def wants(self, device_ip: str) -> bool:
+        """Si algún suscriptor o webhook recibe eventos de este dispositivo"""
+        filters = list(self.subscribers.values()) + [(w.ips, w.kinds) for w in self.webhooks.values()]
+        return any(ips is None or device_ip in ips for ips, _ in filters)
+    
+    async def subscribe(self, ips: Optional[set] = None, kinds: Optional[set] = None,
+                        since_seq: Optional[int] = None, keepalive: Optional[float] = None):
+        """
+        Generar eventos: primero los del historial posteriores a since_seq (o
+        la foto del estado actual si no se indica) y luego los nuevos. Con
+        keepalive genera None tras esos segundos sin eventos.
+        """
+        queue = asyncio.Queue(EVENT_QUEUE_EVENTS)
+        self.subscribers[queue] = (ips, kinds)
+        try:
+            if since_seq is None:
+                backlog = self.snapshot(ips, kinds)
+            else:
+                backlog = [e for e in self.history if e["seq"] > since_seq and event_matches(e, ips, kinds)]
+            last_seq = self.last_seq if since_seq is None else since_seq
+            for event in backlog:
+                yield event
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if event["seq"] > last_seq:
+                    last_seq = event["seq"]
+                    yield event
+        finally:
+            self.subscribers.pop(queue, None)
+
+event_bus = EventBus()
+
+def watch_devices(ips: Optional[set] = None):
+    """
+    Iniciar los vigilantes de los dispositivos conectados que tienen
+    suscriptores, para que los cambios de app, pantalla y batería lleguen
+    como eventos sin que nadie consulte el estado.
+    """
+    if not FOREGROUND_WATCHER:
+        return
+    for device_ip in list(devices):
+        if ips is None or device_ip in ips:
+            foreground_watcher(device_ip)
+
+def start_webhook(webhook: Webhook) -> Webhook:
+    """Registrar un webhook en el bus e iniciar su envío y los vigilantes de sus dispositivos"""
+    event_bus.webhooks[webhook.id] = webhook
+    webhook.start()
+    watch_devices(webhook.ips)
+    logger.info(f"Webhook de eventos registrado: {webhook.url}")
+    return webhook
+
+def publish_volume(device_ip: str, streams: dict):
+    """Publicar el volumen del stream de música si cambió"""
+    music = streams.get("music")
+    if music:
+        event_bus.update(device_ip, "volume", {"level": music.level, "max": music.max, "muted": music.muted})
+
+class ConnectionSupervisor:
+    """
+    Supervisor de conexiones en segundo plano. Cada KEEPALIVE_TICK revisa
+    qué dispositivos registrados toca atender: a los conectados sin tráfico
+    en KEEPALIVE_INTERVAL les envía un sondeo keepalive, y a los caídos los
+    reconecta con espera exponencial y jitter. Así una TV que se cayó se
+    reconecta antes de la próxima petición y /status, /devices responden
+    con la salud en caché.
+    """
+    
+    def __init__(self):
+        self.task = None
+        self.checks = {}  # ip: tarea en curso
+    
+    def start(self):
+        if KEEPALIVE_INTERVAL > 0 and (self.task is None or self.task.done()):
+            self.task = asyncio.ensure_future(self._run())
+    
+    async def stop(self):
+        tasks = [t for t in [self.task, *self.checks.values()] if t]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.task = None
+        self.checks.clear()
+    
+    async def _run(self):
+        while True:
+            for device in list(devices.values()):
+                self.schedule(device)
+            await asyncio.sleep(KEEPALIVE_TICK)
+    
+    def schedule(self, device: DeviceConnection):
+        """
+        Revisar un dispositivo en segundo plano si le toca (respetando la
+        espera entre reintentos) y no hay ya una revisión en curso. Lo usa el
+        bucle del supervisor y /devices para los dispositivos caídos.
+        """
+        if device.ip not in self.checks and device.health.next_check <= time.monotonic():
+            task = asyncio.ensure_future(self.check(device))
+            self.checks[device.ip] = task
+            task.add_done_callback(lambda _, ip=device.ip: self.checks.pop(ip, None))
+    
+    async def check(self, device: DeviceConnection):
+        """Sondear o reconectar un dispositivo y programar su próxima revisión"""
+        health = device.health
+        now = time.monotonic()
+        if device.connected:
+            # Un comando reciente ya prueba que la conexión está viva
+            if now - health.last_seen_at < KEEPALIVE_INTERVAL:
+                health.next_check = health.last_seen_at + KEEPALIVE_INTERVAL
+                return
+            if device.queue_depth:
+                health.next_check = now + KEEPALIVE_INTERVAL
+                return
+            result = await device.probe()
+            if result["status"] == "success":
+                health.next_check = time.monotonic() + KEEPALIVE_INTERVAL
+                return
+        
+        if devices.get(device.ip) is not device:
+            return
+        if await self.reconnect(device):
+            health.next_check = time.monotonic() + KEEPALIVE_INTERVAL
+        else:
+            delay = health.backoff()
+            health.next_check = time.monotonic() + delay
+            logger.info(f"Supervisor: {device.ip} sin conexión ({health.failures} fallos), reintento en {delay:.1f}s")
+    
+    async def reconnect(self, device: DeviceConnection) -> bool:
+        """Reconectar un dispositivo registrado si sigue caído; retorna si quedó conectado"""
+        async with registry_lock(device.ip):
+            if devices.get(device.ip) is not device:
+                return False
+            if not device.connected:
+                await device.connect()
+                if device.connected:
+                    device.health.reconnects += 1
+                    logger.info(f"Supervisor: {device.ip} reconectado")
+        return device.connected
+
+connection_supervisor = ConnectionSupervisor()
+
+def ring_hash(key: str) -> int:
+    """Posición de una clave en el anillo de hash consistente"""
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+class ClusterNode:
+    """
+    Este proceso como nodo del cluster. Los nodos se registran con un
+    heartbeat en una base SQLite compartida; el dueño de cada dispositivo
+    sale de un anillo de hash consistente sobre los nodos vivos, así que al
+    entrar o caer un nodo solo cambian de dueño sus dispositivos. Antes de
+    conectar, el dueño toma un lease del dispositivo en la misma base: si
+    otro nodo todavía lo tiene (traspaso en curso) no se abre una segunda
+    conexión ADB hasta que lo libere o venza (CLUSTER_NODE_TTL). Los leases
+    vencidos de un nodo caído los adopta su nuevo dueño, que reconecta el
+    dispositivo con el puerto guardado.
+    """
+    
+    def __init__(self, db_path: str, url: str, node_id: Optional[str] = None):
+        self.db_path = db_path
+        self.url = url.rstrip("/")
+        self.node_id = node_id or self.url
+        self.nodes = {self.node_id: self.url}
+        self.ring_keys = []
+        self.ring_ids = []
+        self.task = None
+        self.adopting = {}
+    
+    def _db(self):
+        conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA busy_timeout = 10000")
+        return closing(conn)
+    
+    def _init_db(self):
+        with self._db() as conn:
+            # Journal clásico y no WAL: WAL necesita memoria compartida en un
+            # mismo host y no funciona con la base en un sistema de archivos
+            # de red (varios nodos). Con pocas escrituras no hace falta.
+            conn.execute("PRAGMA journal_mode = DELETE")
+            conn.execute("CREATE TABLE IF NOT EXISTS nodes (node_id TEXT PRIMARY KEY, url TEXT, heartbeat REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (device_ip TEXT PRIMARY KEY, node_id TEXT, port INTEGER, expires REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS tags (device_ip TEXT PRIMARY KEY, tags TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS webhooks (webhook_id TEXT PRIMARY KEY, url TEXT, device_ips TEXT, types TEXT)")
+    
+    def _heartbeat(self) -> dict:
+        """Registrar este nodo, olvidar los que dejaron de latir y retornar los vivos {id: url}"""
+        now = time.time()
+        with self._db() as conn:
+            conn.execute("INSERT OR REPLACE INTO nodes (node_id, url, heartbeat) VALUES (?, ?, ?)",
+                         (self.node_id, self.url, now))
+            conn.execute("DELETE FROM nodes WHERE heartbeat < ?", (now - CLUSTER_NODE_TTL,))
+            return dict(conn.execute("SELECT node_id, url FROM nodes").fetchall())
+    
+    def _claim(self, ports: dict) -> tuple:
+        """
+        Tomar o renovar el lease de cada dispositivo ({IP: puerto}) si está
+        libre, vencido o ya es nuestro. Retorna (IPs con lease propio,
+        {IP: nodo que lo tiene}).
+        """
+        now = time.time()
+        held, holders = set(), {}
+        with self._db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for ip, port in ports.items():
+                row = conn.execute("SELECT node_id, expires FROM leases WHERE device_ip = ?", (ip,)).fetchone()
+                if row is None or row[0] == self.node_id or row[1] < now:
+                    conn.execute("INSERT OR REPLACE INTO leases (device_ip, node_id, port, expires) VALUES (?, ?, ?, ?)",
+                                 (ip, self.node_id, port, now + CLUSTER_NODE_TTL))
+                    held.add(ip)
+                else:
+                    holders[ip] = row[0]
+            conn.execute("COMMIT")
+        return held, holders
+    
+    def _release(self, ip: Optional[str] = None):
+        """
+        Liberar el lease de un dispositivo desconectado, o al salir (ip=None)
+        vencer los de este nodo para que sus nuevos dueños los adopten ya.
+        """
+        with self._db() as conn:
+            if ip is None:
+                conn.execute("UPDATE leases SET expires = 0 WHERE node_id = ?", (self.node_id,))
+                conn.execute("DELETE FROM nodes WHERE node_id = ?", (self.node_id,))
+            else:
+                conn.execute("DELETE FROM leases WHERE device_ip = ? AND node_id = ?", (ip, self.node_id))
+    
+    def _load_tags(self) -> dict:
+        with self._db() as conn:
+            return {ip: set(tags.split(",")) for ip, tags in conn.execute("SELECT device_ip, tags FROM tags")}
+    
+    def _save_tags(self, tags: dict, replace: bool = True):
+        """Guardar etiquetas {IP: {etiquetas}} (vacías las borran); con replace=False no se pisan las guardadas"""
+        with self._db() as conn:
+            for ip, names in tags.items():
+                if not names:
+                    conn.execute("DELETE FROM tags WHERE device_ip = ?", (ip,))
+                else:
+                    conn.execute(f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO tags (device_ip, tags) VALUES (?, ?)",
+                                 (ip, ",".join(sorted(names))))
+    
+    def _load_webhooks(self) -> dict:
+        with self._db() as conn:
+            return {row[0]: row[1:] for row in conn.execute("SELECT webhook_id, url, device_ips, types FROM webhooks")}
+    
+    def _save_webhook(self, webhook: "Webhook"):
+        with self._db() as conn:
+            conn.execute("INSERT OR REPLACE INTO webhooks (webhook_id, url, device_ips, types) VALUES (?, ?, ?, ?)",
+                         (webhook.id, webhook.url, webhook.device_ips, webhook.types))
+    
+    def _delete_webhook(self, webhook_id: str):
+        with self._db() as conn:
+            conn.execute("DELETE FROM webhooks WHERE webhook_id = ?", (webhook_id,))
+    
+    def _orphans(self) -> dict:
+        """Dispositivos {IP: puerto} con el lease vencido (su nodo cayó o salió del cluster)"""
+        with self._db() as conn:
+            return dict(conn.execute("SELECT device_ip, port FROM leases WHERE expires < ?", (time.time(),)).fetchall())
+    
+    def set_nodes(self, nodes: dict):
+        """Reconstruir el anillo con los nodos vivos (este siempre incluido)"""
+        self.nodes = {**nodes, self.node_id: self.url}
+        ring = sorted((ring_hash(f"{node_id}#{i}"), node_id) for node_id in self.nodes for i in range(CLUSTER_VNODES))
+        self.ring_keys = [key for key, _ in ring]
+        self.ring_ids = [node_id for _, node_id in ring]
+    
+    def owner(self, ip: str) -> tuple:
+        """(id, url) del nodo dueño de un dispositivo según el anillo"""
+        if not self.ring_keys:
+            return self.node_id, self.url
+        node_id = self.ring_ids[bisect.bisect(self.ring_keys, ring_hash(ip)) % len(self.ring_ids)]
+        return node_id, self.nodes[node_id]
+    
+    def is_owner(self, ip: str) -> bool:
+        return self.owner(ip)[0] == self.node_id
+    
+    async def claim(self, ip: str, port: int):
+        """
+        Tomar un dispositivo antes de conectarlo. Lanza HTTPException 421 si
+        pertenece a otro nodo y 503 si el dueño anterior aún no lo liberó.
+        """
+        node_id, url = self.owner(ip)
+        if node_id != self.node_id:
+            raise HTTPException(status_code=421, detail=f"El dispositivo {ip} pertenece al nodo {url}")
+        held, holders = await run_blocking(self._claim, {ip: port})
+        if ip not in held:
+            raise HTTPException(
+                status_code=503,
+                detail=f"El dispositivo {ip} sigue asignado al nodo {holders[ip]}: traspaso en curso, reintente en unos segundos"
+            )
+    
+    async def release(self, ip: str):
+        await run_blocking(self._release, ip)
+    
+    async def save_tags(self, tags: dict, replace: bool = True):
+        await run_blocking(self._save_tags, tags, replace)
+        await self.sync_tags()
+    
+    async def sync_tags(self):
+        """Traer las etiquetas compartidas al registro local (device_tags)"""
+        tags = await run_blocking(self._load_tags)
+        device_tags.clear()
+        device_tags.update(tags)
+    
+    async def save_webhook(self, webhook: "Webhook"):
+        await run_blocking(self._save_webhook, webhook)
+    
+    async def delete_webhook(self, webhook_id: str):
+        await run_blocking(self._delete_webhook, webhook_id)
+    
+    async def sync_webhooks(self):
+        """
+        Iniciar los webhooks compartidos que falten en este nodo y detener
+        los eliminados. Cada nodo entrega los eventos de sus dispositivos,
+        así cada evento se envía una sola vez en todo el cluster.
+        """
+        shared = await run_blocking(self._load_webhooks)
+        for webhook_id, (url, device_ips, types) in shared.items():
+            if webhook_id not in event_bus.webhooks:
+                start_webhook(Webhook(url, device_ips, types, webhook_id))
+        for webhook_id, webhook in list(event_bus.webhooks.items()):
+            if webhook.source == "api" and webhook_id not in shared:
+                del event_bus.webhooks[webhook_id]
+                await webhook.stop()
+    
+    async def start(self):
+        await run_blocking(self._init_db)
+        await self.heartbeat()
+        self.task = asyncio.ensure_future(self._run())
+        logger.info(f"Cluster: nodo {self.node_id} con {len(self.nodes)} nodo(s) vivo(s) en {self.db_path}")
+    
+    async def stop(self):
+        """Dejar el cluster: los dispositivos pasan a los demás nodos sin esperar a que venzan los leases"""
+        tasks = [task for task in [self.task, *self.adopting.values()] if task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.task = None
+        await run_blocking(self._release)
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(CLUSTER_HEARTBEAT)
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                logger.warning(f"Cluster: error en el heartbeat de {self.node_id}: {str(e)}")
     
-    return True
+    async def heartbeat(self):
+        """
+        Latir, actualizar el anillo, soltar los dispositivos que pasaron a
+        otro nodo y renovar los leases de los propios. Un dispositivo cuyo
+        lease tomó otro nodo (p. ej. tras un heartbeat atrasado) también se
+        suelta, para no quedar con dos conexiones al mismo TV. Por último se
+        adoptan en segundo plano los dispositivos huérfanos que ahora son
+        de este nodo. También se traen las etiquetas y los webhooks
+        compartidos.
+        """
+        self.set_nodes(await run_blocking(self._heartbeat))
+        kept = {ip: device.port for ip, device in devices.items() if self.is_owner(ip)}
+        held, _ = await run_blocking(self._claim, kept) if kept else (set(), {})
+        for ip in list(devices):
+            if ip not in held:
+                logger.info(f"Cluster: {ip} pasa al nodo {self.owner(ip)[1]}, liberando la conexión")
+                async with registry_lock(ip):
+                    if ip in devices:
+                        await unregister_device(ip)
+        for ip, port in (await run_blocking(self._orphans)).items():
+            if self.is_owner(ip) and ip not in devices and ip not in self.adopting:
+                task = asyncio.ensure_future(self.adopt(ip, port))
+                self.adopting[ip] = task
+                task.add_done_callback(lambda _, ip=ip: self.adopting.pop(ip, None))
+        await self.sync_tags()
+        await self.sync_webhooks()
+    
+    async def adopt(self, ip: str, port: int):
+        """
+        Hacerse cargo de un dispositivo de un nodo caído. Si no responde queda
+        registrado como caído, con su lease (lo renueva el heartbeat, así no
+        lo adopta otro nodo), y el supervisor lo sigue reintentando.
+        """
+        async with registry_lock(ip):
+            if ip in devices:
+                return
+            try:
+                result = await register_device(ip, port, keep_lease=True)
+            except HTTPException as e:
+                logger.info(f"Cluster: no se adopta {ip}: {e.detail}")
+                return
+            if result["status"] == "success":
+                logger.info(f"Cluster: {ip}:{port} adoptado por el nodo {self.node_id}")
+            else:
+                logger.warning(f"Cluster: {ip}:{port} adoptado sin conexión: {result.get('message')}")
+                devices[ip] = DeviceConnection(ip, port)
+                connection_supervisor.schedule(devices[ip])
 
-def ensure_device_connection(func):
+async def forward_http(base_url: str, method: str, target: str, headers: list, body: bytes) -> tuple:
     """
-    Decorador que asegura que el dispositivo esté conectado.
-    Si no está conectado, intenta conectar automáticamente.
-    
-    El parámetro device_ip debe estar presente en los argumentos de la función.
+    Reenviar una petición HTTP a otro nodo, sobre asyncio y sin dependencias.
+    Se usa HTTP/1.0 para que la respuesta termine con el cierre de la
+    conexión, también en streams (SSE, MJPEG, NDJSON). Retorna (código,
+    cabeceras, generador de bloques del cuerpo).
     """
-    @wraps(func)
-    async def wrapper(*args, **kwargs):
-        device_ip = kwargs.get('device_ip') or (args[0] if args else None)
-        port = kwargs.get('port', 5555)
-        
-        # Validar device_ip
-        validate_device_ip(device_ip)
+    parts = urlsplit(base_url)
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(parts.hostname, parts.port or 80), CLUSTER_FORWARD_TIMEOUT
+    )
+    try:
+        skip = {b"host", b"content-length", b"connection", b"keep-alive", b"transfer-encoding",
+                CLUSTER_FORWARD_HEADER.encode()}
+        head = [f"{method} {target} HTTP/1.0".encode(), f"Host: {parts.netloc}".encode(),
+                f"Content-Length: {len(body)}".encode(), f"{CLUSTER_FORWARD_HEADER}: {cluster.node_id}".encode()]
+        head += [name + b": " + value for name, value in headers if name.lower() not in skip]
+        writer.write(b"\r\n".join(head) + b"\r\n\r\n" + body)
+        await writer.drain()
         
-        # Verificar si el dispositivo existe en el diccionario
-        if device_ip not in devices:
-            logger.info(f"Dispositivo {device_ip} no encontrado en conexiones, conectando automáticamente...")
-            # Intentar conectar automáticamente
-            result = await connect_device(device_ip, port)
-            if result.get("status") == "error":
-                raise HTTPException(status_code=400, detail=f"No se pudo conectar al dispositivo: {result.get('message')}")
-        
-        # Si el dispositivo existe pero no está conectado, reconectar
-        if not devices[device_ip].connected:
-            logger.info(f"Dispositivo {device_ip} desconectado, reconectando...")
-            reconnect_result = devices[device_ip].connect()
-            if reconnect_result["status"] == "error":
-                raise HTTPException(status_code=400, detail=f"No se pudo reconectar al dispositivo: {reconnect_result.get('message')}")
+        async def read_head():
+            status_line = await reader.readline()
+            response_headers = []
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.partition(b":")
+                response_headers.append((name.strip().lower(), value.strip()))
+            return int(status_line.split()[1]), response_headers
         
-        # Llamar a la función original
-        return await func(*args, **kwargs)
+        status, response_headers = await asyncio.wait_for(read_head(), CLUSTER_FORWARD_TIMEOUT)
+    except BaseException:
+        writer.close()
+        raise
     
-    return wrapper
+    async def chunks():
+        try:
+            while chunk := await reader.read(65536):
+                yield chunk
+        finally:
+            writer.close()
+    
+    return status, response_headers, chunks()
 
-def generate_adb_keys():
-    """Generar claves RSA para ADB si no existen"""
-    try:
-        # Directorio para almacenar claves
-        keys_dir = Path("/app/.android")
-        keys_dir.mkdir(parents=True, exist_ok=True)
-        
-        adbkey_path = keys_dir / "adbkey"
-        
-        # Si las claves no existen, generarlas
-        if not adbkey_path.exists():
-            logger.info(f"Generando nuevas claves RSA en {adbkey_path}")
-            try:
-                from adb_shell.auth.keygen import keygen
-                keygen(str(adbkey_path))
-                logger.info("Claves RSA generadas exitosamente")
-            except Exception as e:
-                logger.error(f"Error al generar claves: {str(e)}")
-                import traceback
-                logger.error(traceback.format_exc())
-                return []
+async def cluster_call(base_url: str, method: str, path: str, params: dict):
+    """Llamar a un endpoint JSON de otro nodo; los errores HTTP se relanzan como HTTPException"""
+    query = urlencode({k: str(v).lower() if isinstance(v, bool) else v for k, v in params.items() if v is not None})
+    status, _, chunks = await forward_http(base_url, method, f"{path}?{query}", [], b"")
+    body = b"".join([chunk async for chunk in chunks])
+    data = json.loads(body) if body else None
+    if status >= 400:
+        raise HTTPException(status_code=status, detail=(data or {}).get("detail", f"Error {status} en {base_url}"))
+    return data
+
+async def cluster_gather(method: str, path: str, params: dict, timeout: float = CLUSTER_FORWARD_TIMEOUT) -> tuple:
+    """
+    Llamar al mismo endpoint en los demás nodos vivos, en paralelo. Retorna
+    (respuestas, [{"node", "error"} de los nodos que no respondieron]).
+    """
+    others = [url for node_id, url in cluster.nodes.items() if node_id != cluster.node_id]
+    results = await asyncio.gather(*(
+        asyncio.wait_for(cluster_call(url, method, path, params), timeout) for url in others
+    ), return_exceptions=True)
+    responses, unreachable = [], []
+    for url, result in zip(others, results):
+        if isinstance(result, BaseException):
+            error = result.detail if isinstance(result, HTTPException) else str(result)
+            unreachable.append({"node": url, "error": error or type(result).__name__})
         else:
-            logger.info(f"Claves ADB encontradas en {adbkey_path}")
-        
-        # Cargar las claves
-        try:
-            from adb_shell.auth.sign_pythonrsa import PythonRSASigner
-            signer = PythonRSASigner.FromRSAKeyPath(str(adbkey_path))
-            logger.info("Claves ADB cargadas exitosamente")
-            return [signer]
-        except Exception as e:
-            logger.error(f"Error al cargar claves: {str(e)}")
-            import traceback
-            logger.error(traceback.format_exc())
-            return []
-    except Exception as e:
-        logger.error(f"Error al generar/cargar claves ADB: {str(e)}")
-        import traceback
-        logger.error(traceback.format_exc())
-        return []
+            responses.append(result)
+    return responses, unreachable
 
-class DeviceConnection:
-    def __init__(self, ip: str, port: int = 5555):
-        self.ip = ip
-        self.port = port
-        self.device = None
-        self.connected = False
-        self.rsa_keys = None  # Se cargarán al conectar
-    
-    def _ensure_keys_loaded(self):
-        """Cargar o generar claves si es necesario"""
-        if self.rsa_keys is not None:
-            logger.info(f"Claves ya cargadas: {len(self.rsa_keys)} clave(s)")
-            return  # Ya están cargadas
-        
-        logger.info("Cargando/generando claves...")
-        self.rsa_keys = generate_adb_keys()
-        logger.info(f"Claves cargadas: {len(self.rsa_keys)} clave(s) disponibles")
+def cluster_request_owner(scope) -> Optional[tuple]:
+    """
+    Nodo dueño (id, url) al que hay que reenviar una petición HTTP, o None
+    si se atiende acá: sin cluster, ya reenviada, sin un único dispositivo
+    (device_ip, o ip en /devices/connect) o con un dispositivo propio. Las
+    operaciones de flota reparten sus dispositivos ellas mismas.
+    """
+    if cluster is None or scope["type"] != "http" or scope["path"].startswith("/fleet/"):
+        return None
+    if any(name == CLUSTER_FORWARD_HEADER.encode() for name, _ in scope["headers"]):
+        return None
+    params = parse_qs(scope["query_string"].decode("latin-1"))
+    ips = params.get("device_ip") or (params.get("ip") if scope["path"] == "/devices/connect" else None)
+    if not ips or len(ips) != 1 or "," in ips[0]:
+        return None
+    node_id, url = cluster.owner(ips[0].strip())
+    return None if node_id == cluster.node_id else (node_id, url)
+
+class ClusterRouter:
+    """
+    Middleware ASGI del modo cluster: las peticiones HTTP de un dispositivo
+    de otro nodo se reenvían a su dueño y la respuesta (también en stream)
+    se devuelve tal cual. El resto pasa directo a la aplicación. Los
+    WebSocket no se reenvían: en un nodo que no es el dueño se rechazan
+    con el motivo y la URL del dueño.
+    """
     
-    def connect(self) -> dict:
-        """Conectar al dispositivo"""
-        try:
-            # Asegurar que las claves estén cargadas/generadas
-            self._ensure_keys_loaded()
-            
-            logger.info(f"Intentando conectar a {self.ip}:{self.port}")
-            # Crear dispositivo
-            self.device = AdbDeviceTcp(self.ip, self.port)
-            # Conectar
-            self.device.connect(rsa_keys=self.rsa_keys)
-            self.connected = True
-            logger.info(f"Conectado exitosamente a {self.ip}:{self.port}")
-            return {"status": "success", "message": f"Conectado a {self.ip}:{self.port}"}
-        except Exception as e:
-            self.connected = False
-            logger.error(f"Error al conectar: {str(e)}")
-            return {"status": "error", "message": str(e)}
+    def __init__(self, app):
+        self.app = app
     
-    def disconnect(self):
-        """Desconectar del dispositivo"""
+    async def __call__(self, scope, receive, send):
+        owner = cluster_request_owner(scope)
+        if owner is None:
+            return await self.app(scope, receive, send)
+        node_id, url = owner
+        
+        body, more = b"", True
+        while more:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            more = message.get("more_body", False)
+        target = scope.get("raw_path", scope["path"].encode()).decode("latin-1")
+        if scope["query_string"]:
+            target += "?" + scope["query_string"].decode("latin-1")
+        
         try:
-            if self.device:
-                self.device.close()
-            self.connected = False
-            logger.info(f"Desconectado de {self.ip}:{self.port}")
-            return {"status": "success", "message": "Desconectado"}
-        except Exception as e:
-            logger.error(f"Error al desconectar: {str(e)}")
-            return {"status": "error", "message": str(e)}
-    
-    def execute_command(self, cmd: str) -> dict:
-        """Ejecutar comando ADB"""
-        if not self.connected:
-            logger.info(f"Dispositivo no conectado, intentando reconectar")
-            connect_result = self.connect()
-            if connect_result["status"] == "error":
-                return connect_result
+            status, headers, chunks = await forward_http(url, scope["method"], target, scope["headers"], body)
+        except (OSError, asyncio.TimeoutError, ValueError, IndexError) as e:
+            logger.warning(f"Cluster: no se pudo reenviar {scope['path']} al nodo {url}: {str(e)}")
+            response = JSONResponse(status_code=503, content={"detail": f"No se pudo reenviar al nodo {url}: {str(e)}"})
+            return await response(scope, receive, send)
         
+        hop_by_hop = {b"connection", b"keep-alive", b"transfer-encoding", b"date", b"server"}
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(k, v) for k, v in headers if k not in hop_by_hop] + [(b"x-adb-api-node", node_id.encode())]
+        })
+        
+        async def pump():
+            async for chunk in chunks:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        
+        async def disconnected():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+        
+        # Si el cliente se va se deja de leer del dueño (cierra su stream)
+        tasks = [asyncio.ensure_future(pump()), asyncio.ensure_future(disconnected())]
         try:
-            logger.info(f"Ejecutando comando en {self.ip}: {cmd}")
-            result = self.device.shell(cmd)
-            logger.info(f"Comando ejecutado exitosamente")
-            return {"status": "success", "output": result}
-        except Exception as e:
-            self.connected = False
-            logger.error(f"Error al ejecutar comando: {str(e)}")
-            return {"status": "error", "message": str(e)}
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await chunks.aclose()
+        if tasks[0] in done:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+app.add_middleware(ClusterRouter)
+
+def parse_device_tags(spec: str) -> dict:
+    """
+    Convertir "sala=ip1,ip2;cocina=ip3" en {ip: {etiquetas}}. Las entradas
+    sin "=" se ignoran con un aviso en el log.
+    """
+    tags = {}
+    for entry in spec.split(";"):
+        if not entry.strip():
+            continue
+        name, sep, ips = entry.partition("=")
+        if not sep or not name.strip():
+            logger.warning(f"DEVICE_TAGS: entrada ignorada '{entry.strip()}' (formato etiqueta=ip1,ip2)")
+            continue
+        for ip in ips.split(","):
+            if ip.strip():
+                tags.setdefault(ip.strip(), set()).add(name.strip())
+    return tags
+
+def resolve_fleet_targets(device_ip: Optional[str], tag: Optional[str]) -> list:
+    """
+    Dispositivos de una operación de flota: las IPs indicadas más las que
+    tengan alguna de las etiquetas (listas separadas por coma), sin repetir
+    y en orden. Lanza HTTPException 400 si la selección queda vacía.
+    """
+    targets = [ip.strip() for ip in device_ip.split(",") if ip.strip()] if device_ip else []
+    for ip in targets:
+        if not validate_ip_address(ip):
+            raise HTTPException(status_code=400, detail=f"device_ip '{ip}' no es una dirección IP o hostname válido")
+    names = {t.strip() for t in tag.split(",") if t.strip()} if tag else set()
+    known = set().union(*device_tags.values()) if device_tags else set()
+    unknown = sorted(names - known)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Etiquetas sin dispositivos: {', '.join(unknown)}")
+    targets += sorted(ip for ip, ip_tags in device_tags.items() if ip_tags & names)
+    targets = list(dict.fromkeys(targets))
+    if not targets:
+        raise HTTPException(status_code=400, detail="Indique device_ip (IPs separadas por coma) o tag")
+    return targets
+
+async def fleet_results(ips: list, operation, parallelism: int):
+    """
+    Ejecutar `operation(ip)` en todos los dispositivos, como mucho
+    `parallelism` a la vez, y producir ("result", registro) a medida que cada
+    uno termina y al final ("summary", totales). Si el cliente se desconecta
+    se cancelan los dispositivos pendientes.
+    """
+    semaphore = asyncio.Semaphore(parallelism)
+    started = time.monotonic()
+
+    async def run(ip):
+        async with semaphore:
+            start = time.monotonic()
+            record = {"type": "result", "device": ip}
+            try:
+                record.update(status="success", status_code=200, result=await operation(ip))
+            except HTTPException as e:
+                record.update(status="error", status_code=e.status_code, error=e.detail)
+            except Exception as e:
+                record.update(status="error", status_code=503, error=str(e))
+            record["elapsed_ms"] = round((time.monotonic() - start) * 1000, 1)
+            return record
+
+    tasks = [asyncio.create_task(run(ip)) for ip in ips]
+    counts = {"success": 0, "error": 0}
+    try:
+        for finished in asyncio.as_completed(tasks):
+            record = await finished
+            counts[record["status"]] += 1
+            yield "result", record
+    finally:
+        for task in tasks:
+            task.cancel()
+    yield "summary", {
+        "type": "summary",
+        "total": len(ips),
+        "success": counts["success"],
+        "error": counts["error"],
+        "parallelism": parallelism,
+        "elapsed_ms": round((time.monotonic() - started) * 1000, 1)
+    }
+
+def fleet_operation(path: str, endpoint, **params):
+    """
+    Operación de flota sobre un dispositivo: el endpoint individual (con
+    ensure_device_connection) si el dispositivo es de este nodo, o el mismo
+    endpoint en su nodo dueño en modo cluster
+    """
+    async def operation(ip):
+        if cluster is not None and not cluster.is_owner(ip):
+            return await cluster_call(cluster.owner(ip)[1], "POST", path, {"device_ip": ip, **params})
+        return await endpoint(device_ip=ip, **params)
+    return operation
+
+async def fleet_response(device_ip: Optional[str], tag: Optional[str], parallelism: Optional[int],
+                         output_format: str, operation) -> StreamingResponse:
+    """
+    Respuesta de una operación de flota: una línea JSON por dispositivo
+    (NDJSON) o un evento SSE `result` por dispositivo, y un resumen final
+    """
+    if output_format not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail="format debe ser 'ndjson' o 'sse'")
+    if cluster is not None and tag:
+        await cluster.sync_tags()
+    ips = resolve_fleet_targets(device_ip, tag)
+    limit = min(parallelism or FLEET_MAX_PARALLEL, FLEET_MAX_PARALLEL)
+
+    async def body():
+        results = fleet_results(ips, operation, limit)
+        try:
+            async for kind, record in results:
+                data = json.dumps(record, default=str)
+                yield f"event: {kind}\ndata: {data}\n\n" if output_format == "sse" else data + "\n"
+        finally:
+            await results.aclose()
+
+    if output_format == "sse":
+        return StreamingResponse(body(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+    return StreamingResponse(body(), media_type="application/x-ndjson")
 
 # Inicializar claves al arrancar la aplicación
 @app.on_event("startup")
 async def startup_event():
-    """Generar/cargar claves RSA al iniciar la aplicación"""
+    """Crear el pool de hilos ADB, generar/cargar claves RSA e iniciar el supervisor, el nodo del cluster y los webhooks al iniciar la aplicación"""
+    adb_pool()
     logger.info("Inicializando claves RSA...")
-    keys = generate_adb_keys()
+    keys = await run_blocking(load_adb_keys)
     if keys:
         logger.info(f"Claves RSA disponibles: {len(keys)} clave(s) cargada(s)")
     else:
         logger.warning("No se pudieron cargar las claves RSA")
+    connection_supervisor.start()
+    if CLUSTER_DB:
+        global cluster
+        cluster = ClusterNode(CLUSTER_DB, CLUSTER_NODE_URL or f"http://{socket.gethostname()}:{os.getenv('PORT', 9123)}")
+        await cluster.start()
+        # Las etiquetas de DEVICE_TAGS no pisan las asignadas por la API
+        await cluster.save_tags(parse_device_tags(DEVICE_TAGS), replace=False)
+    else:
+        device_tags.update(parse_device_tags(DEVICE_TAGS))
+    for url in WEBHOOK_URLS:
+        # Mismo id en todos los nodos: /webhooks lo muestra una sola vez
+        start_webhook(Webhook(url, webhook_id=f"env-{hashlib.md5(url.encode()).hexdigest()[:8]}", source="env"))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Detener supervisor, transmisiones, colectores, vigilantes y webhooks, dejar el cluster y liberar el pool de hilos ADB"""
+    for stream in list(frame_streams.values()):
+        for viewer in list(stream.viewers):
+            stream.unsubscribe(viewer)
+    for device_ip in list(logcat_collectors):
+        await stop_logcat_collector(device_ip)
+    for device_ip in list(foreground_watchers):
+        await stop_foreground_watcher(device_ip)
+    for webhook in list(event_bus.webhooks.values()):
+        await webhook.stop()
+    await connection_supervisor.stop()
+    if cluster is not None:
+        await cluster.stop()
+    global adb_executor
+    if adb_executor is not None:
+        adb_executor.shutdown(wait=False, cancel_futures=True)
+        adb_executor = None
 
 # Endpoints
 
@@ -311,71 +3070,160 @@ async def connect_device(
         if not isinstance(port, int) or port < 1 or port > 65535:
             raise HTTPException(status_code=400, detail="port debe ser un número entre 1 y 65535")
         
-        if ip in devices:
-            if devices[ip].connected:
-                return {"status": "warning", "message": "Dispositivo ya conectado"}
-            devices[ip].disconnect()
-        
-        device = DeviceConnection(ip, port)
-        result = device.connect()
-        
-        if result["status"] == "success":
-            devices[ip] = device
-        
-        return result
+        async with registry_lock(ip):
+            return await register_device(ip, port)
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Error en /devices/connect: {str(e)}")
         return {"status": "error", "message": str(e)}
 
+async def register_device(ip: str, port: int = 5555, keep_lease: bool = False) -> dict:
+    """
+    Conectar un dispositivo y darlo de alta en el registro.
+    Debe llamarse con registry_lock(ip) tomado. En modo cluster antes se
+    toma el dispositivo (HTTPException 421/503 si es de otro nodo); con
+    keep_lease el lease se conserva aunque no conecte (adopción).
+    """
+    if ip in devices:
+        if devices[ip].connected:
+            return {"status": "warning", "message": "Dispositivo ya conectado"}
+        await devices[ip].disconnect()
+    if cluster is not None:
+        await cluster.claim(ip, port)
+    
+    device = DeviceConnection(ip, port)
+    result = await device.connect()
+    
+    if result["status"] != "success" and cluster is not None and not keep_lease:
+        # Sin conexión no queda lease: si no, al vencer lo adoptaría otro nodo
+        await cluster.release(ip)
+    if result["status"] == "success":
+        devices[ip] = device
+        device.publish_connection()
+        if FOREGROUND_WATCHER and event_bus.wants(ip):
+            foreground_watcher(ip)
+        if LOGCAT_COLLECTOR and ip not in logcat_collectors:
+            logcat_collectors[ip] = LogcatCollector(ip)
+            logcat_collectors[ip].start()
+    
+    return result
+
+async def unregister_device(ip: str) -> dict:
+    """
+    Detener el colector y el vigilante, desconectar y dar de baja un
+    dispositivo (y en modo cluster liberar su lease).
+    """
+    await stop_logcat_collector(ip)
+    await stop_foreground_watcher(ip)
+    result = await devices[ip].disconnect()
+    devices.pop(ip, None)
+    if cluster is not None:
+        await cluster.release(ip)
+    return result
+
+def device_entry(ip: str, device: DeviceConnection) -> dict:
+    """Estado en caché de un dispositivo para /devices, sin tocar la red"""
+    if device.connected:
+        status = "connected"
+    elif KEEPALIVE_INTERVAL > 0 or ip in connection_supervisor.checks:
+        status = "reconnecting"
+    else:
+        status = "disconnected"
+    return {
+        "ip": ip,
+        "port": device.port,
+        "transport": device.transport,
+        "status": status,
+        "tags": sorted(device_tags.get(ip, ())),
+        "health": device.health.summary(),
+        "queue": device.queue_stats()
+    }
+
+async def refresh_device(device: DeviceConnection) -> dict:
+    """Reconectar si hace falta y sondear un dispositivo: resultado del sondeo con su RTT"""
+    if not device.connected:
+        await connection_supervisor.reconnect(device)
+    if not device.connected:
+        return {"status": "error", "message": device.health.last_error}
+    return await device.probe()
+
 @app.get(
     "/devices",
     tags=["Dispositivos"],
     summary="Listar dispositivos conectados",
     responses={200: {"description": "Lista de dispositivos conectados"}}
 )
-async def list_devices():
+async def list_devices(
+    refresh: bool = Query(False, description="Sondear todos los dispositivos en paralelo (RTT por dispositivo)"),
+    timeout: float = Query(DEVICES_REFRESH_TIMEOUT, gt=0, le=60, description="Plazo total del sondeo con refresh=true, en segundos"),
+    local: bool = Query(False, description="En modo cluster, solo los dispositivos de este nodo")
+):
     """
     Obtiene la lista de todos los dispositivos registrados y su estado de conexión.
     
+    Sin `refresh` responde al instante con el estado en caché: no espera a
+    ningún dispositivo. Los que están caídos se reconectan en segundo plano,
+    todos a la vez (con la espera entre reintentos del supervisor).
+    
+    Con `refresh=true` sondea todos los dispositivos en paralelo (reconectando
+    los caídos) con un plazo total de `timeout` segundos. Cada dispositivo
+    trae `probe` ("success", "error" o "timeout") y `rtt_ms` del sondeo; los
+    que no respondieron a tiempo siguen revisándose en segundo plano.
+    
     **Retorna:**
-    - **devices**: Lista de dispositivos con su estado
+    - **devices**: Lista de dispositivos con su estado, etiquetas, salud de
+      la conexión y cola de comandos (profundidad actual y tiempos de espera)
     - **count**: Cantidad total de dispositivos
     
+    En modo cluster se listan los dispositivos de todos los nodos (cada
+    entrada con su `node`), consultados en paralelo; `local=true` lista solo
+    los de este nodo.
+    
     **Estados posibles:**
     - connected: Dispositivo conectado y disponible
-    - disconnected: Dispositivo registrado pero desconectado
-    - reconnected: Dispositivo que fue desconectado y se reconectó
-    - error: Error al verificar el estado del dispositivo
+    - reconnecting: Dispositivo caído que se está reconectando en segundo plano
+    - disconnected: Dispositivo caído sin reconexión en curso
     """
-    device_list = []
-    for ip, device in devices.items():
-        try:
-            if device.connected:
-                device_list.append({
-                    "ip": ip,
-                    "port": device.port,
-                    "status": "connected"
-                })
+    if cluster is not None:
+        await cluster.sync_tags()
+    registered = list(devices.items())
+    probes = {}
+    if refresh:
+        tasks = {ip: asyncio.ensure_future(refresh_device(device)) for ip, device in registered}
+        if tasks:
+            await asyncio.wait(tasks.values(), timeout=timeout)
+        for ip, task in tasks.items():
+            if not task.done():
+                probes[ip] = {"probe": "timeout", "rtt_ms": None}
+            elif task.exception() is not None:
+                probes[ip] = {"probe": "error", "rtt_ms": None, "error": str(task.exception())}
             else:
-                # Intentar reconectar
-                device.connect()
-                device_list.append({
-                    "ip": ip,
-                    "port": device.port,
-                    "status": "reconnected" if device.connected else "disconnected"
-                })
-        except Exception as e:
-            logger.error(f"Error al listar dispositivos: {str(e)}")
-            device_list.append({
-                "ip": ip,
-                "port": device.port,
-                "status": "error",
-                "error": str(e)
-            })
+                result = task.result()
+                probes[ip] = {"probe": result["status"], "rtt_ms": result.get("rtt_ms")}
+                if result["status"] != "success":
+                    probes[ip]["error"] = result.get("message")
+    else:
+        for ip, device in registered:
+            if not device.connected:
+                connection_supervisor.schedule(device)
     
-    return {"devices": device_list, "count": len(device_list)}
+    device_list = [{**device_entry(ip, device), **probes.get(ip, {})} for ip, device in registered]
+    response = {"devices": device_list, "count": len(device_list), "refreshed": refresh}
+    if cluster is None:
+        return response
+    
+    for entry in device_list:
+        entry["node"] = cluster.node_id
+    if not local:
+        params = {"refresh": refresh, "timeout": timeout, "local": True}
+        results, response["unreachable_nodes"] = await cluster_gather(
+            "GET", "/devices", params, timeout + KEEPALIVE_TIMEOUT
+        )
+        for result in results:
+            device_list += result["devices"]
+        response["count"] = len(device_list)
+    return response
 
 @app.post(
     "/play",
@@ -417,8 +3265,7 @@ async def play_video(
             raise HTTPException(status_code=400, detail="video_url debe ser una URL válida de YouTube")
         
         device = devices[device_ip]
-        cmd = f'am start -a android.intent.action.VIEW -d "{video_url}"'
-        result = device.execute_command(cmd)
+        result = await device.execute_command(play_command(video_url))
         
         return {
             "device": device_ip,
@@ -454,7 +3301,7 @@ async def stop_video(
     try:
         device = devices[device_ip]
         cmd = "input keyevent KEYCODE_SPACE"
-        result = device.execute_command(cmd)
+        result = await device.execute_command(cmd)
         
         return {
             "device": device_ip,
@@ -489,7 +3336,7 @@ async def exit_app(
     try:
         device = devices[device_ip]
         cmd = "input keyevent KEYCODE_BACK"
-        result = device.execute_command(cmd)
+        result = await device.execute_command(cmd)
         
         return {
             "device": device_ip,
@@ -507,45 +3354,170 @@ async def exit_app(
     tags=["Información"],
     summary="Descargar captura de pantalla",
     responses={
-        200: {"description": "Captura de pantalla descargada", "content": {"image/png": {}}},
+        200: {"description": "Captura de pantalla descargada (o regiones cambiadas con changed_since)", "content": {"image/png": {}, "image/jpeg": {}, "image/webp": {}}},
+        304: {"description": "La pantalla no cambió desde el ETag de If-None-Match"},
+        400: {"description": "Formato no soportado"},
         503: {"description": "Error al ejecutar comando ADB"}
     }
 )
 @ensure_device_connection
 async def get_screenshot(
-    device_ip: str = Query(..., description="IP o hostname del dispositivo")
+    device_ip: str = Query(..., description="IP o hostname del dispositivo"),
+    format: Optional[str] = Query(None, description="png, jpeg o webp: captura en crudo y codifica en el servidor. Sin valor, PNG generado en el dispositivo"),
+    quality: int = Query(80, ge=1, le=100, description="Calidad para jpeg y webp"),
+    width: Optional[int] = Query(None, ge=1, description="Ancho máximo en píxeles (mantiene la proporción)"),
+    changed_since: Optional[str] = Query(None, description="ETag de una captura anterior: en lugar de la imagen, retorna las regiones que cambiaron"),
+    if_none_match: Optional[str] = Header(None, description="ETag de la última captura recibida: si la pantalla no cambió responde 304")
 ):
     """
     Obtiene una captura de pantalla del dispositivo.
+    La imagen se captura con `exec-out screencap` y se envía desde memoria,
+    sin archivos temporales en el dispositivo ni en el servidor.
+    
+    Con `format` o `width` se pide el framebuffer en crudo y se codifica en
+    el servidor, lo que evita la compresión PNG en CPUs lentas de Android TV.
+    
+    Cada respuesta lleva un `ETag` derivado del contenido de la pantalla. Con
+    `If-None-Match` una pantalla sin cambios responde 304 sin cuerpo; con
+    `changed_since` se retorna JSON con las regiones que cambiaron.
     """
+    if format is not None and format not in SCREENSHOT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Formato no soportado: {format}. Usa: {', '.join(SCREENSHOT_FORMATS)}")
     try:
         device = devices[device_ip]
         
-        # Crear directorio temporal si no existe
-        os.makedirs("/tmp/screenshots", exist_ok=True)
+        raw = format is not None or width is not None or changed_since is not None
+        format = format or "png"
+        result = await device.exec_out("screencap" if raw else "screencap -p", read_only=True)
+        if result["status"] != "success":
+            raise HTTPException(status_code=503, detail=f"Error al ejecutar comando ADB: {result['message']}")
         
-        # Tomar screenshot
-        device.execute_command("screencap -p /sdcard/screenshot.png")
+        data = result["output"]
+        if raw:
+            try:
+                frame = parse_raw_screencap(data)
+            except ValueError as e:
+                raise HTTPException(status_code=503, detail=f"screencap no devolvió un framebuffer válido: {str(e)}")
+        elif not data.startswith(PNG_SIGNATURE):
+            detail = data[:200].decode("utf8", errors="replace").strip() or "salida vacía"
+            raise HTTPException(status_code=503, detail=f"screencap no devolvió un PNG: {detail}")
+        
+        frame_hash = await run_blocking(frame_digest, data)
+        etag = screenshot_etag(frame_hash, raw, format, quality, width)
+        
+        # Último frame del dispositivo (hash y miniatura para changed_since)
+        last = device.cache_get("last_frame", float("inf"))
+        if raw and (last is None or last["hash"] != frame_hash):
+            thumbnail = await run_blocking(screen_thumbnail, frame)
+            device.cache_set("last_frame", {"hash": frame_hash, "thumbnail": thumbnail, "size": frame.size})
+        elif not raw and (last is None or last["hash"] != frame_hash):
+            device.cache_set("last_frame", {"hash": frame_hash, "thumbnail": None, "size": None})
+        
+        if changed_since is not None:
+            current = device.cache_get("last_frame", float("inf"))
+            base_hash = etag_frame_hash(changed_since)
+            if base_hash == frame_hash:
+                regions = []
+            elif last is not None and last["hash"] == base_hash and last["thumbnail"] is not None:
+                regions = await run_blocking(changed_regions, last["thumbnail"], current["thumbnail"], frame.size)
+            else:
+                # Sin el frame de referencia no se puede comparar: cambió todo
+                regions = [{"x": 0, "y": 0, "width": frame.width, "height": frame.height}]
+            return {
+                "status": "success",
+                "device": device_ip,
+                "changed": base_hash != frame_hash,
+                "etag": etag,
+                "width": frame.width,
+                "height": frame.height,
+                "regions": regions
+            }
+        
+        if etag_matches(if_none_match, etag):
+            logger.info(f"Screenshot de {device_ip} sin cambios (304)")
+            return Response(status_code=304, headers={"ETag": etag})
         
-        # Descargar archivo
-        timestamp = int(datetime.now().timestamp())
-        local_path = f"/tmp/screenshots/screenshot_{device_ip}_{timestamp}.png"
-        device.device.pull("/sdcard/screenshot.png", local_path)
+        image = await run_blocking(encode_image, frame, format, quality, width) if raw else data
         
-        logger.info(f"Screenshot descargado de {device_ip}")
+        logger.info(f"Screenshot capturado de {device_ip} ({format}, {len(image)} bytes)")
         
-        return FileResponse(
-            local_path, 
-            media_type="image/png", 
-            filename=f"screenshot_{device_ip}.png"
+        return Response(
+            content=image,
+            media_type=SCREENSHOT_FORMATS[format][1],
+            headers={
+                "Content-Disposition": f'attachment; filename="screenshot_{device_ip}.{format}"',
+                "ETag": etag
+            }
         )
     
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error al descargar screenshot: {str(e)}")
+        logger.error(f"Error al capturar screenshot: {str(e)}")
         raise HTTPException(status_code=503, detail=f"Error al ejecutar comando ADB: {str(e)}")
 
+@app.get(
+    "/screenshot/stream",
+    tags=["Información"],
+    summary="Transmisión continua de pantalla (MJPEG)",
+    responses={
+        200: {"description": "Flujo multipart/x-mixed-replace de frames JPEG", "content": {"multipart/x-mixed-replace": {}}},
+        503: {"description": "No se pudo capturar la pantalla"}
+    }
+)
+@ensure_device_connection
+async def stream_screenshot(
+    device_ip: str = Query(..., description="IP o hostname del dispositivo"),
+    fps: float = Query(2, gt=0, description="Frames por segundo objetivo (máximo STREAM_MAX_FPS)"),
+    quality: int = Query(70, ge=1, le=100, description="Calidad JPEG"),
+    width: Optional[int] = Query(None, ge=1, description="Ancho máximo en píxeles (mantiene la proporción)")
+):
+    """
+    Transmite la pantalla del dispositivo como MJPEG, apto para un `<img>`.
+    Todos los espectadores de un dispositivo comparten un único bucle de
+    captura; si un cliente es lento se saltan frames en lugar de acumularlos.
+    """
+    stream, viewer, first = await open_frame_stream(device_ip, fps, quality, width)
+    
+    async def multipart():
+        try:
+            async for jpeg in stream.frames(viewer, quality, width, first):
+                yield (
+                    b"--frame\r\nContent-Type: image/jpeg\r\n"
+                    + f"Content-Length: {len(jpeg)}\r\n\r\n".encode() + jpeg + b"\r\n"
+                )
+        finally:
+            stream.unsubscribe(viewer)
+    
+    return StreamingResponse(multipart(), media_type="multipart/x-mixed-replace; boundary=frame")
+
+@app.websocket("/screenshot/stream/ws")
+async def stream_screenshot_ws(
+    websocket: WebSocket,
+    device_ip: str,
+    fps: float = 2,
+    quality: int = 70,
+    width: Optional[int] = None
+):
+    """
+    Transmite la pantalla del dispositivo por WebSocket: un mensaje binario
+    con un JPEG por frame. Comparte el bucle de captura con /screenshot/stream.
+    """
+    await websocket.accept()
+    try:
+        if fps <= 0 or not 1 <= quality <= 100 or (width is not None and width < 1):
+            raise HTTPException(status_code=400, detail="Parámetros fuera de rango (fps > 0, quality 1-100, width >= 1)")
+        await ensure_connected(device_ip)
+        stream, viewer, first = await open_frame_stream(device_ip, fps, quality, width)
+    except HTTPException as e:
+        await websocket.close(code=1011 if e.status_code >= 500 else 1008, reason=str(e.detail)[:120])
+        return
+    
+    try:
+        await pump_websocket(websocket, stream.frames(viewer, quality, width, first), websocket.send_bytes)
+    finally:
+        stream.unsubscribe(viewer)
+
 @app.get(
     "/status",
     tags=["Información"],
@@ -555,32 +3527,43 @@ async def get_screenshot(
         503: {"description": "Error al ejecutar comando"}
     }
 )
-@ensure_device_connection
 async def get_status(
-    device_ip: str = Query(..., description="IP o hostname del dispositivo")
+    device_ip: str = Query(..., description="IP o hostname del dispositivo"),
+    refresh: bool = Query(False, description="Sondear el dispositivo en lugar de usar la salud en caché")
 ):
     """
     Verifica el estado actual de conexión del dispositivo.
     
+    Con el supervisor activo (`KEEPALIVE_INTERVAL` > 0) la respuesta sale de
+    la salud en caché, sin tocar el dispositivo: último contacto, RTT del
+    último sondeo, fallos consecutivos, reconexiones y tiempo hasta la
+    próxima revisión. Con `refresh=true` (o sin supervisor) se reconecta si
+    hace falta y se envía un sondeo keepalive.
+    
     **Parámetros:**
     - **device_ip**: IP del dispositivo (requerido)
+    - **refresh**: Sondear el dispositivo ahora
     """
     try:
+        cached = KEEPALIVE_INTERVAL > 0 and not refresh and device_ip in devices
+        if not cached:
+            await ensure_connected(device_ip)
+            await devices[device_ip].probe()
         device = devices[device_ip]
         
-        # Intentar ejecutar comando simple para verificar conexión
-        test_result = device.execute_command("echo 'test'")
-        
-        if test_result["status"] == "success":
-            device.connected = True
+        if device.connected:
+            status = "connected"
         else:
-            device.connected = False
+            status = "reconnecting" if KEEPALIVE_INTERVAL > 0 else "disconnected"
         
         return {
             "device": device_ip,
             "port": device.port,
-            "status": "connected" if device.connected else "disconnected",
-            "connected": device.connected
+            "status": status,
+            "connected": device.connected,
+            "cached": cached,
+            "health": device.health.summary(),
+            "queue": device.queue_stats()
         }
     except HTTPException:
         raise
@@ -611,10 +3594,7 @@ async def disconnect_device(
         if device_ip not in devices:
             raise HTTPException(status_code=400, detail=f"Dispositivo '{device_ip}' no encontrado")
         
-        result = devices[device_ip].disconnect()
-        del devices[device_ip]
-        
-        return result
+        return await unregister_device(device_ip)
     except HTTPException:
         raise
     except Exception as e:
@@ -622,49 +3602,141 @@ async def disconnect_device(
         raise HTTPException(status_code=503, detail=f"Error al desconectar: {str(e)}")
 
 @app.post(
-    "/command",
+    "/devices/tags",
+    tags=["Dispositivos"],
+    summary="Asignar etiquetas a un dispositivo",
+    responses={
+        200: {"description": "Etiquetas actualizadas"},
+        400: {"description": "device_ip inválido"}
+    }
+)
+async def set_device_tags(
+    device_ip: str = Query(..., description="IP o hostname del dispositivo"),
+    tags: Optional[str] = Query(None, description="Etiquetas separadas por coma (ej: 'sala,planta-baja'); vacío las elimina")
+):
+    """
+    Reemplaza las etiquetas de un dispositivo. Las etiquetas seleccionan
+    grupos de dispositivos en los endpoints `/fleet/*` (`?tag=sala`). El
+    dispositivo no necesita estar conectado. En modo cluster se guardan en
+    `CLUSTER_DB` y valen para todos los nodos.
+    """
+    validate_device_ip(device_ip)
+    names = {t.strip() for t in tags.split(",") if t.strip()} if tags else set()
+    if cluster is not None:
+        await cluster.save_tags({device_ip: names})
+    elif names:
+        device_tags[device_ip] = names
+    else:
+        device_tags.pop(device_ip, None)
+    return {"device": device_ip, "tags": sorted(names)}
+
+@app.post(
+    "/command",
+    tags=["Comandos"],
+    summary="Enviar comando ADB personalizado",
+    responses={
+        200: {"description": "Comando ejecutado"},
+        400: {"description": "Comando vacío"},
+        503: {"description": "Error al ejecutar comando"}
+    }
+)
+@ensure_device_connection
+async def send_custom_command(
+    device_ip: str = Query(..., description="IP o hostname del dispositivo"),
+    command: str = Query(..., description="Comando ADB shell a ejecutar")
+):
+    """
+    Ejecuta un comando ADB shell personalizado en el dispositivo.
+    
+    **Parámetros:**
+    - **device_ip**: IP del dispositivo (requerido)
+    - **command**: Comando a ejecutar (requerido)
+    
+    **Ejemplos:**
+    - `ps` - Listar procesos
+    - `ls /sdcard` - Listar archivos
+    - `getprop ro.build.version.release` - Obtener versión de Android
+    """
+    try:
+        # Validar parámetros
+        validate_required_params(device_ip=device_ip, command=command)
+        
+        device = devices[device_ip]
+        result = await device.execute_command(command)
+        
+        return {
+            "device": device_ip,
+            "command": command,
+            "result": result
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error en /command: {str(e)}")
+        raise HTTPException(status_code=503, detail=f"Error al ejecutar comando: {str(e)}")
+
+@app.post(
+    "/device/batch",
     tags=["Comandos"],
-    summary="Enviar comando ADB personalizado",
+    summary="Ejecutar varias operaciones en un dispositivo con una sola petición",
     responses={
-        200: {"description": "Comando ejecutado"},
-        400: {"description": "Comando vacío"},
-        503: {"description": "Error al ejecutar comando"}
+        200: {"description": "Resultado de cada paso, en orden"},
+        400: {"description": "Paso inválido o demasiados pasos"},
+        503: {"description": "Error al ejecutar la pipeline"}
     }
 )
 @ensure_device_connection
-async def send_custom_command(
+async def device_batch(
     device_ip: str = Query(..., description="IP o hostname del dispositivo"),
-    command: str = Query(..., description="Comando ADB shell a ejecutar")
+    batch: DeviceBatch = Body(..., description="Pasos en orden y stop_on_error")
 ):
     """
-    Ejecuta un comando ADB shell personalizado en el dispositivo.
+    Ejecuta una lista ordenada de operaciones en un dispositivo, con una
+    sola validación y verificación de conexión. Los pasos consecutivos se
+    envían juntos en un único script shell (un round trip ADB); solo las
+    esperas (`wait`) cortan el lote.
     
-    **Parámetros:**
-    - **device_ip**: IP del dispositivo (requerido)
-    - **command**: Comando a ejecutar (requerido)
+    **Operaciones:**
+    - `keyevent` (`keycodes`), `shell` (`command`), `play` (`video_url`), `stop`, `exit`
+    - `volume` (`level` 0-15), `volume_current`, `current_app`
+    - `wait` (`ms`)
     
-    **Ejemplos:**
-    - `ps` - Listar procesos
-    - `ls /sdcard` - Listar archivos
-    - `getprop ro.build.version.release` - Obtener versión de Android
+    Con `stop_on_error` los pasos posteriores al primero que falla no se
+    ejecutan y se reportan como `skipped`.
+    
+    **Ejemplo:**
+    ```bash
+    curl -X POST "http://localhost:9123/device/batch?device_ip=192.168.1.100" \\
+      -H "Content-Type: application/json" \\
+      -d '{"steps": [{"op": "exit"}, {"op": "volume", "level": 8},
+                     {"op": "play", "video_url": "https://youtu.be/dQw4w9WgXcQ"},
+                     {"op": "wait", "ms": 2000}, {"op": "current_app"}],
+           "stop_on_error": true}'
+    ```
     """
     try:
-        # Validar parámetros
-        validate_required_params(device_ip=device_ip, command=command)
+        if not batch.steps or len(batch.steps) > BATCH_MAX_STEPS:
+            raise HTTPException(status_code=400, detail=f"steps debe tener entre 1 y {BATCH_MAX_STEPS} pasos")
+        for index, step in enumerate(batch.steps):
+            validate_batch_step(index, step)
         
         device = devices[device_ip]
-        result = device.execute_command(command)
+        start = time.monotonic()
+        records, round_trips = await run_device_batch(device, batch.steps, batch.stop_on_error)
         
         return {
             "device": device_ip,
-            "command": command,
-            "result": result
+            "status": "success" if all(r["status"] == "success" for r in records) else "error",
+            "steps": records,
+            "round_trips": round_trips,
+            "elapsed_ms": round((time.monotonic() - start) * 1000, 1),
+            "timestamp": datetime.now().isoformat()
         }
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error en /command: {str(e)}")
-        raise HTTPException(status_code=503, detail=f"Error al ejecutar comando: {str(e)}")
+        logger.error(f"Error en /device/batch: {str(e)}")
+        raise HTTPException(status_code=503, detail=f"Error al ejecutar la pipeline: {str(e)}")
 
 @app.get(
     "/device/info",
@@ -677,7 +3749,8 @@ async def send_custom_command(
 )
 @ensure_device_connection
 async def get_device_info(
-    device_ip: str = Query(..., description="IP o hostname del dispositivo")
+    device_ip: str = Query(..., description="IP o hostname del dispositivo"),
+    refresh: bool = Query(False, description="Ignorar la caché y consultar el dispositivo")
 ):
     """
     Obtiene información detallada del dispositivo Android.
@@ -691,58 +3764,68 @@ async def get_device_info(
     - **storage_info**: Información de almacenamiento
     - **serial_number**: Número de serie único
     - **battery_info**: Información de la batería
+    
+    Todos los datos se obtienen en un único round trip ADB; si alguna
+    sección falla se detalla en **errors**.
+    
+    Las propiedades estáticas se guardan en caché `PROPS_CACHE_TTL` segundos
+    y batería/almacenamiento/RAM `VOLATILE_CACHE_TTL` segundos; la caché se
+    invalida al reconectar. **cached** indica si la respuesta no tocó el
+    dispositivo. Con `refresh=true` se ignora la caché.
     """
     try:
         device = devices[device_ip]
         
-        # Obtener información del dispositivo
-        info = {}
+        # Propiedades estáticas y datos volátiles desde la caché; lo que falte
+        # o haya expirado se obtiene en un solo round trip ADB
+        props = None if refresh else device.cache_get("properties", PROPS_CACHE_TTL)
+        volatile = {}
+        for key in DEVICE_INFO_VOLATILE_COMMANDS:
+            value = None if refresh else device.cache_get(f"volatile_info:{key}", VOLATILE_CACHE_TTL)
+            if value is not None:
+                volatile[key] = value
+        cached = props is not None and len(volatile) == len(DEVICE_INFO_VOLATILE_COMMANDS)
         
-        # Modelo del dispositivo
-        model_result = device.execute_command("getprop ro.product.model")
-        if model_result["status"] == "success":
-            info["model"] = model_result["output"].strip()
-        
-        # Fabricante
-        manufacturer_result = device.execute_command("getprop ro.product.manufacturer")
-        if manufacturer_result["status"] == "success":
-            info["manufacturer"] = manufacturer_result["output"].strip()
-        
-        # Versión de Android
-        android_version_result = device.execute_command("getprop ro.build.version.release")
-        if android_version_result["status"] == "success":
-            info["android_version"] = android_version_result["output"].strip()
-        
-        # Nivel de API
-        api_level_result = device.execute_command("getprop ro.build.version.sdk")
-        if api_level_result["status"] == "success":
-            info["api_level"] = api_level_result["output"].strip()
-        
-        # RAM total
-        ram_result = device.execute_command("cat /proc/meminfo | grep MemTotal")
-        if ram_result["status"] == "success":
-            info["total_ram"] = ram_result["output"].strip()
-        
-        # Almacenamiento
-        storage_result = device.execute_command("df /data")
-        if storage_result["status"] == "success":
-            info["storage_info"] = storage_result["output"].strip()
-        
-        # Identificador único del dispositivo
-        device_id_result = device.execute_command("getprop ro.serialno")
-        if device_id_result["status"] == "success":
-            info["serial_number"] = device_id_result["output"].strip()
-        
-        # Battery level
-        battery_result = device.execute_command("dumpsys battery | grep 'level'")
-        if battery_result["status"] == "success":
-            info["battery_info"] = battery_result["output"].strip()
+        errors = {}
+        commands = {key: cmd for key, cmd in DEVICE_INFO_VOLATILE_COMMANDS.items() if key not in volatile}
+        if props is None:
+            commands["properties"] = "getprop"
         
-        return {
+        if commands:
+            results = await device.execute_batch(commands, read_only=True)
+            
+            # Una sección que falla (error de transporte o código de salida
+            # distinto de 0) se informa en errors y no se guarda en caché
+            for key, result in results.items():
+                error = batch_section_error(result)
+                if error is not None:
+                    errors[key] = error
+                elif key == "properties":
+                    props = parse_getprop(result["output"])
+                    device.cache_set("properties", props)
+                else:
+                    volatile[key] = result["output"].strip()
+                    device.cache_set(f"volatile_info:{key}", volatile[key])
+            
+            battery = re.search(r"level: (\d+)", volatile.get("battery_info", "")) if "battery_info" in commands else None
+            if battery:
+                event_bus.update(device_ip, "battery", {"level": int(battery.group(1))})
+        
+        info = {}
+        for key, prop in DEVICE_INFO_PROPERTIES.items():
+            if props and prop in props:
+                info[key] = props[prop]
+        info.update(volatile)
+        
+        response = {
             "device": device_ip,
             "info": info,
+            "cached": cached,
             "timestamp": datetime.now().isoformat()
         }
+        if errors:
+            response["errors"] = errors
+        return response
     except HTTPException:
         raise
     except Exception as e:
@@ -765,35 +3848,47 @@ async def get_current_app(
     """
     Obtiene la aplicación Android actualmente en pantalla.
     
+    Con `FOREGROUND_WATCHER` activo (por defecto) la primera consulta inicia
+    un vigilante que sigue los cambios de app desde los eventos del sistema;
+    las siguientes se responden desde memoria, sin comandos ADB. La versión
+    de cada app se guarda en caché `PACKAGES_CACHE_TTL` segundos.
+    
     **Parámetros:**
     - **device_ip**: IP del dispositivo (requerido)
     """
     try:
         device = devices[device_ip]
         
-        # Obtener la ventana enfocada
-        focusedwindow_result = device.execute_command("dumpsys window windows | grep 'mCurrentFocus'")
-        
-        current_app = None
-        package_name = None
-        
-        if focusedwindow_result["status"] == "success":
-            output = focusedwindow_result["output"].strip()
-            # Parsear el resultado para extraer el nombre del package
-            if output:
-                # Ejemplo: mCurrentFocus=Window{123456 u0 com.google.android.youtube/com.google.android.youtube.MainActivity}
-                import re
-                match = re.search(r'(\S+)/(\S+)\}', output)
-                if match:
-                    package_name = match.group(1)
-                    current_app = match.group(2)
+        if FOREGROUND_WATCHER:
+            watcher = foreground_watcher(device_ip)
+            try:
+                await asyncio.wait_for(watcher.ready.wait(), FOREGROUND_READY_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=503, detail=f"Error al obtener aplicación actual: {watcher.error or 'sin respuesta del dispositivo'}")
+            package_name, current_app, raw_output = watcher.package, watcher.activity, watcher.raw
+            source, changed_at = "watcher", watcher.changed_at
+        else:
+            # Obtener la ventana enfocada
+            focusedwindow_result = await device.execute_command(FOREGROUND_QUERY_COMMAND, read_only=True)
+            if focusedwindow_result["status"] != "success":
+                raise HTTPException(status_code=503, detail=f"Error al obtener aplicación actual: {focusedwindow_result['message']}")
+            # Ejemplo: mCurrentFocus=Window{123456 u0 com.google.android.youtube/com.google.android.youtube.MainActivity}
+            raw_output = focusedwindow_result["output"]
+            package_name, current_app = parse_foreground_component(raw_output)
+            source, changed_at = "query", None
+            event_bus.update(device_ip, "app", {"package": package_name, "activity": current_app})
         
         # Obtener información de la aplicación (si existe el package)
         app_info = {}
         if package_name:
-            label_result = device.execute_command(f"dumpsys package {package_name} | grep 'versionCode'")
-            if label_result["status"] == "success":
-                app_info["version_info"] = label_result["output"].strip()
+            version_info = device.cache_get(f"version_info:{package_name}", PACKAGES_CACHE_TTL)
+            if version_info is None:
+                label_result = await device.execute_command(f"dumpsys package {shlex.quote(package_name)} | grep 'versionCode'", read_only=True)
+                if label_result["status"] == "success":
+                    version_info = label_result["output"].strip()
+                    device.cache_set(f"version_info:{package_name}", version_info)
+            if version_info is not None:
+                app_info["version_info"] = version_info
         
         return {
             "device": device_ip,
@@ -802,7 +3897,9 @@ async def get_current_app(
                 "activity": current_app,
                 "info": app_info
             },
-            "raw_output": focusedwindow_result.get("output", ""),
+            "source": source,
+            "changed_at": changed_at,
+            "raw_output": raw_output,
             "timestamp": datetime.now().isoformat()
         }
     except HTTPException:
@@ -811,6 +3908,55 @@ async def get_current_app(
         logger.error(f"Error en /device/current-app: {str(e)}")
         raise HTTPException(status_code=503, detail=f"Error al obtener aplicación actual: {str(e)}")
 
+@app.get(
+    "/device/current-app/stream",
+    tags=["Información del Dispositivo"],
+    summary="Cambios de aplicación en pantalla en vivo (Server-Sent Events)",
+    responses={
+        200: {"description": "Flujo text/event-stream, un evento JSON por cambio de app", "content": {"text/event-stream": {}}}
+    }
+)
+@ensure_device_connection
+async def stream_current_app(
+    device_ip: str = Query(..., description="IP o hostname del dispositivo")
+):
+    """
+    Transmite la app en primer plano como Server-Sent Events: primero el
+    estado actual y luego un evento por cada cambio, con package, activity,
+    seq y changed_at. Todos los clientes comparten el vigilante del
+    dispositivo.
+    """
+    watcher = foreground_watcher(device_ip)
+    
+    async def events():
+        states = watcher.events()
+        try:
+            async for state in states:
+                yield f"event: app\ndata: {json.dumps(state)}\n\n"
+        finally:
+            await states.aclose()
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.websocket("/device/current-app/stream/ws")
+async def stream_current_app_ws(
+    websocket: WebSocket,
+    device_ip: str
+):
+    """
+    Transmite los cambios de app en primer plano por WebSocket: un mensaje
+    JSON con el estado actual y otro por cada cambio.
+    """
+    await websocket.accept()
+    try:
+        await ensure_connected(device_ip)
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=str(e.detail)[:120])
+        return
+    
+    watcher = foreground_watcher(device_ip)
+    await pump_websocket(websocket, watcher.events(), websocket.send_json)
+
 @app.get(
     "/device/installed-apps",
     tags=["Información del Dispositivo"],
@@ -824,59 +3970,68 @@ async def get_current_app(
 @ensure_device_connection
 async def get_installed_apps(
     device_ip: str = Query(..., description="IP o hostname del dispositivo"),
-    limit: int = Query(20, description="Cantidad máxima de aplicaciones a retornar (1-500)", ge=1, le=500)
+    limit: int = Query(20, description="Cantidad máxima de aplicaciones a retornar (1-500)", ge=1, le=500),
+    offset: int = Query(0, ge=0, description="Primer resultado a retornar"),
+    prefix: Optional[str] = Query(None, description="Solo paquetes cuyo nombre empieza así (ej: 'com.google.')"),
+    system: Optional[bool] = Query(None, description="true: solo del sistema, false: solo de terceros"),
+    sort: str = Query("name", description="Orden: name, -name, uid o -uid"),
+    refresh: bool = Query(False, description="Reconstruir el índice de paquetes desde el dispositivo"),
+    details: bool = Query(False, description="Incluir versión, SDK, fechas de instalación, instalador y estado")
 ):
     """
     Obtiene la lista de aplicaciones instaladas en el dispositivo.
     
+    La lista sale de un índice de paquetes por dispositivo, construido con
+    un solo round trip ADB. Pasados `PACKAGES_CACHE_TTL` segundos solo se
+    comprueba si cambió `packages.xml` y el índice se reconstruye únicamente
+    tras una instalación, actualización o desinstalación.
+    
     **Parámetros:**
     - **device_ip**: IP del dispositivo (requerido)
-    - **limit**: Cantidad máxima de apps a retornar (default: 20, max: 500)
+    - **limit / offset**: Paginación (default: 20, max: 500)
+    - **prefix**: Búsqueda por prefijo del nombre del paquete
+    - **system**: Filtrar aplicaciones del sistema o de terceros
+    - **sort**: Orden por nombre o uid; con "-" en orden descendente
+    - **refresh**: Forzar la reconstrucción del índice
+    - **details**: Agregar los metadatos de cada app. Salen de un único
+      `dumpsys package packages` por dispositivo, en caché hasta que cambie
+      el índice
     
     **Información retornada:**
     - **package_name**: Nombre del paquete (ej: com.google.android.youtube)
     - **is_system_app**: Indica si es aplicación del sistema
+    - **apk_path / uid**: Ruta del APK base y uid de la aplicación
+    - **details**: Con details=true, version_name, version_code, min_sdk,
+      target_sdk, first_install_time, last_update_time, installer y enabled
+    - **index.added / index.removed**: Cambios detectados en la última reconstrucción
     """
     try:
         # Validar parámetros
         validate_required_params(device_ip=device_ip)
         if not isinstance(limit, int) or limit < 1 or limit > 500:
             raise HTTPException(status_code=400, detail="limit debe ser un número entre 1 y 500")
+        if sort not in PACKAGE_SORTS:
+            raise HTTPException(status_code=400, detail=f"sort debe ser uno de: {', '.join(PACKAGE_SORTS)}")
         
         device = devices[device_ip]
-        
-        # Obtener lista de paquetes
-        packages_result = device.execute_command("pm list packages")
-        
-        apps = []
-        if packages_result["status"] == "success":
-            lines = packages_result["output"].strip().split('\n')
-            # Limitar a los últimos 'limit' paquetes
-            selected_packages = lines[-limit:] if len(lines) > limit else lines
-            
-            for line in selected_packages:
-                if line.startswith("package:"):
-                    package_name = line.replace("package:", "").strip()
-                    apps.append({
-                        "package_name": package_name
-                    })
-        
-        # Obtener lista de aplicaciones del sistema
-        system_apps_result = device.execute_command("pm list packages -s")
-        system_packages = set()
-        if system_apps_result["status"] == "success":
-            for line in system_apps_result["output"].strip().split('\n'):
-                if line.startswith("package:"):
-                    system_packages.add(line.replace("package:", "").strip())
-        
-        # Marcar cuáles son del sistema
-        for app in apps:
-            app["is_system_app"] = app["package_name"] in system_packages
+        index = await get_package_index(device, refresh=refresh)
+        total, page = index.query(prefix, system, sort, offset, limit)
+        next_offset = offset + limit if offset + limit < total else None
+        apps = [asdict(p) for p in page]
+        if details:
+            package_details = await get_package_details(device, index)
+            for app_entry in apps:
+                found = package_details.get(app_entry["package_name"])
+                app_entry["details"] = asdict(found) if found else None
         
         return {
             "device": device_ip,
-            "total_apps": len(apps),
+            "total_apps": total,
+            "offset": offset,
+            "limit": limit,
+            "next_offset": next_offset,
             "apps": apps,
+            "index": index.stats(),
             "timestamp": datetime.now().isoformat()
         }
     except HTTPException:
@@ -891,51 +4046,64 @@ async def get_installed_apps(
     summary="Obtener logs del sistema",
     responses={
         200: {"description": "Logs del dispositivo"},
-        400: {"description": "Parámetro lines fuera de rango"},
+        400: {"description": "Parámetros de filtro o paginación inválidos"},
         503: {"description": "Error al obtener logs"}
     }
 )
 @ensure_device_connection
 async def get_device_logcat(
     device_ip: str = Query(..., description="IP o hostname del dispositivo"),
-    lines: int = Query(50, description="Cantidad de líneas a obtener (1-1000)", ge=1, le=1000),
-    filter_text: Optional[str] = Query(None, description="Filtro opcional (ej: 'error', 'warning')")
+    lines: int = Query(50, description=f"Cantidad de líneas a leer del dispositivo (1-{LOGCAT_MAX_LINES})", ge=1, le=LOGCAT_MAX_LINES),
+    filter_text: Optional[str] = Query(None, description="Texto que debe aparecer en el tag o el mensaje (ej: 'error')"),
+    level: Optional[str] = Query(None, description="Nivel mínimo: V, D, I, W, E o F"),
+    tag: Optional[str] = Query(None, description="Tags separados por coma (ej: 'ActivityManager,WindowManager')"),
+    pid: Optional[int] = Query(None, description="Solo líneas de este proceso"),
+    regex: Optional[str] = Query(None, description="Expresión regular sobre el mensaje"),
+    since: Optional[str] = Query(None, description="Desde este momento, formato MM-DD HH:MM:SS[.mmm] (ignora lines)"),
+    until: Optional[str] = Query(None, description="Hasta este momento, formato MM-DD HH:MM:SS[.mmm]"),
+    offset: int = Query(0, ge=0, description="Primer resultado a retornar"),
+    limit: int = Query(100, ge=1, le=1000, description="Cantidad máxima de resultados (1-1000)")
 ):
     """
-    Obtiene los últimos logs del sistema (logcat) del dispositivo.
+    Obtiene los logs del sistema (logcat) del dispositivo, separados en
+    timestamp, pid, tid, nivel, tag y mensaje.
     
     **Parámetros:**
     - **device_ip**: IP del dispositivo (requerido)
-    - **lines**: Cantidad de líneas a retornar (default: 50, max: 1000)
-    - **filter_text**: Texto para filtrar logs (opcional)
+    - **lines**: Líneas a leer del dispositivo (default: 50, max: 10000)
+    - **level / tag**: Se aplican con los filtros nativos de logcat, en el dispositivo
+    - **filter_text, pid, regex, since, until**: Se aplican en el servidor
+    - **offset / limit**: Paginación de los resultados ya filtrados
     """
     try:
         # Validar parámetros
         validate_required_params(device_ip=device_ip)
-        if not isinstance(lines, int) or lines < 1 or lines > 1000:
-            raise HTTPException(status_code=400, detail="lines debe ser un número entre 1 y 1000")
+        if not isinstance(lines, int) or lines < 1 or lines > LOGCAT_MAX_LINES:
+            raise HTTPException(status_code=400, detail=f"lines debe ser un número entre 1 y {LOGCAT_MAX_LINES}")
+        tags = [t.strip() for t in tag.split(",") if t.strip()] if tag else None
+        try:
+            matches = logcat_filter(level, tags, pid, regex, since, until, filter_text)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
         device = devices[device_ip]
         
-        # Obtener logcat
-        cmd = f"logcat -t {lines}"
-        if filter_text:
-            cmd += f" | grep '{filter_text}'"
+        logcat_result = await device.execute_command(logcat_command(lines, level, tags, since), read_only=True)
+        if logcat_result["status"] != "success":
+            raise HTTPException(status_code=503, detail=f"Error al obtener logs: {logcat_result['message']}")
         
-        logcat_result = device.execute_command(cmd)
-        
-        logs = []
-        if logcat_result["status"] == "success":
-            lines_list = logcat_result["output"].strip().split('\n')
-            for line in lines_list:
-                if line.strip():
-                    logs.append(line)
+        entries = [e for e in parse_logcat(logcat_result["output"]) if matches(e)]
+        page = entries[offset:offset + limit]
+        next_offset = offset + limit if offset + limit < len(entries) else None
         
         return {
             "device": device_ip,
             "filter": filter_text,
-            "total_lines": len(logs),
-            "logs": logs,
+            "total_lines": len(entries),
+            "offset": offset,
+            "limit": limit,
+            "next_offset": next_offset,
+            "entries": [asdict(e) for e in page],
             "timestamp": datetime.now().isoformat()
         }
     except HTTPException:
@@ -944,6 +4112,176 @@ async def get_device_logcat(
         logger.error(f"Error en /device/logcat: {str(e)}")
         raise HTTPException(status_code=503, detail=f"Error al obtener información del dispositivo: {str(e)}")
 
+def logcat_stream_command(tail: int, since: Optional[str] = None) -> str:
+    """
+    `logcat` que sigue con las líneas nuevas: desde la hora del dispositivo
+    `since` o mostrando antes las últimas `tail` líneas
+    """
+    if since:
+        return f"logcat -v threadtime -T {shlex.quote(since)}"
+    return f"logcat -v threadtime -T {tail}"
+
+async def device_clock(device: DeviceConnection) -> str:
+    """Hora actual del dispositivo en el formato que acepta `logcat -T`"""
+    result = await device.execute_command(DEVICE_CLOCK_COMMAND, read_only=True)
+    since = result["output"].strip() if result["status"] == "success" else ""
+    if not DEVICE_CLOCK.match(since):
+        raise RuntimeError(f"Hora del dispositivo no válida: {since or result.get('message')}")
+    return since
+
+async def logcat_lines(channel: DeviceConnection, tail: int, filter_text: Optional[str],
+                       since: Optional[str] = None):
+    """
+    Líneas de logcat en vivo de un canal dedicado, filtradas en el servidor.
+    Con tail=0 se sigue desde `since` (la hora del dispositivo al abrir el
+    stream), porque `logcat -T` exige al menos una línea previa.
+    """
+    async for line in channel.stream_lines(logcat_stream_command(tail, since)):
+        if line and (not filter_text or filter_text in line):
+            yield line
+
+@app.get(
+    "/device/logcat/stream",
+    tags=["Información del Dispositivo"],
+    summary="Logs del sistema en vivo (Server-Sent Events)",
+    responses={
+        200: {"description": "Flujo text/event-stream, un evento por línea", "content": {"text/event-stream": {}}},
+        400: {"description": "Parámetro tail fuera de rango"},
+        503: {"description": "No se pudo abrir el stream de logcat"}
+    }
+)
+@ensure_device_connection
+async def stream_device_logcat(
+    device_ip: str = Query(..., description="IP o hostname del dispositivo"),
+    tail: int = Query(0, ge=0, le=1000, description="Líneas anteriores a incluir antes de las nuevas (0-1000)"),
+    filter_text: Optional[str] = Query(None, description="Filtro opcional (ej: 'error', 'warning')")
+):
+    """
+    Transmite el logcat del dispositivo en vivo como Server-Sent Events.
+    
+    `logcat` corre en una conexión ADB dedicada mientras el cliente esté
+    conectado; al desconectarse se cierra y el proceso termina en el
+    dispositivo. Si el cliente lee lento se deja de leer del dispositivo
+    (la memoria del servidor no crece).
+    """
+    try:
+        since = await device_clock(devices[device_ip]) if tail == 0 else None
+        channel = await devices[device_ip].open_stream_channel()
+    except Exception as e:
+        logger.error(f"Error en /device/logcat/stream: {str(e)}")
+        raise HTTPException(status_code=503, detail=f"No se pudo abrir el stream de logcat: {str(e)}")
+    
+    async def events():
+        lines = logcat_lines(channel, tail, filter_text, since)
+        try:
+            async for line in lines:
+                yield f"data: {line}\n\n"
+        finally:
+            await lines.aclose()
+            await channel.disconnect()
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.websocket("/device/logcat/stream/ws")
+async def stream_device_logcat_ws(
+    websocket: WebSocket,
+    device_ip: str,
+    tail: int = 0,
+    filter_text: Optional[str] = None
+):
+    """
+    Transmite el logcat del dispositivo en vivo por WebSocket: un mensaje de
+    texto por línea. Al cerrar el WebSocket termina `logcat` en el dispositivo.
+    """
+    await websocket.accept()
+    try:
+        if not 0 <= tail <= 1000:
+            raise HTTPException(status_code=400, detail="tail debe ser un número entre 0 y 1000")
+        await ensure_connected(device_ip)
+        since = await device_clock(devices[device_ip]) if tail == 0 else None
+        channel = await devices[device_ip].open_stream_channel()
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=str(e.detail)[:120])
+        return
+    except Exception as e:
+        await websocket.close(code=1011, reason=f"No se pudo abrir el stream de logcat: {str(e)}"[:120])
+        return
+    
+    try:
+        await pump_websocket(websocket, logcat_lines(channel, tail, filter_text, since), websocket.send_text)
+    finally:
+        await channel.disconnect()
+
+@app.post(
+    "/device/logcat/collector",
+    tags=["Información del Dispositivo"],
+    summary="Iniciar o detener el colector de logcat en segundo plano",
+    responses={
+        200: {"description": "Estado del colector"},
+        400: {"description": "Dispositivo no conectado"}
+    }
+)
+@ensure_device_connection
+async def set_logcat_collector(
+    device_ip: str = Query(..., description="IP o hostname del dispositivo"),
+    enabled: bool = Query(True, description="true para iniciar, false para detener y descartar el buffer")
+):
+    """
+    Inicia (o detiene) un colector que mantiene el logcat del dispositivo en
+    un buffer circular del servidor, consultable con /device/logcat/buffer.
+    Con `LOGCAT_COLLECTOR=true` se inicia solo al conectar cada dispositivo.
+    """
+    if not enabled:
+        await stop_logcat_collector(device_ip)
+        return {"status": "success", "device": device_ip, "collector": None}
+    
+    collector = logcat_collectors.get(device_ip)
+    if collector is None:
+        collector = logcat_collectors[device_ip] = LogcatCollector(device_ip)
+    collector.start()
+    return {"status": "success", "device": device_ip, "collector": collector.stats()}
+
+@app.get(
+    "/device/logcat/buffer",
+    tags=["Información del Dispositivo"],
+    summary="Leer logs nuevos del colector (sin ADB)",
+    responses={
+        200: {"description": "Líneas posteriores a since_seq"},
+        400: {"description": "Colector no iniciado o filtros inválidos"}
+    }
+)
+async def get_logcat_buffer(
+    device_ip: str = Query(..., description="IP o hostname del dispositivo"),
+    since_seq: int = Query(0, ge=0, description="Última secuencia recibida (next_seq de la consulta anterior)"),
+    limit: int = Query(500, ge=1, le=5000, description="Cantidad máxima de líneas (1-5000)"),
+    filter_text: Optional[str] = Query(None, description="Texto que debe aparecer en el tag o el mensaje"),
+    level: Optional[str] = Query(None, description="Nivel mínimo: V, D, I, W, E o F"),
+    tag: Optional[str] = Query(None, description="Tags separados por coma"),
+    pid: Optional[int] = Query(None, description="Solo líneas de este proceso"),
+    regex: Optional[str] = Query(None, description="Expresión regular sobre el mensaje")
+):
+    """
+    Retorna las líneas que el colector recibió después de `since_seq`,
+    directamente desde memoria. Pasar el `next_seq` de cada respuesta como
+    `since_seq` de la siguiente para leer solo lo nuevo; `missed` indica que
+    hubo líneas que salieron del buffer antes de ser leídas.
+    """
+    validate_device_ip(device_ip)
+    collector = logcat_collectors.get(device_ip)
+    if collector is None:
+        raise HTTPException(status_code=400, detail=f"No hay colector de logcat para '{device_ip}'. Inícialo con POST /device/logcat/collector")
+    tags = [t.strip() for t in tag.split(",") if t.strip()] if tag else None
+    try:
+        matches = logcat_filter(level, tags, pid, regex, text=filter_text)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return {
+        "device": device_ip,
+        **collector.fetch(since_seq, limit, matches),
+        "collector": collector.stats()
+    }
+
 @app.get(
     "/device/volume/current",
     tags=["Control de Volumen"],
@@ -955,24 +4293,28 @@ async def get_device_logcat(
 )
 @ensure_device_connection
 async def get_current_volume(
-    device_ip: str = Query(..., description="IP o hostname del dispositivo")
+    device_ip: str = Query(..., description="IP o hostname del dispositivo"),
+    refresh: bool = Query(False, description="Ignorar la caché y consultar el dispositivo")
 ):
     """
     Obtiene el nivel de volumen actual del dispositivo.
+    
+    **Retorna:**
+    - **volume_info**: Estado por stream (music, ring, alarm, notification...)
+      con level, min, max, muted y device (salida activa)
+    - **cached**: Si el estado se sirvió desde la caché (`VOLUME_CACHE_TTL`),
+      que también se actualiza con cada cambio de volumen
     """
     try:
         device = devices[device_ip]
         
-        # Obtener información de volumen actual
-        volume_result = device.execute_command("dumpsys audio_service | grep -i 'speaker.*volume'")
-        
-        volume_info = {}
-        if volume_result["status"] == "success":
-            volume_info["raw_output"] = volume_result["output"].strip()
+        cached = not refresh and device.cache_get("volume_state", VOLUME_CACHE_TTL) is not None
+        streams = await get_volume_state(device, refresh=refresh)
         
         return {
             "device": device_ip,
-            "volume_info": volume_info,
+            "volume_info": {name: asdict(stream) for name, stream in streams.items()},
+            "cached": cached,
             "timestamp": datetime.now().isoformat()
         }
     except HTTPException:
@@ -1002,6 +4344,9 @@ async def increase_volume(
     **Parámetros:**
     - **device_ip**: IP del dispositivo (requerido)
     - **steps**: Pasos a aumentar (default: 1, max: 15)
+    
+    Todas las teclas se envían en una sola invocación de `input`; **volume**
+    trae el nivel resultante si el dispositivo permite leerlo.
     """
     try:
         # Validar parámetros
@@ -1011,18 +4356,15 @@ async def increase_volume(
         
         device = devices[device_ip]
         
-        # Aumentar volumen usando VOLUME_UP keyevent
-        results = []
-        for _ in range(steps):
-            cmd = "input keyevent KEYCODE_VOLUME_UP"
-            result = device.execute_command(cmd)
-            results.append(result)
+        # Aumentar volumen: todas las teclas VOLUME_UP en una sola invocación
+        result = await apply_volume(device, keycodes=("KEYCODE_VOLUME_UP",) * steps)
         
         return {
             "device": device_ip,
             "action": "increase_volume",
             "steps": steps,
-            "status": "success" if all(r["status"] == "success" for r in results) else "partial",
+            "status": result["status"],
+            "volume": result.get("volume"),
             "timestamp": datetime.now().isoformat()
         }
     except HTTPException:
@@ -1052,6 +4394,9 @@ async def decrease_volume(
     **Parámetros:**
     - **device_ip**: IP del dispositivo (requerido)
     - **steps**: Pasos a disminuir (default: 1, max: 15)
+    
+    Todas las teclas se envían en una sola invocación de `input`; **volume**
+    trae el nivel resultante si el dispositivo permite leerlo.
     """
     try:
         # Validar parámetros
@@ -1061,18 +4406,15 @@ async def decrease_volume(
         
         device = devices[device_ip]
         
-        # Disminuir volumen usando VOLUME_DOWN keyevent
-        results = []
-        for _ in range(steps):
-            cmd = "input keyevent KEYCODE_VOLUME_DOWN"
-            result = device.execute_command(cmd)
-            results.append(result)
+        # Disminuir volumen: todas las teclas VOLUME_DOWN en una sola invocación
+        result = await apply_volume(device, keycodes=("KEYCODE_VOLUME_DOWN",) * steps)
         
         return {
             "device": device_ip,
             "action": "decrease_volume",
             "steps": steps,
-            "status": "success" if all(r["status"] == "success" for r in results) else "partial",
+            "status": result["status"],
+            "volume": result.get("volume"),
             "timestamp": datetime.now().isoformat()
         }
     except HTTPException:
@@ -1103,14 +4445,14 @@ async def mute_device(
     try:
         device = devices[device_ip]
         
-        # Silenciar usando MUTE keyevent
-        cmd = "input keyevent KEYCODE_MUTE"
-        result = device.execute_command(cmd)
+        # Silenciar usando MUTE keyevent (y leer el estado en el mismo round trip)
+        result = await apply_volume(device, keycodes=("KEYCODE_MUTE",))
         
         return {
             "device": device_ip,
             "action": "mute",
             "status": result["status"],
+            "volume": result.get("volume"),
             "timestamp": datetime.now().isoformat()
         }
     except HTTPException:
@@ -1135,26 +4477,25 @@ async def set_volume(
     level: int = Query(..., ge=0, le=15, description="Nivel de volumen (0-15)")
 ):
     # Establece el nivel de volumen del dispositivo a un valor especifico (0-15).
+    # Usa un solo comando segun el nivel de API (cmd media_session / media) y, si
+    # no esta disponible, el siguiente metodo hasta una sola invocacion de input
+    # con todas las teclas.
     try:
         validate_required_params(device_ip=device_ip)
         if not isinstance(level, int) or level < 0 or level > 15:
             raise HTTPException(status_code=400, detail="level debe ser un numero entero entre 0 y 15")
         
         device = devices[device_ip]
-        cmd = "input keyevent KEYCODE_VOLUME_MUTE"
-        device.execute_command(cmd)
-        
-        results = []
-        for _ in range(level):
-            cmd = "input keyevent KEYCODE_VOLUME_UP"
-            result = device.execute_command(cmd)
-            results.append(result)
+        # Fijar el nivel con un solo comando (según nivel de API) y leerlo de vuelta
+        result = await apply_volume(device, level=level)
         
         return {
             "device": device_ip,
             "action": "set_volume",
             "level": level,
-            "status": "success" if all(r["status"] == "success" for r in results) else "partial",
+            "method": result["method"],
+            "status": result["status"],
+            "volume": result.get("volume"),
             "timestamp": datetime.now().isoformat()
         }
     except HTTPException:
@@ -1163,8 +4504,440 @@ async def set_volume(
         logger.error(f"Error en /device/volume/set: {str(e)}")
         raise HTTPException(status_code=503, detail=f"Error al establecer volumen: {str(e)}")
 
+def event_subscription(device_ip: Optional[str], types: Optional[str]) -> tuple:
+    """Validar los filtros de una suscripción e iniciar los vigilantes necesarios"""
+    try:
+        ips, kinds = event_filter(device_ip, types)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    for ip in ips or ():
+        validate_device_ip(ip)
+    watch_devices(ips)
+    return ips, kinds
+
+def events_on_this_node(ips: Optional[set]) -> bool:
+    """Si todos los dispositivos del filtro son de este nodo (siempre, sin cluster)"""
+    return cluster is None or (ips is not None and all(cluster.is_owner(ip) for ip in ips))
+
+def require_local_events(ips: Optional[set]):
+    """
+    En modo cluster un stream de eventos solo cubre dispositivos de un nodo:
+    los seq son de cada nodo y no se pueden retomar mezclados. Lanza
+    HTTPException 400 (o 421 con la URL del dueño) si no es el caso.
+    """
+    if events_on_this_node(ips):
+        return
+    if ips is None:
+        raise HTTPException(status_code=400, detail="En modo cluster indique device_ip (o use webhooks, que cubren todos los nodos)")
+    owners = {cluster.owner(ip)[1] for ip in ips}
+    if len(owners) == 1:
+        raise HTTPException(status_code=421, detail=f"Los dispositivos pertenecen al nodo {owners.pop()}")
+    raise HTTPException(status_code=400, detail="En modo cluster los dispositivos de un stream de eventos deben ser del mismo nodo")
+
+@app.get(
+    "/events",
+    tags=["Eventos"],
+    summary="Cambios de estado de los dispositivos en vivo (Server-Sent Events)",
+    responses={
+        200: {"description": "Flujo text/event-stream, un evento JSON por cambio", "content": {"text/event-stream": {}}},
+        400: {"description": "Filtros inválidos"}
+    }
+)
+async def stream_events(
+    device_ip: Optional[str] = Query(None, description="IPs separadas por coma (todas si se omite)"),
+    types: Optional[str] = Query(None, description=f"Tipos separados por coma: {', '.join(EVENT_TYPES)}"),
+    since_seq: Optional[int] = Query(None, ge=0, description="Retomar desde este seq (si no, se envía el estado actual)"),
+    last_event_id: Optional[str] = Header(None, description="Retomar desde este seq (lo envía EventSource al reconectar)")
+):
+    """
+    Transmite los cambios de estado observados por la API como Server-Sent
+    Events: conexión (`device`), app en primer plano (`app`), pantalla
+    (`screen`), volumen (`volume`) y batería (`battery`).
+    
+    Al conectarse se envía el último estado conocido de cada tipo y luego un
+    evento por cada cambio. El `id` de cada evento es su `seq`: al
+    reconectar, EventSource envía `Last-Event-ID` y se reciben los eventos
+    perdidos que sigan en el historial (`EVENT_HISTORY`).
+    
+    Suscribirse inicia los vigilantes de los dispositivos, así que app,
+    pantalla y batería llegan sin que nadie consulte el estado.
+    
+    En modo cluster se indica `device_ip` y la petición la atiende el nodo
+    dueño; para recibir los eventos de todos los nodos se usan webhooks.
+    """
+    ips, kinds = event_subscription(device_ip, types)
+    require_local_events(ips)
+    if since_seq is None and last_event_id and last_event_id.isdigit():
+        since_seq = int(last_event_id)
+    
+    async def events():
+        subscription = event_bus.subscribe(ips, kinds, since_seq, keepalive=EVENT_KEEPALIVE)
+        try:
+            async for event in subscription:
+                if event is None:
+                    yield ": keepalive\n\n"
+                else:
+                    yield f"id: {event['seq']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            await subscription.aclose()
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.websocket("/events/ws")
+async def stream_events_ws(
+    websocket: WebSocket,
+    device_ip: Optional[str] = None,
+    types: Optional[str] = None,
+    since_seq: Optional[int] = None
+):
+    """
+    Transmite los cambios de estado por WebSocket: un mensaje JSON por
+    evento, con los mismos filtros que /events.
+    """
+    await websocket.accept()
+    try:
+        ips, kinds = event_subscription(device_ip, types)
+        require_local_events(ips)
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=str(e.detail)[:120])
+        return
+    
+    async def events():
+        subscription = event_bus.subscribe(ips, kinds, since_seq)
+        try:
+            async for event in subscription:
+                yield event
+        finally:
+            await subscription.aclose()
+    
+    await pump_websocket(websocket, events(), websocket.send_json)
+
+@app.get(
+    "/events/state",
+    tags=["Eventos"],
+    summary="Último estado conocido de cada dispositivo",
+    responses={
+        200: {"description": "Último evento de cada tipo por dispositivo"},
+        400: {"description": "Filtros inválidos"}
+    }
+)
+async def get_events_state(
+    device_ip: Optional[str] = Query(None, description="IPs separadas por coma (todas si se omite)"),
+    types: Optional[str] = Query(None, description=f"Tipos separados por coma: {', '.join(EVENT_TYPES)}"),
+    local: bool = Query(False, description="En modo cluster, solo los dispositivos de este nodo")
+):
+    """
+    Retorna el último estado conocido de cada dispositivo desde memoria, sin
+    comandos ADB. **last_seq** sirve para continuar con /events?since_seq=.
+    
+    En modo cluster se juntan los estados de todos los nodos, consultados
+    en paralelo; como cada nodo tiene sus propios seq, **last_seq** es null
+    salvo que todos los dispositivos pedidos sean de un mismo nodo.
+    """
+    try:
+        ips, kinds = event_filter(device_ip, types)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    state = {}
+    for event in event_bus.snapshot(ips, kinds):
+        state.setdefault(event["device"], {})[event["type"]] = {**event["data"], "changed_at": event["timestamp"]}
+    response = {
+        "devices": state,
+        "last_seq": event_bus.last_seq,
+        "timestamp": datetime.now().isoformat()
+    }
+    if local or events_on_this_node(ips):
+        return response
+    
+    params = {"device_ip": device_ip, "types": types, "local": True}
+    results, response["unreachable_nodes"] = await cluster_gather("GET", "/events/state", params)
+    for result in results:
+        state.update(result["devices"])
+    response["last_seq"] = None
+    return response
+
+@app.post(
+    "/webhooks",
+    tags=["Eventos"],
+    summary="Registrar un webhook de eventos",
+    responses={
+        200: {"description": "Webhook registrado"},
+        400: {"description": "URL o filtros inválidos"}
+    }
+)
+async def create_webhook(
+    url: str = Query(..., description="URL http(s) que recibe los eventos por POST"),
+    device_ip: Optional[str] = Query(None, description="IPs separadas por coma (todas si se omite)"),
+    types: Optional[str] = Query(None, description=f"Tipos separados por coma: {', '.join(EVENT_TYPES)}")
+):
+    """
+    Registra una URL que recibe los eventos por POST, agrupados: el cuerpo es
+    `{"events": [...], "dropped": n}`. Los eventos de `WEBHOOK_BATCH_DELAY`
+    segundos viajan en un solo POST; si el destino falla se reintenta con
+    espera exponencial hasta `WEBHOOK_MAX_RETRIES` veces.
+    
+    Los webhooks viven en memoria: para que sobrevivan a un reinicio, usar
+    la variable de entorno `WEBHOOK_URLS`. En modo cluster se guardan en
+    `CLUSTER_DB`: cada nodo envía los eventos de sus dispositivos y los
+    demás nodos lo toman en su próximo heartbeat (`CLUSTER_HEARTBEAT`).
+    """
+    if urlsplit(url).scheme not in ("http", "https") or not urlsplit(url).hostname:
+        raise HTTPException(status_code=400, detail="url debe ser una URL http:// o https://")
+    event_subscription(device_ip, types)
+    webhook = Webhook(url, device_ip, types)
+    if cluster is not None:
+        await cluster.save_webhook(webhook)
+    start_webhook(webhook)
+    return {"status": "success", "webhook": webhook.stats()}
+
+@app.get(
+    "/webhooks",
+    tags=["Eventos"],
+    summary="Listar webhooks de eventos"
+)
+async def list_webhooks(
+    local: bool = Query(False, description="En modo cluster, solo las estadísticas de este nodo")
+):
+    """
+    Lista los webhooks registrados con sus estadísticas de entrega. En modo
+    cluster las estadísticas son la suma de las de todos los nodos.
+    """
+    if cluster is not None:
+        await cluster.sync_webhooks()
+    webhooks = {w.id: w.stats() for w in event_bus.webhooks.values()}
+    response = {"webhooks": list(webhooks.values()), "timestamp": datetime.now().isoformat()}
+    if cluster is None or local:
+        return response
+    
+    results, response["unreachable_nodes"] = await cluster_gather("GET", "/webhooks", {"local": True})
+    for result in results:
+        for remote in result["webhooks"]:
+            stats = webhooks.get(remote["id"])
+            if stats is None:
+                continue
+            for key in ("pending", "delivered", "failed", "dropped"):
+                stats[key] += remote[key]
+            for key in ("last_status", "last_error"):
+                stats[key] = stats[key] if stats[key] is not None else remote[key]
+    return response
+
+@app.delete(
+    "/webhooks/{webhook_id}",
+    tags=["Eventos"],
+    summary="Eliminar un webhook de eventos",
+    responses={
+        200: {"description": "Webhook eliminado"},
+        404: {"description": "Webhook no encontrado"}
+    }
+)
+async def delete_webhook(webhook_id: str):
+    """
+    Elimina un webhook; los eventos pendientes de envío se descartan. En
+    modo cluster se elimina de todos los nodos; los de `WEBHOOK_URLS` se
+    quitan de la variable de entorno.
+    """
+    if cluster is not None:
+        await cluster.sync_webhooks()
+    webhook = event_bus.webhooks.get(webhook_id)
+    if webhook is None:
+        raise HTTPException(status_code=404, detail=f"Webhook '{webhook_id}' no encontrado")
+    if cluster is not None:
+        if webhook.source == "env":
+            raise HTTPException(status_code=409, detail="Webhook de WEBHOOK_URLS: en modo cluster se quita de la variable de entorno")
+        await cluster.delete_webhook(webhook_id)
+    del event_bus.webhooks[webhook_id]
+    await webhook.stop()
+    return {"status": "success", "webhook": webhook.stats()}
+
+@app.post(
+    "/fleet/command",
+    tags=["Flota"],
+    summary="Ejecutar un comando en varios dispositivos",
+    responses={
+        200: {"description": "Un resultado por dispositivo a medida que termina y un resumen final",
+              "content": {"application/x-ndjson": {}, "text/event-stream": {}}},
+        400: {"description": "Selección vacía, etiqueta sin dispositivos o formato inválido"}
+    }
+)
+async def fleet_command(
+    device_ip: Optional[str] = Query(None, description="IPs separadas por coma (ej: '192.168.1.10,192.168.1.11')"),
+    tag: Optional[str] = Query(None, description="Etiquetas separadas por coma; se suman sus dispositivos"),
+    parallelism: Optional[int] = Query(None, ge=1, description=f"Dispositivos a la vez (máximo y default: FLEET_MAX_PARALLEL={FLEET_MAX_PARALLEL})"),
+    format: str = Query("ndjson", description="ndjson (una línea JSON por dispositivo) o sse (Server-Sent Events)"),
+    command: str = Query(..., description="Comando ADB shell a ejecutar")
+):
+    """
+    Ejecuta el mismo comando que `/command` en todos los dispositivos
+    seleccionados (`device_ip` y/o `tag`), en paralelo y con el límite
+    `parallelism`. Cada dispositivo se conecta o reconecta si hace falta.
+    
+    La respuesta se transmite a medida que termina cada dispositivo: una
+    línea `{"type": "result", "device", "status", "status_code", "result" o
+    "error", "elapsed_ms"}` por dispositivo y una línea `{"type": "summary"}`
+    al final. El tiempo total es el del dispositivo más lento, no la suma.
+    """
+    validate_required_params(command=command)
+    return await fleet_response(device_ip, tag, parallelism, format,
+                          fleet_operation("/command", send_custom_command, command=command))
+
+@app.post(
+    "/fleet/play",
+    tags=["Flota"],
+    summary="Reproducir un video en varios dispositivos",
+    responses={
+        200: {"description": "Un resultado por dispositivo a medida que termina y un resumen final",
+              "content": {"application/x-ndjson": {}, "text/event-stream": {}}},
+        400: {"description": "Selección vacía, etiqueta sin dispositivos o formato inválido"}
+    }
+)
+async def fleet_play(
+    device_ip: Optional[str] = Query(None, description="IPs separadas por coma (ej: '192.168.1.10,192.168.1.11')"),
+    tag: Optional[str] = Query(None, description="Etiquetas separadas por coma; se suman sus dispositivos"),
+    parallelism: Optional[int] = Query(None, ge=1, description=f"Dispositivos a la vez (máximo y default: FLEET_MAX_PARALLEL={FLEET_MAX_PARALLEL})"),
+    format: str = Query("ndjson", description="ndjson (una línea JSON por dispositivo) o sse (Server-Sent Events)"),
+    video_url: str = Query(..., description="URL del video de YouTube (youtube.com o youtu.be)")
+):
+    """Reproduce el video (como `/play`) en todos los dispositivos seleccionados"""
+    validate_required_params(video_url=video_url)
+    return await fleet_response(device_ip, tag, parallelism, format,
+                          fleet_operation("/play", play_video, video_url=video_url))
+
+@app.post(
+    "/fleet/stop",
+    tags=["Flota"],
+    summary="Pausar la reproducción en varios dispositivos",
+    responses={
+        200: {"description": "Un resultado por dispositivo a medida que termina y un resumen final",
+              "content": {"application/x-ndjson": {}, "text/event-stream": {}}},
+        400: {"description": "Selección vacía, etiqueta sin dispositivos o formato inválido"}
+    }
+)
+async def fleet_stop(
+    device_ip: Optional[str] = Query(None, description="IPs separadas por coma (ej: '192.168.1.10,192.168.1.11')"),
+    tag: Optional[str] = Query(None, description="Etiquetas separadas por coma; se suman sus dispositivos"),
+    parallelism: Optional[int] = Query(None, ge=1, description=f"Dispositivos a la vez (máximo y default: FLEET_MAX_PARALLEL={FLEET_MAX_PARALLEL})"),
+    format: str = Query("ndjson", description="ndjson (una línea JSON por dispositivo) o sse (Server-Sent Events)")
+):
+    """Pausa la reproducción (como `/stop`) en todos los dispositivos seleccionados"""
+    return await fleet_response(device_ip, tag, parallelism, format, fleet_operation("/stop", stop_video))
+
+@app.post(
+    "/fleet/exit",
+    tags=["Flota"],
+    summary="Salir de la aplicación en varios dispositivos",
+    responses={
+        200: {"description": "Un resultado por dispositivo a medida que termina y un resumen final",
+              "content": {"application/x-ndjson": {}, "text/event-stream": {}}},
+        400: {"description": "Selección vacía, etiqueta sin dispositivos o formato inválido"}
+    }
+)
+async def fleet_exit(
+    device_ip: Optional[str] = Query(None, description="IPs separadas por coma (ej: '192.168.1.10,192.168.1.11')"),
+    tag: Optional[str] = Query(None, description="Etiquetas separadas por coma; se suman sus dispositivos"),
+    parallelism: Optional[int] = Query(None, ge=1, description=f"Dispositivos a la vez (máximo y default: FLEET_MAX_PARALLEL={FLEET_MAX_PARALLEL})"),
+    format: str = Query("ndjson", description="ndjson (una línea JSON por dispositivo) o sse (Server-Sent Events)")
+):
+    """Cierra la aplicación actual (como `/exit`) en todos los dispositivos seleccionados"""
+    return await fleet_response(device_ip, tag, parallelism, format, fleet_operation("/exit", exit_app))
+
+@app.post(
+    "/fleet/volume/set",
+    tags=["Flota"],
+    summary="Establecer el volumen en varios dispositivos",
+    responses={
+        200: {"description": "Un resultado por dispositivo a medida que termina y un resumen final",
+              "content": {"application/x-ndjson": {}, "text/event-stream": {}}},
+        400: {"description": "Selección vacía, etiqueta sin dispositivos o formato inválido"}
+    }
+)
+async def fleet_set_volume(
+    device_ip: Optional[str] = Query(None, description="IPs separadas por coma (ej: '192.168.1.10,192.168.1.11')"),
+    tag: Optional[str] = Query(None, description="Etiquetas separadas por coma; se suman sus dispositivos"),
+    parallelism: Optional[int] = Query(None, ge=1, description=f"Dispositivos a la vez (máximo y default: FLEET_MAX_PARALLEL={FLEET_MAX_PARALLEL})"),
+    format: str = Query("ndjson", description="ndjson (una línea JSON por dispositivo) o sse (Server-Sent Events)"),
+    level: int = Query(..., ge=0, le=15, description="Nivel de volumen (0-15)")
+):
+    """Fija el nivel de volumen (como `/device/volume/set`) en todos los dispositivos seleccionados"""
+    if not isinstance(level, int) or level < 0 or level > 15:
+        raise HTTPException(status_code=400, detail="level debe ser un numero entero entre 0 y 15")
+    return await fleet_response(device_ip, tag, parallelism, format,
+                          fleet_operation("/device/volume/set", set_volume, level=level))
+
+def listen_socket(port: int, host: str = "0.0.0.0") -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+def worker_node_url(node_url: str, private_port: int) -> tuple:
+    """
+    (URL del worker para el cluster, interfaz del puerto privado). Solo en
+    este host basta localhost; con CLUSTER_NODE_URL el worker se anuncia
+    con ese host y su puerto privado, para que lo alcancen los demás hosts.
+    """
+    if not node_url:
+        return f"http://127.0.0.1:{private_port}", "127.0.0.1"
+    parts = urlsplit(node_url)
+    return f"{parts.scheme or 'http'}://{parts.hostname}:{private_port}", "0.0.0.0"
+
+def serve_worker(public_sock: socket.socket, private_port: int):
+    """
+    Worker del modo multiproceso: atiende el puerto público compartido y un
+    puerto privado por el que los demás nodos le reenvían las peticiones de
+    sus dispositivos.
+    """
+    import uvicorn
+    global CLUSTER_NODE_URL
+    CLUSTER_NODE_URL, host = worker_node_url(CLUSTER_NODE_URL, private_port)
+    private_sock = listen_socket(private_port, host)
+    server = uvicorn.Server(uvicorn.Config(app, log_level=os.getenv("LOG_LEVEL", "info").lower()))
+    server.run(sockets=[public_sock, private_sock])
+
+def run_cluster_workers(port: int):
+    """
+    Lanzar CLUSTER_WORKERS procesos que comparten el puerto público (el
+    kernel reparte las conexiones) y se coordinan por CLUSTER_DB. Un worker
+    que muere se reinicia; mientras tanto sus dispositivos pasan a los
+    demás cuando vence su heartbeat.
+    """
+    import multiprocessing
+    context = multiprocessing.get_context("fork")
+    public_sock = listen_socket(port)
+    private_base = int(CLUSTER_WORKER_PORT or port + 1)
+    
+    def spawn(i: int):
+        process = context.Process(target=serve_worker, args=(public_sock, private_base + i), daemon=True)
+        process.start()
+        logger.info(f"Cluster: worker {i} (pid {process.pid}) en el puerto privado {private_base + i}")
+        return process
+    
+    def terminate(signum, frame):
+        sys.exit(0)
+    
+    signal.signal(signal.SIGTERM, terminate)
+    workers = [spawn(i) for i in range(CLUSTER_WORKERS)]
+    try:
+        while True:
+            time.sleep(1)
+            for i, process in enumerate(workers):
+                if not process.is_alive():
+                    logger.warning(f"Cluster: el worker {i} (pid {process.pid}) terminó con código {process.exitcode}, reiniciando")
+                    workers[i] = spawn(i)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in workers:
+            if process.is_alive():
+                process.terminate()
+        for process in workers:
+            process.join(10)
+
 if __name__ == "__main__":
     import uvicorn
-    import os
     port = int(os.getenv("PORT", 9123))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    if CLUSTER_WORKERS > 1:
+        run_cluster_workers(port)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=port)
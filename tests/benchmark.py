@@ -0,0 +1,505 @@
+"""
+Benchmarks de la ADB Control API contra dispositivos ADB simulados.
+
+No requieren un Android real: usan el servidor de tests/fake_adb.py.
+
+Uso:
+    python tests/benchmark.py transport --devices 200 --requests 2000
+    python tests/benchmark.py device-info --latency 0.05
+    python tests/benchmark.py screenshot --png-ms 350 --mbps 100
+    python tests/benchmark.py logcat-parser --lines 100000
+    python tests/benchmark.py app-details --apps 300 --dumpsys-ms 250
+    python tests/benchmark.py reconnect-storm --devices 50 --transport thread
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from fake_adb import FakeAdbServer, device_ips
+
+
+def rss_kb() -> int:
+    """Memoria residente del proceso actual en KB (Linux)"""
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def load_api(**overrides):
+    """Importar main.py sin generar claves y con logging silenciado"""
+    import main
+    logging.getLogger("main").setLevel(logging.WARNING)
+    main.generate_adb_keys = lambda: []
+    for name, value in overrides.items():
+        setattr(main, name, value)
+    return main
+
+
+def print_table(headers, rows):
+    widths = [max(len(str(x)) for x in column) for column in zip(headers, *rows)]
+    for row in [headers, ["-" * w for w in widths], *rows]:
+        print("  ".join(str(x).rjust(w) for x, w in zip(row, widths)))
+
+
+# --------------------------------------------------------------------------- #
+# transport: pool de hilos vs asyncio nativo
+# --------------------------------------------------------------------------- #
+
+def transport_worker(args):
+    """Proceso hijo: conectar N dispositivos y medir memoria y throughput"""
+    main = load_api(ADB_TRANSPORT=args.mode)
+    ips = device_ips(args.devices)
+
+    async def scenario():
+        rss_before = rss_kb()
+        threads_before = threading.active_count()
+        results = await asyncio.gather(*(main.connect_device(ip=ip, port=args.port) for ip in ips))
+        failed = sum(1 for r in results if r["status"] != "success")
+
+        # Peticiones secuenciales por dispositivo, concurrentes entre dispositivos
+        per_device = max(1, args.requests // len(ips))
+
+        async def device_loop(ip):
+            for _ in range(per_device):
+                await main.send_custom_command(device_ip=ip, command="echo ok")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(device_loop(ip) for ip in ips))
+        elapsed = time.perf_counter() - start
+        return {
+            "mode": args.mode,
+            "failed_connects": failed,
+            "kb_per_device": (rss_kb() - rss_before) / len(ips),
+            "threads": threading.active_count() - threads_before,
+            "requests_per_s": per_device * len(ips) / elapsed,
+        }
+
+    print(json.dumps(asyncio.run(scenario())))
+
+
+def bench_transport(args):
+    """Comparar los modos de transporte "thread" y "async" """
+    with FakeAdbServer() as server:
+        for ip in device_ips(args.devices):
+            server.add_device(ip, latency=args.latency)
+
+        rows = []
+        for mode in ("thread", "async"):
+            env = dict(os.environ, ADB_EXECUTOR_WORKERS=str(args.workers))
+            output = subprocess.run(
+                [sys.executable, __file__, "transport-worker", "--mode", mode,
+                 "--port", str(server.port), "--devices", str(args.devices),
+                 "--requests", str(args.requests)],
+                env=env, capture_output=True, text=True, check=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            rows.append([
+                result["mode"], args.devices, result["failed_connects"],
+                f"{result['kb_per_device']:.1f}", result["threads"],
+                f"{result['requests_per_s']:.0f}",
+            ])
+
+    print(f"\n{args.devices} dispositivos, {args.requests} peticiones, "
+          f"latencia {args.latency * 1000:.0f} ms, pool de {args.workers} hilos\n")
+    print_table(["modo", "dispositivos", "fallos", "KB/dispositivo", "hilos", "req/s"], rows)
+
+
+# --------------------------------------------------------------------------- #
+# device-info: 8 comandos separados vs un lote en un solo round trip
+# --------------------------------------------------------------------------- #
+
+def bench_device_info(args):
+    """Comparar /device/info comando a comando vs lote único"""
+    main = load_api()
+    ip = device_ips(1)[0]
+
+    with FakeAdbServer() as server:
+        fake = server.add_device(ip, latency=args.latency)
+
+        async def one_by_one():
+            # Comportamiento anterior: un execute_command por dato
+            device = main.devices[ip]
+            info_commands = [
+                "getprop ro.product.model", "getprop ro.product.manufacturer",
+                "getprop ro.build.version.release", "getprop ro.build.version.sdk",
+                "cat /proc/meminfo | grep MemTotal", "df /data",
+                "getprop ro.serialno", "dumpsys battery | grep 'level'",
+            ]
+            for cmd in info_commands:
+                await device.execute_command(cmd)
+
+        async def batched():
+            await main.get_device_info(device_ip=ip, refresh=True)
+
+        async def cached():
+            await main.get_device_info(device_ip=ip, refresh=False)
+
+        async def measure(func):
+            commands_before = len(fake.commands)
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                await func()
+            elapsed = time.perf_counter() - start
+            return (len(fake.commands) - commands_before) / args.iterations, elapsed / args.iterations
+
+        async def scenario():
+            await main.connect_device(ip=ip, port=server.port)
+            return [
+                ["8 comandos", *await measure(one_by_one)],
+                ["lote único", *await measure(batched)],
+                ["caché", *await measure(cached)],
+            ]
+
+        rows = asyncio.run(scenario())
+
+    print(f"\n/device/info, latencia {args.latency * 1000:.0f} ms por round trip, {args.iterations} iteraciones\n")
+    print_table(
+        ["modo", "round trips", "latencia ms"],
+        [[mode, f"{trips:.2f}", f"{latency * 1000:.1f}"] for mode, trips, latency in rows]
+    )
+
+
+# --------------------------------------------------------------------------- #
+# screenshot: PNG en el dispositivo vs framebuffer en crudo + codificación local
+# --------------------------------------------------------------------------- #
+
+def synthetic_frame(width, height):
+    """Imagen parecida a una interfaz de TV: degradado de fondo y un póster con ruido"""
+    from PIL import Image
+    frame = Image.linear_gradient("L").resize((width, height)).convert("RGBA")
+    poster = Image.effect_noise((width // 3, height // 2), 40).convert("RGBA")
+    frame.paste(poster, (width // 10, height // 4))
+    return frame
+
+
+def bench_screenshot(args):
+    """Comparar latencia y bytes de /screenshot según dónde se codifica la imagen"""
+    import io
+    import struct
+    main = load_api()
+    ip = device_ips(1)[0]
+
+    frame = synthetic_frame(args.width, args.height)
+    raw = struct.pack("<IIII", frame.width, frame.height, 1, 1) + frame.tobytes()
+    png = io.BytesIO()
+    frame.save(png, "PNG")
+    png = png.getvalue()
+
+    def device(service, command):
+        # El dispositivo comprime en PNG (si se pide -p) y envía por la red
+        output = png if command == "screencap -p" else raw
+        if output is png:
+            time.sleep(args.png_ms / 1000)
+        time.sleep(len(output) * 8 / (args.mbps * 1e6))
+        return output
+
+    modes = [
+        ("PNG en dispositivo", dict(format=None, quality=80, width=None), len(png)),
+        ("crudo -> png", dict(format="png", quality=80, width=None), len(raw)),
+        ("crudo -> jpeg q70", dict(format="jpeg", quality=70, width=None), len(raw)),
+        ("crudo -> webp q70", dict(format="webp", quality=70, width=None), len(raw)),
+        ("crudo -> jpeg q70 640px", dict(format="jpeg", quality=70, width=640), len(raw)),
+    ]
+
+    with FakeAdbServer() as server:
+        server.add_device(ip, handler=device)
+
+        async def scenario():
+            await main.connect_device(ip=ip, port=server.port)
+            rows = []
+            for name, params, wire in modes:
+                start = time.perf_counter()
+                for _ in range(args.iterations):
+                    response = await main.get_screenshot(device_ip=ip, changed_since=None, if_none_match=None, **params)
+                elapsed = (time.perf_counter() - start) / args.iterations
+                rows.append([name, f"{wire / 1024:.0f}", f"{len(response.body) / 1024:.0f}", f"{elapsed * 1000:.0f}"])
+            return rows
+
+        rows = asyncio.run(scenario())
+
+    print(f"\n/screenshot {args.width}x{args.height}, PNG en el dispositivo {args.png_ms:.0f} ms, "
+          f"red {args.mbps:.0f} Mbit/s, {args.iterations} iteraciones\n")
+    print_table(["modo", "KB por ADB", "KB respuesta", "latencia ms"], rows)
+
+
+# --------------------------------------------------------------------------- #
+# logcat-parser: parseo threadtime y filtros en el servidor
+# --------------------------------------------------------------------------- #
+
+def synthetic_logcat(lines, seed=1):
+    """Log threadtime sintético con tags, niveles y procesos variados"""
+    import random
+    rng = random.Random(seed)
+    tags = ["ActivityManager", "WindowManager", "AudioFlinger", "chromium", "ExoPlayerImpl",
+            "wpa_supplicant", "NetflixService", "InputDispatcher", "libc", "SurfaceFlinger"]
+    out = ["--------- beginning of main"]
+    for i in range(lines):
+        ms = i * 37
+        out.append(
+            f"10-17 {ms // 3600000 % 24:02}:{ms // 60000 % 60:02}:{ms // 1000 % 60:02}.{ms % 1000:03}"
+            f" {rng.randint(100, 9999):5} {rng.randint(100, 9999):5} {rng.choice('VDDIIIIWWE')}"
+            f" {rng.choice(tags)}: mensaje {i} con datos {rng.getrandbits(64):x} y algo de texto"
+        )
+    return "\n".join(out) + "\n"
+
+
+def bench_logcat_parser(args):
+    """Medir parseo y filtrado de logcat sobre una muestra grande"""
+    main = load_api()
+    output = synthetic_logcat(args.lines)
+
+    def measure(func):
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            result = func()
+            best = min(best, time.perf_counter() - start)
+        return result, best
+
+    def previous():
+        # Comportamiento anterior: lista de líneas opacas
+        return [line for line in output.strip().split("\n") if line.strip()]
+
+    warnings = main.logcat_filter(level="W", pattern=r"datos [0-9a-f]{15}")
+
+    modes = [
+        ("líneas opacas (anterior)", previous),
+        ("parse_logcat", lambda: main.parse_logcat(output)),
+        ("parse + nivel W + regex", lambda: [e for e in main.parse_logcat(output) if warnings(e)]),
+    ]
+    rows = []
+    for name, func in modes:
+        result, elapsed = measure(func)
+        rows.append([name, len(result), f"{elapsed * 1000:.0f}", f"{args.lines / elapsed / 1000:.0f}"])
+
+    entries = [e for e in main.parse_logcat(output) if warnings(e)]
+    full = len(json.dumps(previous()))
+    page = len(json.dumps([main.asdict(e) for e in entries[:100]]))
+
+    print(f"\nlogcat threadtime, {args.lines} líneas ({len(output) / 1e6:.1f} MB), mejor de {args.repeat}\n")
+    print_table(["modo", "resultados", "ms", "miles de líneas/s"], rows)
+    print(f"\nJSON: todas las líneas {full / 1024:.0f} KB, página de 100 filtradas {page / 1024:.1f} KB")
+
+
+# --------------------------------------------------------------------------- #
+# app-details: un `dumpsys package <pkg>` por app vs un volcado en streaming
+# --------------------------------------------------------------------------- #
+
+def synthetic_package_dump(apps):
+    """Volcado de `dumpsys package packages` con el tamaño típico por paquete (~2 KB)"""
+    filler = "".join(f"      android.permission.PERMISSION_{i}: granted=true\n" for i in range(30))
+    yield "Packages:\n"
+    for i in range(apps):
+        yield (
+            f"  Package [com.example.app{i:04d}] (a1b2c3):\n"
+            f"    userId={10000 + i}\n"
+            f"    versionCode={i} minSdk=21 targetSdk=33\n"
+            f"    versionName=1.0.{i}\n"
+            f"    firstInstallTime=2024-01-01 10:00:00\n"
+            f"    lastUpdateTime=2024-02-01 12:30:00\n"
+            f"    installerPackageName=com.android.vending\n"
+            f"    runtime permissions:\n{filler}"
+            f"    User 0: ceDataInode=1 installed=true hidden=false enabled=0\n"
+        )
+
+
+def bench_app_details(args):
+    """Comparar metadatos de apps con un dumpsys por paquete vs uno solo para todas"""
+    main = load_api()
+    ip = device_ips(1)[0]
+    dump = "".join(synthetic_package_dump(args.apps))
+    names = [f"com.example.app{i:04d}" for i in range(args.apps)]
+
+    def device(service, command):
+        # Cada dumpsys arranca un proceso en el dispositivo
+        if command.startswith("dumpsys package"):
+            time.sleep(args.dumpsys_ms / 1000)
+        if command == main.PACKAGE_DETAILS_COMMAND:
+            return (dump[i:i + 65536] for i in range(0, len(dump), 65536))
+        if command == main.PACKAGE_LIST_COMMANDS["third_party"]:
+            return "".join(f"package:/data/app/{n}/base.apk={n} uid:{10000 + i}\n" for i, n in enumerate(names))
+        if command.startswith("dumpsys package "):
+            name = command.split()[2]
+            return dump[dump.index(f"[{name}]"):dump.index("User 0:", dump.index(f"[{name}]"))]
+        return ""
+
+    with FakeAdbServer() as server:
+        server.add_device(ip, handler=device, stream_interval=0)
+
+        async def per_package():
+            connection = main.devices[ip]
+            for name in names[:args.sample]:
+                await connection.execute_command(f"dumpsys package {name}", read_only=True)
+            return len(names) / args.sample
+
+        async def bulk():
+            await main.get_installed_apps(device_ip=ip, limit=500, offset=0, prefix=None, system=None,
+                                          sort="name", refresh=True, details=True)
+            return 1
+
+        async def scenario():
+            await main.connect_device(ip=ip, port=server.port)
+            rows = []
+            for name, func in (("dumpsys por paquete (extrapolado)", per_package), ("volcado único en streaming", bulk)):
+                start = time.perf_counter()
+                scale = await func()
+                rows.append([name, f"{(time.perf_counter() - start) * scale:.2f}"])
+            return rows
+
+        rows = asyncio.run(scenario())
+
+    print(f"\nMetadatos de {args.apps} apps ({len(dump) / 1e6:.1f} MB de volcado), "
+          f"{args.dumpsys_ms:.0f} ms por invocación de dumpsys\n")
+    print_table(["modo", "segundos"], rows)
+
+
+# --------------------------------------------------------------------------- #
+# reconnect-storm: handshake con claves por conexión vs firmante compartido
+# --------------------------------------------------------------------------- #
+
+def write_adb_key(directory):
+    """Crear adbkey/adbkey.pub en el directorio (con cryptography si está, es mucho más rápido)"""
+    path = os.path.join(directory, "adbkey")
+    try:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+    except ImportError:
+        from adb_shell.auth.keygen import keygen
+        keygen(path)
+        return path
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    with open(path, "wb") as private:
+        private.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                        serialization.NoEncryption()))
+    with open(path + ".pub", "w") as public:
+        public.write("QAAAA benchmark@adb-api\n")
+    return path
+
+
+def bench_reconnect_storm(args):
+    """N dispositivos que se reconectan a la vez (p. ej. tras un corte de red) con autenticación RSA"""
+    import main as api
+    generate_adb_keys, load_adb_keys = api.generate_adb_keys, api.load_adb_keys
+    main = load_api(ADB_TRANSPORT=args.transport)
+    main.generate_adb_keys = generate_adb_keys
+    ips = device_ips(args.devices)
+    modes = [
+        ("claves por conexión + python-rsa (antes)", "python", False),
+        ("firmante compartido + python-rsa", "python", True),
+        ("firmante compartido + cryptography", "cryptography", True),
+    ]
+
+    with tempfile.TemporaryDirectory() as keys_dir, FakeAdbServer(require_auth=True) as server:
+        write_adb_key(keys_dir)
+        main.ADB_KEYS_DIR = keys_dir
+        for ip in ips:
+            server.add_device(ip)
+
+        async def storm():
+            """Conectar todos a la vez midiendo también el retraso máximo del event loop"""
+            lag = 0.0
+            done = asyncio.Event()
+
+            async def monitor():
+                nonlocal lag
+                while not done.is_set():
+                    start = time.perf_counter()
+                    await asyncio.sleep(0.005)
+                    lag = max(lag, time.perf_counter() - start - 0.005)
+
+            watcher = asyncio.ensure_future(monitor())
+            connections = [main.DeviceConnection(ip, server.port) for ip in ips]
+            start = time.perf_counter()
+            results = await asyncio.gather(*(c.connect() for c in connections))
+            elapsed = time.perf_counter() - start
+            done.set()
+            await watcher
+            assert all(r["status"] == "success" for r in results), results[0]
+            for connection in connections:
+                await connection.disconnect()
+            return elapsed, lag
+
+        rows = []
+        for name, signer, shared in modes:
+            main.ADB_SIGNER = signer
+            main.adb_keys = []
+            # Antes cada conexión nueva leía adbkey y construía su firmante
+            main.load_adb_keys = load_adb_keys if shared else generate_adb_keys
+            runs = [asyncio.run(storm()) for _ in range(args.rounds)]
+            elapsed = statistics.median(r[0] for r in runs)
+            rows.append([name, f"{elapsed:.2f}", f"{elapsed / len(ips) * 1000:.1f}",
+                         f"{max(r[1] for r in runs) * 1000:.0f}"])
+
+    print(f"\n{len(ips)} dispositivos reconectando a la vez, transporte {args.transport}, "
+          f"mediana de {args.rounds} tormentas\n")
+    print_table(["modo", "segundos", "ms por dispositivo", "retraso máx. event loop (ms)"], rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    transport = sub.add_parser("transport", help="Pool de hilos vs asyncio nativo")
+    transport.add_argument("--devices", type=int, default=200)
+    transport.add_argument("--requests", type=int, default=2000)
+    transport.add_argument("--latency", type=float, default=0.02)
+    transport.add_argument("--workers", type=int, default=32)
+    transport.set_defaults(func=bench_transport)
+
+    worker = sub.add_parser("transport-worker", help=argparse.SUPPRESS)
+    worker.add_argument("--mode", required=True)
+    worker.add_argument("--port", type=int, required=True)
+    worker.add_argument("--devices", type=int, required=True)
+    worker.add_argument("--requests", type=int, required=True)
+    worker.set_defaults(func=transport_worker)
+
+    device_info = sub.add_parser("device-info", help="/device/info: 8 round trips vs lote único")
+    device_info.add_argument("--latency", type=float, default=0.05)
+    device_info.add_argument("--iterations", type=int, default=20)
+    device_info.set_defaults(func=bench_device_info)
+
+    screenshot = sub.add_parser("screenshot", help="/screenshot: PNG en el dispositivo vs crudo + codificación local")
+    screenshot.add_argument("--width", type=int, default=1920)
+    screenshot.add_argument("--height", type=int, default=1080)
+    screenshot.add_argument("--png-ms", type=float, default=350,
+                            help="Tiempo que tarda el dispositivo en comprimir el PNG")
+    screenshot.add_argument("--mbps", type=float, default=100, help="Ancho de banda hasta el dispositivo")
+    screenshot.add_argument("--iterations", type=int, default=3)
+    screenshot.set_defaults(func=bench_screenshot)
+
+    logcat_parser = sub.add_parser("logcat-parser", help="Parseo y filtrado de logcat en el servidor")
+    logcat_parser.add_argument("--lines", type=int, default=100000)
+    logcat_parser.add_argument("--repeat", type=int, default=3)
+    logcat_parser.set_defaults(func=bench_logcat_parser)
+
+    app_details = sub.add_parser("app-details", help="/device/installed-apps?details=true: dumpsys por paquete vs único")
+    app_details.add_argument("--apps", type=int, default=300)
+    app_details.add_argument("--dumpsys-ms", type=float, default=250,
+                             help="Tiempo de arranque de cada dumpsys en el dispositivo")
+    app_details.add_argument("--sample", type=int, default=20,
+                             help="Paquetes medidos de a uno (el resto se extrapola)")
+    app_details.set_defaults(func=bench_app_details)
+
+    reconnect_storm = sub.add_parser("reconnect-storm", help="Handshake RSA: claves por conexión vs firmante compartido")
+    reconnect_storm.add_argument("--devices", type=int, default=50)
+    reconnect_storm.add_argument("--transport", choices=["thread", "async"], default="thread")
+    reconnect_storm.add_argument("--rounds", type=int, default=3)
+    reconnect_storm.set_defaults(func=bench_reconnect_storm)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
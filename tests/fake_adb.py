@@ -0,0 +1,231 @@
+"""
+Servidor ADB simulado para pruebas sin dispositivo real.
+
+Implementa lo mínimo del protocolo ADB sobre TCP (CNXN, AUTH, OPEN, WRTE, OKAY,
+CLSE) para que ``AdbDeviceTcp`` pueda conectarse y ejecutar comandos shell.
+Cada dirección de loopback (127.0.0.X) se comporta como un dispositivo
+distinto, con su propia latencia y sus propias respuestas.
+"""
+
+import asyncio
+import os
+import re
+import sys
+import threading
+from pathlib import Path
+
+from adb_shell import constants
+from adb_shell.adb_message import AdbMessage, unpack
+
+# Permitir importar src/main.py desde las pruebas y benchmarks
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+if str(SRC_DIR) not in sys.path:
+    sys.path.insert(0, str(SRC_DIR))
+
+WRTE_CHUNK = 4096
+
+# Lotes generados por main.build_batch_script
+BATCH_SECTION = re.compile(
+    r"echo '(@@\w+:\d+@@)'\n\(\n(.*?)\n\)\nrc=\$\?; echo; echo \"(@@\w+:\d+:)\$rc(@@)\""
+    r"(; \[ \$rc -eq 0 \] \|\| exit \$rc)?",
+    re.S
+)
+
+
+class FakeDevice:
+    """Dispositivo simulado: responde comandos shell con una latencia fija"""
+
+    def __init__(self, latency: float = 0.0, responses: dict = None, handler=None, stream_interval: float = 0.01):
+        self.latency = latency
+        self.stream_interval = stream_interval
+        self.responses = dict(responses or {})
+        self.handler = handler
+        self.commands = []
+        self.connections = 0
+        self.signatures = 0
+        self.active_streams = 0
+        self.max_active_streams = 0
+
+    def respond(self, service: str, command: str) -> bytes:
+        """Obtener la salida de un comando (o de un lote de comandos)"""
+        sections = BATCH_SECTION.findall(command)
+        if sections:
+            output = b""
+            for begin, cmd, end_prefix, end_suffix, stop_on_error in sections:
+                section_output, exit_code = self.run(service, cmd)
+                output += f"{begin}\n".encode() + section_output
+                output += f"\n{end_prefix}{exit_code}{end_suffix}\n".encode()
+                if stop_on_error and exit_code != 0:
+                    break
+            return output
+        return self.run(service, command)[0]
+
+    def run(self, service: str, command: str) -> tuple:
+        """
+        Ejecutar un comando simple: (salida, código de salida).
+        Si la respuesta es un iterable de bloques (p. ej. un generador), la
+        salida se envía de a un bloque cada stream_interval segundos, como un
+        comando de larga duración.
+        """
+        if self.handler:
+            output = self.handler(service, command)
+        elif command in self.responses:
+            output = self.responses[command]
+        elif command.startswith("echo "):
+            output = command[5:].strip("'\"") + "\n"
+        else:
+            output = ""
+        output, exit_code = output if isinstance(output, tuple) else (output, 0)
+        if isinstance(output, str):
+            output = output.encode("utf8")
+        elif not isinstance(output, bytes):
+            output = (c.encode("utf8") if isinstance(c, str) else c for c in output)
+        return output, exit_code
+
+
+class FakeAdbServer:
+    """Servidor ADB simulado que corre en un hilo con su propio event loop"""
+
+    def __init__(self, host: str = "0.0.0.0", port: int = 0, require_auth: bool = False):
+        self.host = host
+        self.port = port
+        # Con require_auth el CNXN se responde con un token AUTH que el cliente
+        # debe firmar (se acepta cualquier firma)
+        self.require_auth = require_auth
+        self.devices = {}
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._started = threading.Event()
+        self._error = None
+        self._writers = set()
+
+    def add_device(self, ip: str, **kwargs) -> FakeDevice:
+        """Registrar un dispositivo simulado en la IP indicada"""
+        device = FakeDevice(**kwargs)
+        self.devices[ip] = device
+        return device
+
+    def start(self):
+        """Arrancar el servidor en segundo plano"""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._started.wait(5)
+        if self._error:
+            raise self._error
+        return self
+
+    def stop(self):
+        """Detener el servidor"""
+        if self._loop and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread:
+            self._thread.join(5)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port)
+            )
+        except OSError as e:
+            self._error = e
+            self._started.set()
+            self._loop.close()
+            return
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._started.set()
+        self._loop.run_forever()
+        self._server.close()
+        # Cerrar las conexiones abiertas para que cada handler termine solo
+        for writer in self._writers:
+            writer.close()
+        self._loop.run_until_complete(asyncio.sleep(0.05))
+        pending = asyncio.all_tasks(self._loop)
+        for task in pending:
+            task.cancel()
+        self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        self._loop.close()
+
+    async def _handle(self, reader, writer):
+        ip = writer.get_extra_info("sockname")[0]
+        device = self.devices.setdefault(ip, FakeDevice())
+        device.connections += 1
+        self._writers.add(writer)
+        streams = {}
+        next_id = 1
+
+        def send(command, arg0, arg1, data=b""):
+            msg = AdbMessage(command, arg0, arg1, data)
+            writer.write(msg.pack() + data)
+
+        try:
+            while True:
+                header = await reader.readexactly(constants.MESSAGE_SIZE)
+                cmd, arg0, arg1, length, _ = unpack(header)
+                data = await reader.readexactly(length) if length else b""
+                command = constants.WIRE_TO_ID.get(cmd)
+
+                if command == constants.CNXN and self.require_auth:
+                    send(constants.AUTH, constants.AUTH_TOKEN, 0, os.urandom(20))
+                elif command == constants.CNXN or (command == constants.AUTH and arg0 == constants.AUTH_SIGNATURE):
+                    if command == constants.AUTH:
+                        device.signatures += 1
+                    send(constants.CNXN, constants.VERSION, constants.MAX_ADB_DATA, b"device::ro.product.name=fake;\0")
+                elif command == constants.OPEN:
+                    remote_id = next_id
+                    next_id += 1
+                    destination = data.rstrip(b"\0").decode("utf8")
+                    service, _, shell_cmd = destination.partition(":")
+                    send(constants.OKAY, remote_id, arg0)
+                    streams[remote_id] = asyncio.ensure_future(
+                        self._run_stream(device, send, writer, streams, remote_id, arg0, service, shell_cmd)
+                    )
+                elif command == constants.CLSE:
+                    task = streams.pop(arg1, None)
+                    if task and not task.done():
+                        task.cancel()
+                        send(constants.CLSE, arg1, arg0)
+                # OKAY no requiere respuesta en este servidor simulado
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in streams.values():
+                task.cancel()
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _run_stream(self, device, send, writer, streams, remote_id, local_id, service, command):
+        device.commands.append(command)
+        device.active_streams += 1
+        device.max_active_streams = max(device.max_active_streams, device.active_streams)
+        try:
+            if device.latency:
+                await asyncio.sleep(device.latency)
+            output = device.respond(service, command)
+            if isinstance(output, bytes):
+                for i in range(0, len(output), WRTE_CHUNK):
+                    send(constants.WRTE, remote_id, local_id, output[i:i + WRTE_CHUNK])
+            else:
+                for chunk in output:
+                    send(constants.WRTE, remote_id, local_id, chunk)
+                    await writer.drain()
+                    await asyncio.sleep(device.stream_interval)
+            streams.pop(remote_id, None)
+            send(constants.CLSE, remote_id, local_id)
+            await writer.drain()
+        finally:
+            device.active_streams -= 1
+
+
+def device_ips(count: int, start: int = 2) -> list:
+    """Generar IPs de loopback distintas para simular varios dispositivos"""
+    return [f"127.0.{n // 256}.{n % 256}" for n in range(start, start + count)]
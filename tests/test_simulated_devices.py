@@ -0,0 +1,1831 @@
+"""
+Pruebas de la API contra dispositivos ADB simulados (tests/fake_adb.py).
+
+No requieren un Android real: cada IP 127.0.0.X es un dispositivo distinto
+servido por FakeAdbServer.
+"""
+
+import asyncio
+import io
+import socket
+import json
+import struct
+import subprocess
+import time
+
+import pytest
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from PIL import Image
+
+from fake_adb import FakeAdbServer, device_ips
+
+import main
+
+
+@pytest.fixture(params=main.ADB_TRANSPORT_MODES)
+def adb_server(request, monkeypatch):
+    """Servidor ADB simulado y registro limpio, en cada modo de transporte"""
+    monkeypatch.setattr(main, "generate_adb_keys", lambda: [])
+    monkeypatch.setattr(main, "ADB_TRANSPORT", request.param)
+    monkeypatch.setattr(main, "event_bus", main.EventBus())
+    main.devices.clear()
+    main.registry_locks.clear()
+    main.foreground_watchers.clear()
+    server = FakeAdbServer().start()
+    yield server
+    main.devices.clear()
+    main.registry_locks.clear()
+    main.foreground_watchers.clear()
+    server.stop()
+
+
+async def connect_all(server, ips):
+    results = await asyncio.gather(*(main.connect_device(ip=ip, port=server.port) for ip in ips))
+    assert all(r["status"] == "success" for r in results), results
+    assert all(main.devices[ip].transport == main.ADB_TRANSPORT for ip in ips)
+
+
+def test_concurrent_requests_take_time_of_slowest_device(adb_server):
+    """20 peticiones a 20 dispositivos tardan lo que el más lento, no la suma"""
+    ips = device_ips(20)
+    latencies = [0.05 * (i + 1) for i in range(len(ips))]
+    for ip, latency in zip(ips, latencies):
+        adb_server.add_device(ip, latency=latency)
+
+    async def scenario():
+        await connect_all(adb_server, ips)
+        start = time.perf_counter()
+        results = await asyncio.gather(*(
+            main.send_custom_command(device_ip=ip, command="echo ok") for ip in ips
+        ))
+        return time.perf_counter() - start, results
+
+    elapsed, results = asyncio.run(scenario())
+
+    assert all(r["result"]["output"].strip() == "ok" for r in results)
+    slowest, total = max(latencies), sum(latencies)
+    assert elapsed < slowest * 2, f"{elapsed:.2f}s (más lento {slowest:.2f}s, suma {total:.2f}s)"
+
+
+def test_app_can_start_again_after_shutdown(monkeypatch):
+    """Apagar libera el pool de hilos ADB; un segundo arranque crea otro"""
+    monkeypatch.setattr(main, "load_adb_keys", lambda: [])
+
+    async def lifespan():
+        await main.startup_event()
+        pool = main.adb_executor
+        result = await main.run_blocking(sum, [1, 2])
+        await main.shutdown_event()
+        return pool, result
+
+    first, first_result = asyncio.run(lifespan())
+    second, second_result = asyncio.run(lifespan())
+
+    assert first_result == second_result == 3
+    assert first is not second and main.adb_executor is None
+
+
+def test_cancelled_request_does_not_mix_next_command_output(adb_server):
+    """Cancelar una petición a mitad del comando no deja su respuesta al siguiente"""
+    ip = device_ips(1)[0]
+    adb_server.add_device(ip, latency=0.3)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        first = asyncio.ensure_future(main.send_custom_command(device_ip=ip, command="echo first"))
+        await asyncio.sleep(0.1)
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        results = [await main.send_custom_command(device_ip=ip, command=f"echo {word}") for word in ("second", "third")]
+        return first.cancelled(), results
+
+    cancelled, results = asyncio.run(scenario())
+
+    assert cancelled
+    assert [r["result"]["output"].strip() for r in results] == ["second", "third"]
+
+
+def test_slow_device_does_not_block_event_loop(adb_server):
+    """Un dumpsys lento en un dispositivo no retrasa a otro dispositivo"""
+    slow_ip, fast_ip = device_ips(2)
+    adb_server.add_device(slow_ip, latency=1.5)
+    adb_server.add_device(fast_ip, latency=0.0)
+
+    async def scenario():
+        await connect_all(adb_server, [slow_ip, fast_ip])
+        slow = asyncio.ensure_future(main.send_custom_command(device_ip=slow_ip, command="dumpsys"))
+        await asyncio.sleep(0.1)
+        start = time.perf_counter()
+        await main.get_status(device_ip=fast_ip, refresh=True)
+        fast_elapsed = time.perf_counter() - start
+        await slow
+        return fast_elapsed
+
+    assert asyncio.run(scenario()) < 0.5
+
+
+def test_commands_to_same_device_are_serialized(adb_server):
+    """Peticiones concurrentes al mismo TV no intercalan paquetes en el socket"""
+    ip = device_ips(1)[0]
+    fake = adb_server.add_device(ip, latency=0.02)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        return await asyncio.gather(*(
+            main.send_custom_command(device_ip=ip, command=f"echo {i}") for i in range(10)
+        ))
+
+    results = asyncio.run(scenario())
+
+    assert [r["result"]["output"].strip() for r in results] == [str(i) for i in range(10)]
+    assert fake.max_active_streams == 1
+    assert fake.connections == 1
+    stats = main.devices[ip].queue_stats()
+    assert stats["depth"] == 0 and stats["max_wait_ms"] > 0
+
+
+def test_full_queue_returns_429(adb_server, monkeypatch):
+    """Con ADB_MAX_QUEUE alcanzado las peticiones extra reciben 429"""
+    monkeypatch.setattr(main, "ADB_MAX_QUEUE", 2)
+    ip = device_ips(1)[0]
+    adb_server.add_device(ip, latency=0.2)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        return await asyncio.gather(*(
+            main.send_custom_command(device_ip=ip, command="echo ok") for _ in range(4)
+        ), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+
+    rejected = [r for r in results if isinstance(r, HTTPException)]
+    assert len(rejected) == 2 and all(r.status_code == 429 for r in rejected)
+
+
+def test_first_requests_share_one_auto_connection(request, monkeypatch):
+    """Dos primeras peticiones a un TV nuevo abren una sola conexión"""
+    monkeypatch.setattr(main, "generate_adb_keys", lambda: [])
+    main.devices.clear()
+    main.registry_locks.clear()
+    try:
+        server = FakeAdbServer(port=5555).start()
+    except OSError:
+        pytest.skip("puerto 5555 ocupado")
+    request.addfinalizer(server.stop)
+    request.addfinalizer(main.devices.clear)
+    ip = device_ips(1)[0]
+    fake = server.add_device(ip)
+
+    async def scenario():
+        return await asyncio.gather(*(main.get_status(device_ip=ip, refresh=False) for _ in range(5)))
+
+    results = asyncio.run(scenario())
+
+    assert all(r["connected"] for r in results)
+    assert fake.connections == 1
+
+
+def test_read_only_commands_use_parallel_channels(adb_server, monkeypatch):
+    """Con varios canales las lecturas van en paralelo y las teclas por el canal principal"""
+    monkeypatch.setattr(main, "ADB_CHANNELS_PER_DEVICE", 4)
+    ip = device_ips(1)[0]
+    fake = adb_server.add_device(ip, latency=0.2, responses={
+        "pm list packages -f -U -s": "package:/system/app/a.apk=a uid:1000\n",
+        "pm list packages -f -U -3": "package:/data/app/b/base.apk=b uid:10050\n",
+    })
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        start = time.perf_counter()
+        apps, info, volume = await asyncio.gather(
+            main.get_installed_apps(**installed_apps_params(ip)),
+            main.get_device_info(device_ip=ip, refresh=False),
+            main.increase_volume(device_ip=ip, steps=3),
+        )
+        return time.perf_counter() - start, apps, info, volume
+
+    elapsed, apps, info, volume = asyncio.run(scenario())
+
+    assert [a["is_system_app"] for a in apps["apps"]] == [True, False]
+    assert "battery_info" in info["info"] and "errors" not in info
+    assert volume["status"] == "success"
+    # getprop, las 3 lecturas y las teclas en serie tardarían 5 × 200 ms
+    assert elapsed < 1.0
+    assert fake.max_active_streams > 1
+    assert main.devices[ip].queue_stats()["channels"] == fake.connections
+    keys = [c for c in fake.commands if "input keyevent" in c]
+    assert len(keys) == 1 and keys[0].count("KEYCODE_VOLUME_UP") == 3
+
+
+def test_device_info_uses_one_round_trip_and_cache(adb_server, monkeypatch):
+    """/device/info: un solo comando shell, luego caché hasta reconectar"""
+    ip = device_ips(1)[0]
+    fake = adb_server.add_device(ip, responses={
+        "getprop": "[ro.product.model]: [BRAVIA 4K]\n[ro.build.version.sdk]: [28]\n",
+        "df /data": "Filesystem 1K-blocks\n/data 100\n",
+    })
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        first = await main.get_device_info(device_ip=ip, refresh=False)
+        second = await main.get_device_info(device_ip=ip, refresh=False)
+        commands_cached = len(fake.commands)
+        monkeypatch.setattr(main, "VOLATILE_CACHE_TTL", 0)
+        await main.get_device_info(device_ip=ip, refresh=False)
+        volatile_only = fake.commands[-1]
+        await main.devices[ip].disconnect()
+        await main.devices[ip].connect()
+        await main.get_device_info(device_ip=ip, refresh=False)
+        return first, second, commands_cached, volatile_only
+
+    first, second, commands_cached, volatile_only = asyncio.run(scenario())
+
+    assert commands_cached == 1
+    assert first["info"]["model"] == "BRAVIA 4K"
+    assert first["info"]["api_level"] == "28"
+    assert first["info"]["storage_info"] == "Filesystem 1K-blocks\n/data 100"
+    assert "errors" not in first
+    assert not first["cached"] and second["cached"]
+    assert second["info"] == first["info"]
+    assert "\ngetprop\n" not in volatile_only and "df /data" in volatile_only
+    assert "\ngetprop\n" in fake.commands[-1]
+
+
+def test_device_info_reports_failing_section_without_caching_it(adb_server):
+    """Una sección con código de salida != 0 va a errors y se vuelve a pedir"""
+    ip = device_ips(1)[0]
+    fake = adb_server.add_device(ip, responses={
+        "getprop": "[ro.product.model]: [BRAVIA 4K]\n",
+        "df /data": ("df: /data: Permission denied", 1),
+    })
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        first = await main.get_device_info(device_ip=ip, refresh=False)
+        fake.responses["df /data"] = "Filesystem 1K-blocks\n/data 100\n"
+        second = await main.get_device_info(device_ip=ip, refresh=False)
+        return first, second, fake.commands[-1]
+
+    first, second, retried = asyncio.run(scenario())
+
+    assert first["errors"] == {"storage_info": "df: /data: Permission denied"}
+    assert "storage_info" not in first["info"] and first["info"]["model"] == "BRAVIA 4K"
+    assert not second["cached"] and "errors" not in second
+    assert second["info"]["storage_info"] == "Filesystem 1K-blocks\n/data 100"
+    assert "df /data" in retried and "\ngetprop\n" not in retried and "MemTotal" not in retried
+
+
+def test_batch_output_reports_incomplete_sections():
+    """Una sección cortada se informa como error sin afectar a las demás"""
+    output = "@@t:0@@\nok\n\n@@t:0:0@@\n@@t:1@@\npartial"
+    first, second = main.parse_batch_output(output, 2, "t")
+    assert first == {"status": "success", "output": "ok\n", "exit_code": 0}
+    assert second["status"] == "error"
+
+
+def test_batch_script_stops_on_error_in_shell():
+    """El script real de sh corta en el primer comando fallido con stop_on_error"""
+    script = main.build_batch_script(["echo a", "false", "echo c"], "t", stop_on_error=True)
+    output = subprocess.run(["sh", "-c", script], capture_output=True, text=True).stdout
+    first, second, third = main.parse_batch_output(output, 3, "t")
+    assert first["output"] == "a\n" and second["exit_code"] == 1
+    assert third["status"] == "error"
+
+
+def test_batch_script_isolates_comments_and_quotes():
+    """Un comentario o comillas en un comando no afectan a los demás"""
+    commands = ["echo a # comentario", "echo \"b 'c'\" 'd \"e\"'", "echo f"]
+    script = main.build_batch_script(commands, "t")
+    output = subprocess.run(["sh", "-c", script], capture_output=True, text=True).stdout
+    sections = main.parse_batch_output(output, 3, "t")
+    assert [s["output"] for s in sections] == ["a\n", "b 'c' d \"e\"\n", "f\n"]
+    assert [s["exit_code"] for s in sections] == [0, 0, 0]
+
+
+def installed_apps_params(ip, **params):
+    defaults = dict(device_ip=ip, limit=20, offset=0, prefix=None, system=None, sort="name", refresh=False, details=False)
+    return {**defaults, **params}
+
+
+class FakePackageManager:
+    """Gestor de paquetes simulado: listados de `pm` y marca de cambios de packages.xml"""
+
+    def __init__(self, system, third_party):
+        self.system = dict(system)
+        self.third_party = dict(third_party)
+        self.stamp = 1700000000
+
+    def install(self, name, uid):
+        self.third_party[name] = uid
+        self.stamp += 1
+
+    def dumpsys(self):
+        """Volcado de `dumpsys package packages`, en bloques como un comando largo"""
+        yield "Activity Resolver Table:\n  Non-Data Actions:\n\nPackages:\n"
+        for name, uid in {**self.system, **self.third_party}.items():
+            yield (
+                f"  Package [{name}] (1a2b3c):\n"
+                f"    userId={uid}\n"
+                f"    versionCode={uid} minSdk=21 targetSdk=33\n"
+                f"    versionName=1.{uid}\n"
+                f"    firstInstallTime=2024-01-01 10:00:00\n"
+                f"    lastUpdateTime=2024-02-0{len(name) % 9 + 1} 12:30:00\n"
+                f"    installerPackageName={'null' if name in self.system else 'com.android.vending'}\n"
+                f"    User 0: ceDataInode=1 installed=true hidden=false enabled={3 if uid == 10080 else 0}\n"
+            )
+        yield "\nHidden system packages:\n  Package [android] (9f9f):\n    versionName=0.factory\n"
+
+    def __call__(self, service, command):
+        if command == main.PACKAGE_DETAILS_COMMAND:
+            return self.dumpsys()
+        if command == main.PACKAGES_STAMP_COMMAND:
+            return f"{self.stamp}\n"
+        for key, packages in (("system", self.system), ("third_party", self.third_party)):
+            if command == main.PACKAGE_LIST_COMMANDS[key]:
+                root = "/system/app" if key == "system" else "/data/app/~~x=="
+                return "".join(f"package:{root}/{name}/base.apk={name} uid:{uid}\n" for name, uid in packages.items())
+        return ""
+
+
+def test_parse_package_list():
+    output = "package:/data/app/~~ab==/com.app-1/base.apk=com.app uid:10123\npackage:/system/app/x.apk=x uid:1000,1001\n"
+
+    packages = main.parse_package_list(output, is_system_app=False)
+
+    assert [(p.package_name, p.apk_path, p.uid) for p in packages] == [
+        ("com.app", "/data/app/~~ab==/com.app-1/base.apk", 10123),
+        ("x", "/system/app/x.apk", 1000),
+    ]
+
+
+def test_installed_apps_index_search_sort_and_pages(adb_server):
+    ip = device_ips(1)[0]
+    pm = FakePackageManager(
+        {"android": 1000, "com.android.settings": 1000, "com.google.android.gms": 10010},
+        {"com.google.android.youtube": 10100, "com.netflix.mediaclient": 10090, "org.videolan.vlc": 10080},
+    )
+    fake = adb_server.add_device(ip, handler=pm)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        pages = [
+            await main.get_installed_apps(**installed_apps_params(ip, prefix="com.", limit=2)),
+            await main.get_installed_apps(**installed_apps_params(ip, prefix="com.", limit=2, offset=2)),
+            await main.get_installed_apps(**installed_apps_params(ip, system=False, sort="-uid")),
+        ]
+        return pages
+
+    first, second, third_party = asyncio.run(scenario())
+
+    assert first["total_apps"] == 4 and first["next_offset"] == 2
+    assert [a["package_name"] for a in first["apps"] + second["apps"]] == [
+        "com.android.settings", "com.google.android.gms", "com.google.android.youtube", "com.netflix.mediaclient",
+    ]
+    assert second["next_offset"] is None
+    assert [a["uid"] for a in third_party["apps"]] == [10100, 10090, 10080]
+    assert not any(a["is_system_app"] for a in third_party["apps"])
+    # Un solo round trip para construir el índice; las demás consultas salen de memoria
+    assert len([c for c in fake.commands if "pm list packages" in c]) == 1
+
+
+def test_package_details_parser_reads_packages_section():
+    parser = main.PackageDetailsParser()
+    pm = FakePackageManager({"android": 1000}, {"org.videolan.vlc": 10080})
+    for line in "".join(pm.dumpsys()).splitlines():
+        parser.feed(line)
+
+    assert set(parser.details) == {"android", "org.videolan.vlc"}
+    vlc = parser.details["org.videolan.vlc"]
+    assert (vlc.version_name, vlc.version_code, vlc.target_sdk) == ("1.10080", 10080, 33)
+    assert vlc.last_update_time == "2024-02-08 12:30:00"
+    assert vlc.installer == "com.android.vending" and vlc.enabled is False
+    # Los "Hidden system packages" no pisan la versión instalada
+    assert parser.details["android"].version_name == "1.1000"
+    assert parser.details["android"].installer is None
+
+
+def test_installed_apps_details_use_one_dumpsys_per_index(adb_server):
+    ip = device_ips(1)[0]
+    pm = FakePackageManager({"android": 1000}, {"org.videolan.vlc": 10080})
+    fake = adb_server.add_device(ip, handler=pm, stream_interval=0.001)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        first, second = await asyncio.gather(*(
+            main.get_installed_apps(**installed_apps_params(ip, details=True)) for _ in range(2)
+        ))
+        third = await main.get_installed_apps(**installed_apps_params(ip, details=True, refresh=True))
+        return first, second, third
+
+    first, second, third = asyncio.run(scenario())
+
+    assert first == {**second, "timestamp": first["timestamp"]}
+    details = {a["package_name"]: a["details"] for a in first["apps"]}
+    assert details["org.videolan.vlc"]["version_code"] == 10080
+    assert details["android"]["enabled"] is True
+    assert third["apps"][1]["details"]["version_name"] == "1.10080"
+    # Peticiones simultáneas comparten el volcado; reconstruir el índice lo descarta
+    assert fake.commands.count(main.PACKAGE_DETAILS_COMMAND) == 2
+
+
+def test_installed_apps_index_refreshes_only_on_change(adb_server, monkeypatch):
+    monkeypatch.setattr(main, "PACKAGES_CACHE_TTL", 0)
+    ip = device_ips(1)[0]
+    pm = FakePackageManager({"android": 1000}, {"org.videolan.vlc": 10080})
+    fake = adb_server.add_device(ip, handler=pm)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        await main.get_installed_apps(**installed_apps_params(ip))
+        unchanged = await main.get_installed_apps(**installed_apps_params(ip))
+        builds = len([c for c in fake.commands if "pm list packages" in c])
+        pm.install("com.netflix.mediaclient", 10090)
+        changed = await main.get_installed_apps(**installed_apps_params(ip))
+        return builds, unchanged, changed
+
+    builds, unchanged, changed = asyncio.run(scenario())
+
+    # Sin cambios en packages.xml solo se consulta la marca, no `pm`
+    assert builds == 1
+    assert unchanged["total_apps"] == 2
+    assert changed["total_apps"] == 3
+    assert changed["index"]["added"] == ["com.netflix.mediaclient"]
+    assert changed["index"]["removed"] == []
+
+
+class FakeTvVolume:
+    """Simula el volumen STREAM_MUSIC de un TV para el handler de FakeDevice"""
+
+    def __init__(self, sdk=30, level=5, maximum=15, supports_cmd=True, supports_media=True):
+        self.sdk = sdk
+        self.level = level
+        self.maximum = maximum
+        self.supports_cmd = supports_cmd
+        self.supports_media = supports_media
+        self.input_calls = 0
+
+    def __call__(self, service, command):
+        if command == "getprop":
+            return f"[ro.build.version.sdk]: [{self.sdk}]\n"
+        if command.startswith("cmd media_session volume"):
+            if not self.supports_cmd:
+                return "/system/bin/sh: cmd: not found\n", 127
+            self.level = int(command.split()[-1])
+            return ""
+        if command.startswith("media volume"):
+            if not self.supports_media:
+                return "/system/bin/sh: media: not found\n", 127
+            self.level = int(command.split()[-1])
+            return ""
+        if command.startswith("dumpsys audio"):
+            return (
+                "- STREAM_RING:\n   Muted: false\n   Min: 0\n   Max: 7\n"
+                "   Current: 2 (speaker): 5, 40000000 (default): 5\n   Devices: speaker\n"
+                "- STREAM_MUSIC:\n   Muted: false\n   Min: 0\n"
+                f"   Max: {self.maximum}\n   streamVolume:{self.level}\n"
+                f"   Current: 2 (speaker): 4, 400 (hdmi): {self.level}, 40000000 (default): 4\n"
+                "   Devices: hdmi\n"
+            )
+        if command.startswith("input keyevent"):
+            self.input_calls += 1
+            for key in command.split()[2:]:
+                if key == "KEYCODE_VOLUME_UP":
+                    self.level = min(self.maximum, self.level + 1)
+                elif key == "KEYCODE_VOLUME_DOWN":
+                    self.level = max(0, self.level - 1)
+        return ""
+
+
+def run_volume(adb_server, tv, action):
+    ip = device_ips(1)[0]
+    fake = adb_server.add_device(ip, handler=tv)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        return await action(ip)
+
+    return fake, asyncio.run(scenario())
+
+
+def test_set_volume_uses_single_command_and_reads_back(adb_server):
+    tv = FakeTvVolume(sdk=30, level=2)
+    fake, result = run_volume(adb_server, tv, lambda ip: main.set_volume(device_ip=ip, level=9))
+
+    assert result["method"] == "media_session"
+    assert result["volume"] == {"name": "music", "level": 9, "min": 0, "max": 15, "muted": False, "device": "hdmi"}
+    assert tv.level == 9 and tv.input_calls == 0
+    # getprop (una vez por conexión) + un lote con set y estado
+    assert len(fake.commands) == 2
+
+
+def test_set_volume_uses_media_command_before_android_11(adb_server):
+    tv = FakeTvVolume(sdk=28, level=2)
+    fake, result = run_volume(adb_server, tv, lambda ip: main.set_volume(device_ip=ip, level=6))
+
+    assert result["method"] == "media" and tv.level == 6
+    assert not any("media_session" in command for command in fake.commands)
+
+
+def test_set_volume_falls_back_from_media_session_to_media(adb_server):
+    tv = FakeTvVolume(sdk=30, level=2, supports_cmd=False)
+
+    async def action(ip):
+        first = await main.set_volume(device_ip=ip, level=7)
+        second = await main.set_volume(device_ip=ip, level=8)
+        return first, second
+
+    fake, (first, second) = run_volume(adb_server, tv, action)
+
+    assert first["method"] == "media" and second["method"] == "media"
+    assert tv.level == 8 and tv.input_calls == 0
+    assert sum("media_session" in command for command in fake.commands) == 1
+
+
+def test_set_volume_falls_back_to_one_keyevent_invocation(adb_server):
+    tv = FakeTvVolume(sdk=30, level=12, supports_cmd=False, supports_media=False)
+    _, result = run_volume(adb_server, tv, lambda ip: main.set_volume(device_ip=ip, level=4))
+
+    assert result["status"] == "success" and result["method"] == "keyevent"
+    assert tv.level == 4 and tv.input_calls == 1
+    assert result["volume"]["level"] == 4
+
+
+def test_increase_volume_sends_all_steps_at_once(adb_server):
+    tv = FakeTvVolume(sdk=28, level=3)
+    _, result = run_volume(adb_server, tv, lambda ip: main.increase_volume(device_ip=ip, steps=4))
+
+    assert result["volume"]["level"] == 7
+    assert tv.input_calls == 1
+
+
+def test_volume_change_refreshes_cached_state(adb_server):
+    """Tras fijar el volumen, /device/volume/current responde sin otro round trip"""
+    tv = FakeTvVolume(sdk=30, level=2)
+
+    async def action(ip):
+        await main.set_volume(device_ip=ip, level=11)
+        return await main.get_current_volume(device_ip=ip, refresh=False)
+
+    fake, result = run_volume(adb_server, tv, action)
+
+    assert result["cached"] is True
+    assert result["volume_info"]["music"]["level"] == 11
+    assert result["volume_info"]["ring"] == {"name": "ring", "level": 5, "min": 0, "max": 7, "muted": False, "device": "speaker"}
+    assert len(fake.commands) == 2
+
+
+def test_parse_audio_streams_legacy_format():
+    """Formato de Android 7: sin Min ni streamVolume, con Mute count"""
+    output = (
+        "- STREAM_MUSIC:\n"
+        "   Mute count: 1\n"
+        "   Max: 15\n"
+        "   Current: 2: 11, 400: 8, 40000000: 6\n"
+        "   Devices: 400\n"
+        "Ringer mode:\n"
+    )
+    music = main.parse_audio_streams(output)["music"]
+    assert (music.level, music.min, music.max, music.muted, music.device) == (8, 0, 15, True, "400")
+
+
+def screenshot(ip, **params):
+    """Llamar a /screenshot con los valores por defecto de sus parámetros"""
+    defaults = dict(format=None, quality=80, width=None, changed_since=None, if_none_match=None)
+    return main.get_screenshot(device_ip=ip, **{**defaults, **params})
+
+
+def test_screenshot_is_captured_in_memory_with_exec_out(adb_server, tmp_path, monkeypatch):
+    """La captura viaja en bytes por exec-out, sin archivos en el dispositivo ni en disco"""
+    ip = device_ips(1)[0]
+    png = main.PNG_SIGNATURE + bytes(range(256)) * 400
+    fake = adb_server.add_device(ip, responses={"screencap -p": png})
+    monkeypatch.chdir(tmp_path)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        return await asyncio.gather(*(screenshot(ip) for _ in range(3)))
+
+    responses = asyncio.run(scenario())
+
+    assert all(r.body == png and r.media_type == "image/png" for r in responses)
+    assert fake.commands == ["screencap -p"] * 3
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_screenshot_without_png_returns_503(adb_server):
+    ip = device_ips(1)[0]
+    adb_server.add_device(ip, responses={"screencap -p": "screencap: permission denied\n"})
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        return await screenshot(ip)
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(scenario())
+    assert exc.value.status_code == 503 and "permission denied" in exc.value.detail
+
+
+def raw_frame(width, height, pixel_format=1, header_size=16):
+    """Salida de `screencap` en crudo: cabecera + píxeles de 4 bytes"""
+    header = struct.pack("<IIII", width, height, pixel_format, 1)[:header_size]
+    return header + bytes(
+        value for y in range(height) for x in range(width) for value in (x * 7 % 256, y * 5 % 256, 128, 255)
+    )
+
+
+@pytest.mark.parametrize("header_size", [12, 16])
+def test_parse_raw_screencap(header_size):
+    image = main.parse_raw_screencap(raw_frame(4, 3, header_size=header_size))
+    assert image.size == (4, 3) and image.getpixel((1, 2)) == (7, 10, 128, 255)
+
+    with pytest.raises(ValueError):
+        main.parse_raw_screencap(raw_frame(4, 3)[:-1])
+
+
+def test_screenshot_raw_frame_is_encoded_on_server(adb_server):
+    """Con format se pide el framebuffer en crudo y se codifica en el servidor"""
+    ip = device_ips(1)[0]
+    fake = adb_server.add_device(ip, responses={"screencap": raw_frame(64, 36)})
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        return await screenshot(ip, format="jpeg", quality=70, width=32)
+
+    response = asyncio.run(scenario())
+
+    assert response.media_type == "image/jpeg"
+    image = Image.open(io.BytesIO(response.body))
+    assert image.format == "JPEG" and image.size == (32, 18)
+    assert fake.commands == ["screencap"]
+
+
+def test_screenshot_rejects_unknown_format(adb_server):
+    ip = device_ips(1)[0]
+    fake = adb_server.add_device(ip)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        return await screenshot(ip, format="gif")
+
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(scenario())
+    assert exc.value.status_code == 400 and fake.commands == []
+
+
+def test_screen_stream_shares_one_capture_loop(adb_server, monkeypatch):
+    """Dos espectadores del mismo dispositivo comparten capturas y codificación"""
+    monkeypatch.setattr(main, "STREAM_MAX_FPS", 50)
+    ip = device_ips(1)[0]
+    fake = adb_server.add_device(ip, responses={"screencap": raw_frame(32, 18)})
+
+    async def watch(frames):
+        response = await main.stream_screenshot(device_ip=ip, fps=50, quality=70, width=None)
+        parts = []
+        async for part in response.body_iterator:
+            parts.append(part)
+            if len(parts) == frames:
+                break
+        await response.body_iterator.aclose()
+        return parts
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        parts = await asyncio.gather(watch(10), watch(10))
+        await asyncio.sleep(0.1)
+        return parts
+
+    parts = asyncio.run(scenario())
+
+    for viewer in parts:
+        assert all(p.startswith(b"--frame\r\nContent-Type: image/jpeg\r\n") for p in viewer)
+        jpeg = viewer[0].split(b"\r\n\r\n", 1)[1][:-2]
+        assert Image.open(io.BytesIO(jpeg)).size == (32, 18)
+    # Un único bucle: las capturas no se duplican por espectador
+    assert fake.commands.count("screencap") <= 13
+    # Sin espectadores el bucle se detiene y se da de baja
+    assert ip not in main.frame_streams
+
+
+def test_screen_stream_skips_frames_for_slow_viewer(adb_server, monkeypatch):
+    """Un espectador lento recibe el último frame, sin cola de frames atrasados"""
+    monkeypatch.setattr(main, "STREAM_MAX_FPS", 50)
+    ip = device_ips(1)[0]
+    adb_server.add_device(ip, responses={"screencap": raw_frame(8, 8)})
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        stream, viewer, first = await main.open_frame_stream(ip, 50, 70, None)
+        seqs = [first[0]]
+        frames = stream.frames(viewer, 70, None, first)
+        await frames.__anext__()
+        for _ in range(3):
+            await asyncio.sleep(0.2)
+            await frames.__anext__()
+            seqs.append(stream.encoded[(70, None)][0])
+        await frames.aclose()
+        stream.unsubscribe(viewer)
+        return seqs
+
+    seqs = asyncio.run(scenario())
+    assert all(b - a > 1 for a, b in zip(seqs, seqs[1:])), seqs
+
+
+def test_screen_stream_does_not_delay_control_commands(adb_server, monkeypatch):
+    """Las capturas van por su propia conexión: un comando no espera al frame en curso"""
+    monkeypatch.setattr(main, "STREAM_MAX_FPS", 50)
+    ip = device_ips(1)[0]
+    frame = raw_frame(64, 36)
+
+    def handler(service, command):
+        if command == "screencap":
+            # Frame lento: 10 bloques, uno cada 50 ms
+            return (frame[i:i + len(frame) // 10 + 1] for i in range(0, len(frame), len(frame) // 10 + 1))
+        return command[5:] + "\n" if command.startswith("echo ") else ""
+
+    fake = adb_server.add_device(ip, handler=handler, stream_interval=0.05)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        stream, viewer, first = await main.open_frame_stream(ip, 50, 70, None)
+        await asyncio.sleep(0.1)
+        start = time.perf_counter()
+        result = await main.send_custom_command(device_ip=ip, command="echo ok")
+        elapsed = time.perf_counter() - start
+        connections = fake.connections
+        stream.unsubscribe(viewer)
+        await asyncio.gather(stream.task, return_exceptions=True)
+        return result, elapsed, connections, stream.channel
+
+    result, elapsed, connections, channel = asyncio.run(scenario())
+
+    assert result["result"]["output"].strip() == "ok"
+    assert elapsed < 0.3, f"{elapsed:.2f}s"
+    assert connections == 2 and channel is None
+
+
+def test_screenshot_unchanged_frame_returns_304(adb_server):
+    """Con If-None-Match, una pantalla sin cambios responde 304 sin cuerpo"""
+    ip = device_ips(1)[0]
+    screen = {"frame": raw_frame(16, 9)}
+    adb_server.add_device(ip, handler=lambda service, command: screen["frame"])
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        first = await screenshot(ip, format="jpeg")
+        etag = first.headers["etag"]
+        unchanged = await screenshot(ip, format="jpeg", if_none_match=f'"other", W/{etag}')
+        other_variant = await screenshot(ip, format="webp", if_none_match=etag)
+        screen["frame"] = raw_frame(16, 9, pixel_format=5)
+        changed = await screenshot(ip, format="jpeg", if_none_match=etag)
+        return etag, unchanged, other_variant, changed
+
+    etag, unchanged, other_variant, changed = asyncio.run(scenario())
+
+    assert unchanged.status_code == 304 and unchanged.body == b"" and unchanged.headers["etag"] == etag
+    assert other_variant.status_code == 200 and other_variant.headers["etag"] != etag
+    assert changed.status_code == 200 and changed.headers["etag"] != etag
+
+
+def test_screenshot_changed_since_reports_regions(adb_server):
+    """changed_since compara con el frame anterior y retorna las celdas cambiadas"""
+    ip = device_ips(1)[0]
+    screen = {"frame": raw_frame(64, 32)}
+    adb_server.add_device(ip, handler=lambda service, command: screen["frame"])
+
+    def draw(frame, x, y):
+        # Cambiar un píxel del framebuffer (cabecera de 16 bytes, RGBA)
+        offset = 16 + (y * 64 + x) * 4
+        return frame[:offset] + bytes([255 - frame[offset]]) + frame[offset + 1:]
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        base = await screenshot(ip, changed_since="")
+        same = await screenshot(ip, changed_since=base["etag"])
+        screen["frame"] = draw(screen["frame"], 50, 20)
+        diff = await screenshot(ip, changed_since=same["etag"])
+        unknown = await screenshot(ip, changed_since='"0000-0000"')
+        return base, same, diff, unknown
+
+    base, same, diff, unknown = asyncio.run(scenario())
+
+    assert same["changed"] is False and same["regions"] == []
+    assert diff["changed"] is True
+    assert diff["regions"] == [{"x": 48, "y": 20, "width": 8, "height": 4}]
+    assert unknown["regions"] == [{"x": 0, "y": 0, "width": 64, "height": 32}]
+
+
+class FakeLogcat:
+    """
+    logcat -T simulado: cabecera, línea previa (salvo con -T desde la hora del
+    dispositivo) y luego líneas nuevas sin fin
+    """
+
+    def __init__(self):
+        self.produced = 0
+
+    def __call__(self, service, command):
+        if command == main.DEVICE_CLOCK_COMMAND:
+            return "10-17 12:00:00.500\n"
+        if command.startswith("logcat"):
+            return self.lines(previous="-T '" not in command)
+        return command[5:] + "\n" if command.startswith("echo ") else ""
+
+    def lines(self, previous):
+        yield b"--------- beginning of main\n"
+        if previous:
+            yield b"10-17 12:00:00.000  100  100 I Previa: linea vieja\n"
+        while True:
+            self.produced += 1
+            level = "E" if self.produced % 3 == 0 else "I"
+            line = f"10-17 12:00:01.000  100  200 {level} Tag: linea {self.produced} ñ\n".encode()
+            # Líneas partidas entre bloques, incluso a mitad de un carácter UTF-8
+            yield line[:-3]
+            yield line[-3:]
+
+
+def test_logcat_stream_yields_lines_and_stops_device_process(adb_server):
+    ip = device_ips(1)[0]
+    logcat = FakeLogcat()
+    fake = adb_server.add_device(ip, handler=logcat, stream_interval=0.005)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        response = await main.stream_device_logcat(device_ip=ip, tail=0, filter_text=None)
+        events = []
+        async for event in response.body_iterator:
+            events.append(event)
+            if len(events) == 4:
+                # La conexión principal sigue libre mientras corre logcat
+                status = await main.send_custom_command(device_ip=ip, command="echo ok")
+                assert status["result"]["output"].strip() == "ok"
+            if len(events) == 6:
+                break
+        await response.body_iterator.aclose()
+        await asyncio.sleep(0.2)
+        return events
+
+    events = asyncio.run(scenario())
+
+    assert events[0] == "data: --------- beginning of main\n\n"
+    assert events[1] == "data: 10-17 12:00:01.000  100  200 I Tag: linea 1 ñ\n\n"
+    assert [e.split("linea ")[1].split()[0] for e in events[1:]] == ["1", "2", "3", "4", "5"]
+    assert "logcat -v threadtime -T '10-17 12:00:00.500'" in fake.commands
+    assert fake.active_streams == 0
+    produced = logcat.produced
+    time.sleep(0.1)
+    assert logcat.produced == produced
+
+
+def test_logcat_stream_filters_on_server(adb_server):
+    ip = device_ips(1)[0]
+    adb_server.add_device(ip, handler=FakeLogcat(), stream_interval=0.001)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        response = await main.stream_device_logcat(device_ip=ip, tail=5, filter_text=" E Tag")
+        events = []
+        async for event in response.body_iterator:
+            events.append(event)
+            if len(events) == 3:
+                break
+        await response.body_iterator.aclose()
+        return events
+
+    events = asyncio.run(scenario())
+    assert [e.split("linea ")[1].split()[0] for e in events] == ["3", "6", "9"]
+
+
+LOGCAT_SAMPLE = (
+    "--------- beginning of main\n"
+    "10-17 12:00:00.100  100  101 I ActivityManager: Start proc 4321:com.netflix/u0a12\n"
+    "10-17 12:00:01.200  100  102 W WindowManager: Slow input: 250ms\n"
+    "10-17 12:00:02.300  200  200 E AndroidRuntime: FATAL EXCEPTION: main\n"
+    "10-17 12:00:03.400  200  201 D tag with spaces: value: 1\n"
+    "10-17 12:00:04.500  100  101 I ActivityManager: Displayed com.netflix/.Home\n"
+)
+
+
+def test_parse_logcat_threadtime():
+    entries = main.parse_logcat(LOGCAT_SAMPLE)
+    assert len(entries) == 5
+    assert entries[2] == main.LogcatEntry("10-17 12:00:02.300", 200, 200, "E", "AndroidRuntime", "FATAL EXCEPTION: main")
+    assert (entries[3].tag, entries[3].message) == ("tag with spaces", "value: 1")
+
+
+def test_logcat_filter_and_command():
+    entries = main.parse_logcat(LOGCAT_SAMPLE)
+
+    def select(**kwargs):
+        matches = main.logcat_filter(**kwargs)
+        return [e.timestamp[-6:] for e in entries if matches(e)]
+
+    assert select(level="W") == ["01.200", "02.300"]
+    assert select(tags=["ActivityManager"], pattern=r"com\.netflix/\.") == ["04.500"]
+    assert select(pid=200, until="10-17 12:00:02") == ["02.300"]
+    assert select(since="10-17 12:00:03.400", text="value") == ["03.400"]
+    with pytest.raises(ValueError):
+        main.logcat_filter(pattern="(")
+    with pytest.raises(ValueError):
+        main.logcat_filter(since="ayer")
+
+    assert main.logcat_command(50) == "logcat -v threadtime -t 50"
+    assert main.logcat_command(50, "w", ["ActivityManager"], "10-17 12:00:00") == (
+        "logcat -v threadtime -t '10-17 12:00:00.000' ActivityManager:W '*:S'"
+    )
+
+
+def test_logcat_endpoint_filters_and_paginates(adb_server):
+    ip = device_ips(1)[0]
+    fake = adb_server.add_device(ip, handler=lambda service, command: LOGCAT_SAMPLE if command.startswith("logcat") else "")
+
+    async def fetch(**params):
+        defaults = dict(lines=50, filter_text=None, level=None, tag=None, pid=None, regex=None,
+                        since=None, until=None, offset=0, limit=100)
+        return await main.get_device_logcat(device_ip=ip, **{**defaults, **params})
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        first = await fetch(tag="ActivityManager", limit=1)
+        second = await fetch(tag="ActivityManager", limit=1, offset=first["next_offset"])
+        with pytest.raises(HTTPException) as exc:
+            await fetch(regex="[")
+        return first, second, exc.value
+
+    first, second, error = asyncio.run(scenario())
+
+    assert first["total_lines"] == 2 and first["next_offset"] == 1
+    assert first["entries"][0]["message"] == "Start proc 4321:com.netflix/u0a12"
+    assert second["entries"][0]["message"] == "Displayed com.netflix/.Home" and second["next_offset"] is None
+    assert error.status_code == 400
+    assert fake.commands[-1] == "logcat -v threadtime -t 50 ActivityManager:V '*:S'"
+
+
+def buffer_params(**params):
+    defaults = dict(since_seq=0, limit=500, filter_text=None, level=None, tag=None, pid=None, regex=None)
+    return {**defaults, **params}
+
+
+def test_logcat_collector_serves_new_lines_from_memory(adb_server):
+    ip = device_ips(1)[0]
+    fake = adb_server.add_device(ip, handler=FakeLogcat(), stream_interval=0.002)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        started = await main.set_logcat_collector(device_ip=ip, enabled=True)
+        await asyncio.sleep(0.3)
+        commands = len(fake.commands)
+        first = await main.get_logcat_buffer(device_ip=ip, **buffer_params(limit=5))
+        second = await main.get_logcat_buffer(device_ip=ip, **buffer_params(since_seq=first["next_seq"], level="E"))
+        served_from_memory = len(fake.commands) == commands
+        await main.set_logcat_collector(device_ip=ip, enabled=False)
+        await asyncio.sleep(0.1)
+        return started, first, second, served_from_memory
+
+    started, first, second, served_from_memory = asyncio.run(scenario())
+
+    assert started["collector"]["running"] is True
+    assert served_from_memory
+    assert [e["seq"] for e in first["entries"]] == [1, 2, 3, 4, 5] and first["next_seq"] == 5
+    assert first["entries"][0]["tag"] == "Previa"
+    assert second["entries"] and all(e["level"] == "E" and e["seq"] > 5 for e in second["entries"])
+    assert second["next_seq"] == second["last_seq"]
+    assert ip not in main.logcat_collectors and fake.active_streams == 0
+
+
+def test_logcat_collector_evicts_by_size_and_age(monkeypatch):
+    collector = main.LogcatCollector("127.0.0.2")
+    entry = main.LogcatEntry("10-17 12:00:00.000", 1, 1, "I", "Tag", "x" * 104)
+    monkeypatch.setattr(main, "LOGCAT_BUFFER_BYTES", 1000)
+    for _ in range(20):
+        collector.append(entry)
+
+    result = collector.fetch(0, 100, lambda e: True)
+    assert collector.size <= 1000 and len(collector.entries) == 4
+    assert result["first_seq"] == 17 and result["missed"] is True
+    assert collector.fetch(20, 100, lambda e: True) == {
+        "entries": [], "next_seq": 20, "first_seq": 17, "last_seq": 20, "missed": False
+    }
+
+    monkeypatch.setattr(main, "LOGCAT_BUFFER_MAX_AGE", 0)
+    assert collector.fetch(18, 100, lambda e: True)["entries"] == []
+    assert collector.stats()["lines"] == 0 and collector.stats()["evicted"] == 20
+
+
+class FakeForegroundApp:
+    """Foco de ventana y eventos de actividad reanudada de `logcat -b events`"""
+
+    def __init__(self, package, activity):
+        self.focus = (package, activity)
+        self.events = []
+
+    def switch(self, package, activity):
+        self.focus = (package, activity)
+        self.events.append(f"I/wm_set_resumed_activity( 1234): [0,{package}/{activity},resumeTopActivity]\n")
+
+    def screen(self, on):
+        self.events.append(f"I/screen_toggled( 1234): {int(on)}\n")
+
+    def __call__(self, service, command):
+        if command == main.FOREGROUND_QUERY_COMMAND:
+            package, activity = self.focus
+            return f"  mCurrentFocus=Window{{1a2b3c u0 {package}/{package}{activity}}}\n"
+        if command == main.DEVICE_CLOCK_COMMAND:
+            return "10-17 22:45:58.000\n"
+        if command == main.FOREGROUND_WATCH_COMMAND.format(since="'10-17 22:45:58.000'"):
+            return self.stream()
+        if command.startswith("dumpsys package "):
+            return "    versionCode=42 minSdk=21 targetSdk=33\n"
+        return ""
+
+    def stream(self):
+        # Con -T desde la hora de la consulta no llegan eventos anteriores
+        while True:
+            yield self.events.pop(0) if self.events else "\n"
+
+
+def test_parse_foreground_component():
+    focus = "mCurrentFocus=Window{1a2b u0 com.google.android.youtube.tv/com.google.android.apps.youtube.tv.activity.ShellActivity}"
+    event = "I/wm_set_resumed_activity( 1234): [0,com.netflix.ninja/.MainActivity,resumeTopActivity]"
+
+    assert main.parse_foreground_component(focus) == (
+        "com.google.android.youtube.tv", "com.google.android.apps.youtube.tv.activity.ShellActivity")
+    assert main.parse_foreground_component(event) == ("com.netflix.ninja", "com.netflix.ninja.MainActivity")
+    assert main.parse_foreground_component("mCurrentFocus=null") == (None, None)
+
+
+def test_current_app_is_served_by_watcher(adb_server):
+    ip = device_ips(1)[0]
+    tv = FakeForegroundApp("com.android.tv.launcher", ".Launcher")
+    fake = adb_server.add_device(ip, handler=tv, stream_interval=0.005)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        first = await main.get_current_app(device_ip=ip)
+        polls = [await main.get_current_app(device_ip=ip) for _ in range(5)]
+        tv.switch("com.netflix.ninja", ".MainActivity")
+        await asyncio.sleep(0.2)
+        switched = await main.get_current_app(device_ip=ip)
+        await main.disconnect_device(device_ip=ip)
+        return first, polls, switched
+
+    first, polls, switched = asyncio.run(scenario())
+
+    assert first["current_app"]["package"] == "com.android.tv.launcher"
+    assert first["current_app"]["info"]["version_info"] == "versionCode=42 minSdk=21 targetSdk=33"
+    assert all(p["current_app"] == first["current_app"] and p["source"] == "watcher" for p in polls)
+    assert switched["current_app"]["activity"] == "com.netflix.ninja.MainActivity"
+    # Un solo dumpsys de foco y uno de versión por app, sin importar cuántas consultas
+    assert len([c for c in fake.commands if main.FOREGROUND_QUERY_COMMAND in c]) == 1
+    # Los eventos se siguen desde la hora de la consulta y el primero no se descarta
+    assert "logcat -b events -v brief -T '10-17 22:45:58.000' " in " ".join(fake.commands)
+    assert len([c for c in fake.commands if c.startswith("dumpsys package")]) == 2
+    assert ip not in main.foreground_watchers and fake.active_streams == 0
+
+
+def test_current_app_stream_emits_changes(adb_server):
+    ip = device_ips(1)[0]
+    tv = FakeForegroundApp("com.android.tv.launcher", ".Launcher")
+    adb_server.add_device(ip, handler=tv, stream_interval=0.005)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        response = await main.stream_current_app(device_ip=ip)
+        events = []
+        async for event in response.body_iterator:
+            events.append(event)
+            if len(events) == 1:
+                tv.switch("com.netflix.ninja", ".MainActivity")
+                # Volver a la misma actividad no es un cambio
+                tv.switch("com.netflix.ninja", ".MainActivity")
+                tv.switch("com.google.android.youtube.tv", ".Shell")
+            if len(events) == 3:
+                break
+        await response.body_iterator.aclose()
+        watcher = main.foreground_watchers[ip]
+        subscribers = len(watcher.subscribers)
+        await main.stop_foreground_watcher(ip)
+        return events, subscribers
+
+    events, subscribers = asyncio.run(scenario())
+
+    states = [json.loads(e.split("data: ", 1)[1]) for e in events]
+    assert all(e.startswith("event: app\n") for e in events)
+    assert [s["package"] for s in states] == [
+        "com.android.tv.launcher", "com.netflix.ninja", "com.google.android.youtube.tv"]
+    assert [s["seq"] for s in states] == [1, 2, 3]
+    assert subscribers == 0
+
+
+def test_current_app_without_watcher_queries_device(adb_server, monkeypatch):
+    monkeypatch.setattr(main, "FOREGROUND_WATCHER", False)
+    ip = device_ips(1)[0]
+    fake = adb_server.add_device(ip, handler=FakeForegroundApp("com.android.tv.launcher", ".Launcher"))
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        return [await main.get_current_app(device_ip=ip) for _ in range(2)]
+
+    results = asyncio.run(scenario())
+
+    assert [r["source"] for r in results] == ["query", "query"]
+    assert results[1]["current_app"]["activity"] == "com.android.tv.launcher.Launcher"
+    assert fake.commands.count(main.FOREGROUND_QUERY_COMMAND) == 2
+    assert not any(c.startswith("logcat -b events") for c in fake.commands)
+
+
+def test_event_bus_streams_state_changes(adb_server):
+    ip = device_ips(1)[0]
+    tv = FakeForegroundApp("com.android.tv.launcher", ".Launcher")
+    adb_server.add_device(ip, handler=tv, stream_interval=0.005)
+
+    async def scenario():
+        response = await main.stream_events(device_ip=None, types=None, since_seq=None, last_event_id=None)
+        events = response.body_iterator
+        received = []
+
+        async def read(count):
+            while len(received) < count:
+                chunk = await events.__anext__()
+                if not chunk.startswith(":"):
+                    received.append(chunk)
+
+        reader = asyncio.ensure_future(read(2))
+        await asyncio.sleep(0.05)
+        # Con un suscriptor activo, conectar inicia el vigilante del dispositivo
+        await connect_all(adb_server, [ip])
+        await asyncio.wait_for(reader, 5)
+        tv.screen(False)
+        await asyncio.wait_for(read(3), 5)
+        tv.switch("com.netflix.ninja", ".MainActivity")
+        await asyncio.wait_for(read(4), 5)
+        await events.aclose()
+        state = await main.get_events_state(device_ip=ip, types=None, local=False)
+        # Retomar desde un seq: solo los eventos posteriores, del historial
+        resumed = await main.stream_events(device_ip=ip, types="app", since_seq=None, last_event_id="2")
+        replay = await resumed.body_iterator.__anext__()
+        await resumed.body_iterator.aclose()
+        await main.stop_foreground_watcher(ip)
+        return received, state, replay
+
+    received, state, replay = asyncio.run(scenario())
+
+    parsed = [json.loads(e.split("data: ", 1)[1]) for e in received]
+    assert [(e["type"], e["data"]) for e in parsed] == [
+        ("device", {"connected": True}),
+        ("app", {"package": "com.android.tv.launcher", "activity": "com.android.tv.launcher.Launcher"}),
+        ("screen", {"on": False}),
+        ("app", {"package": "com.netflix.ninja", "activity": "com.netflix.ninja.MainActivity"}),
+    ]
+    assert received[0].startswith("id: 1\nevent: device\n")
+    assert state["devices"][ip]["screen"]["on"] is False
+    assert state["devices"][ip]["app"]["package"] == "com.netflix.ninja"
+    assert json.loads(replay.split("data: ", 1)[1])["seq"] == 4
+
+
+def test_event_bus_publishes_only_changes():
+    bus = main.EventBus()
+    bus.update("10.0.0.1", "volume", {"level": 5, "max": 15, "muted": False})
+    bus.update("10.0.0.1", "volume", {"level": 5, "max": 15, "muted": False})
+    bus.update("10.0.0.1", "volume", {"level": 6, "max": 15, "muted": False})
+
+    assert [e["data"]["level"] for e in bus.history] == [5, 6]
+    with pytest.raises(ValueError):
+        main.event_filter(types="app,clima")
+
+
+def test_webhook_batches_and_retries(monkeypatch):
+    monkeypatch.setattr(main, "event_bus", main.EventBus())
+    monkeypatch.setattr(main, "WEBHOOK_BATCH_DELAY", 0.05)
+    monkeypatch.setattr(main, "WEBHOOK_RETRY_BASE", 0.01)
+    requests = []
+
+    async def handle(reader, writer):
+        headers = await reader.readuntil(b"\r\n\r\n")
+        length = int(headers.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+        requests.append(json.loads(await reader.readexactly(length)))
+        # El primer intento falla: el lote se reintenta completo
+        status = b"500 Internal Server Error" if len(requests) == 1 else b"204 No Content"
+        writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Length: 0\r\n\r\n")
+        await writer.drain()
+        writer.close()
+
+    async def scenario():
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        result = await main.create_webhook(url=f"http://127.0.0.1:{port}/hook", device_ip=None, types="volume,app")
+        for level in range(3):
+            main.event_bus.update("10.0.0.1", "volume", {"level": level, "max": 15, "muted": False})
+        main.event_bus.update("10.0.0.1", "screen", {"on": True})
+        await asyncio.sleep(0.3)
+        stats = (await main.list_webhooks(local=False))["webhooks"][0]
+        await main.delete_webhook(result["webhook"]["id"])
+        server.close()
+        return stats
+
+    stats = asyncio.run(scenario())
+
+    assert len(requests) == 2 and requests[0] == requests[1]
+    assert [e["data"]["level"] for e in requests[1]["events"]] == [0, 1, 2]
+    assert stats["delivered"] == 3 and stats["failed"] == 0 and stats["last_status"] == 204
+    assert main.event_bus.webhooks == {}
+
+
+def test_status_uses_cached_health(adb_server):
+    ip = device_ips(1)[0]
+    fake = adb_server.add_device(ip, latency=0.05)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        commands = len(fake.commands)
+        cached = await main.get_status(device_ip=ip, refresh=False)
+        untouched = len(fake.commands) == commands
+        probed = await main.get_status(device_ip=ip, refresh=True)
+        return cached, untouched, probed
+
+    cached, untouched, probed = asyncio.run(scenario())
+
+    assert untouched and cached["cached"] and cached["status"] == "connected"
+    assert cached["health"]["last_seen"] is not None and cached["health"]["rtt_ms"] is None
+    assert not probed["cached"] and probed["health"]["rtt_ms"] >= 50
+    assert fake.commands[-1] == main.KEEPALIVE_COMMAND
+
+
+def test_supervisor_probes_and_reconnects_with_backoff(monkeypatch):
+    monkeypatch.setattr(main, "generate_adb_keys", lambda: [])
+    monkeypatch.setattr(main, "event_bus", main.EventBus())
+    monkeypatch.setattr(main, "KEEPALIVE_INTERVAL", 0.2)
+    monkeypatch.setattr(main, "KEEPALIVE_TICK", 0.02)
+    monkeypatch.setattr(main, "KEEPALIVE_BACKOFF_BASE", 0.05)
+    monkeypatch.setattr(main, "KEEPALIVE_BACKOFF_MAX", 0.1)
+    main.devices.clear()
+    main.registry_locks.clear()
+    ip = device_ips(1)[0]
+    server = FakeAdbServer().start()
+    port = server.port
+    servers = [server]
+
+    async def scenario():
+        supervisor = main.ConnectionSupervisor()
+        await main.connect_device(ip=ip, port=port)
+        supervisor.start()
+        await asyncio.sleep(0.4)
+        probes = servers[0].devices[ip].commands.count(main.KEEPALIVE_COMMAND)
+        # La TV se cae: el sondeo lo detecta y los reintentos fallan con espera
+        servers[0].stop()
+        await asyncio.sleep(0.5)
+        down = main.devices[ip].health.summary(), main.devices[ip].connected
+        # Vuelve: el supervisor reconecta sin que llegue ninguna petición
+        servers.append(FakeAdbServer(port=port).start())
+        await asyncio.sleep(0.5)
+        up = main.devices[ip].health.summary(), main.devices[ip].connected
+        await supervisor.stop()
+        return probes, down, up
+
+    try:
+        probes, (down, down_connected), (up, up_connected) = asyncio.run(scenario())
+    finally:
+        servers[-1].stop()
+        main.devices.clear()
+        main.registry_locks.clear()
+
+    assert probes >= 1
+    assert not down_connected and down["failures"] >= 2 and down["last_error"]
+    assert up_connected and up["reconnects"] == 1 and up["failures"] == 0
+    assert [e["data"]["connected"] for e in main.event_bus.history] == [True, False, True]
+
+
+async def read_body(response):
+    body = b"".join([chunk if isinstance(chunk, bytes) else chunk.encode()
+                     async for chunk in response.body_iterator])
+    return body.decode()
+
+
+async def read_fleet(response):
+    return [json.loads(line) for line in (await read_body(response)).splitlines()]
+
+
+def test_fleet_command_streams_results_as_devices_finish(adb_server):
+    """La flota tarda lo que el dispositivo más lento y responde en orden de llegada"""
+    ips = device_ips(8)
+    latencies = [0.05 * (len(ips) - i) for i in range(len(ips))]
+    for ip, latency in zip(ips, latencies):
+        adb_server.add_device(ip, latency=latency)
+
+    async def scenario():
+        await connect_all(adb_server, ips)
+        start = time.perf_counter()
+        response = await main.fleet_command(device_ip=",".join(ips), tag=None, parallelism=None,
+                                            format="ndjson", command="echo ok")
+        records = await read_fleet(response)
+        return time.perf_counter() - start, records
+
+    elapsed, records = asyncio.run(scenario())
+
+    results, summary = records[:-1], records[-1]
+    assert [r["device"] for r in results] == list(reversed(ips))
+    assert all(r["status"] == "success" and r["result"]["result"]["output"].strip() == "ok" for r in results)
+    assert summary == {**summary, "type": "summary", "total": 8, "success": 8, "error": 0}
+    assert elapsed < max(latencies) * 2, f"{elapsed:.2f}s (suma {sum(latencies):.2f}s)"
+
+
+def test_fleet_results_respect_parallelism_and_report_errors():
+    active, peak = 0, 0
+
+    async def operation(ip):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.02)
+        active -= 1
+        if ip == "bad":
+            raise HTTPException(status_code=400, detail="No se pudo conectar")
+        return {"ip": ip}
+
+    async def scenario():
+        return [item async for item in main.fleet_results(["a", "b", "bad", "c", "d", "e"], operation, 2)]
+
+    items = asyncio.run(scenario())
+
+    assert peak == 2
+    kinds = [kind for kind, _ in items]
+    assert kinds == ["result"] * 6 + ["summary"]
+    bad = next(r for _, r in items if r.get("device") == "bad")
+    assert bad["status_code"] == 400 and bad["error"] == "No se pudo conectar"
+    assert items[-1][1]["success"] == 5 and items[-1][1]["error"] == 1
+
+
+def test_fleet_targets_by_tag(adb_server, monkeypatch):
+    monkeypatch.setattr(main, "device_tags", main.parse_device_tags("sala=127.0.0.2, 127.0.0.3;cocina=127.0.0.4;mal"))
+    assert main.device_tags == {"127.0.0.2": {"sala"}, "127.0.0.3": {"sala"}, "127.0.0.4": {"cocina"}}
+    assert main.resolve_fleet_targets("127.0.0.4", "sala") == ["127.0.0.4", "127.0.0.2", "127.0.0.3"]
+    with pytest.raises(HTTPException) as unknown:
+        main.resolve_fleet_targets(None, "patio")
+    with pytest.raises(HTTPException) as empty:
+        main.resolve_fleet_targets(None, None)
+    assert unknown.value.status_code == empty.value.status_code == 400
+
+    ips = ["127.0.0.2", "127.0.0.3"]
+    for ip in ips:
+        adb_server.add_device(ip)
+
+    async def scenario():
+        await connect_all(adb_server, ips)
+        await main.set_device_tags(device_ip="127.0.0.3", tags="")
+        response = await main.fleet_command(device_ip=None, tag="sala", parallelism=4,
+                                            format="sse", command="echo ok")
+        return response, await read_body(response)
+
+    response, body = asyncio.run(scenario())
+
+    assert response.media_type == "text/event-stream"
+    events = [e for e in body.split("\n\n") if e]
+    assert [e.splitlines()[0] for e in events] == ["event: result", "event: summary"]
+    assert json.loads(events[0].splitlines()[1][len("data: "):])["device"] == "127.0.0.2"
+
+
+def batch(*steps, stop_on_error=False):
+    return main.DeviceBatch(steps=[main.BatchStep(**step) for step in steps], stop_on_error=stop_on_error)
+
+
+class FakeTvPipeline(FakeTvVolume):
+    """TV con volumen y app en primer plano para /device/batch"""
+
+    def __call__(self, service, command):
+        if command.startswith("am start"):
+            return "Starting: Intent { act=android.intent.action.VIEW }\n"
+        if command.startswith(main.FOREGROUND_QUERY_COMMAND):
+            return "  mCurrentFocus=Window{1 u0 com.google.android.youtube/.MainActivity}\n"
+        if command == "false":
+            return "", 1
+        return super().__call__(service, command)
+
+
+def test_device_batch_merges_adjacent_steps(adb_server):
+    """exit + volumen + play + app actual en un round trip; wait corta el lote"""
+    tv = FakeTvPipeline(sdk=30, level=2)
+    ip = device_ips(1)[0]
+    fake = adb_server.add_device(ip, handler=tv)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        await main.set_volume(device_ip=ip, level=3)
+        commands = len(fake.commands)
+        result = await main.device_batch(device_ip=ip, batch=batch(
+            {"op": "exit"},
+            {"op": "volume", "level": 9},
+            {"op": "play", "video_url": "https://youtu.be/dQw4w9WgXcQ"},
+            {"op": "wait", "ms": 10},
+            {"op": "keyevent", "keycodes": ["KEYCODE_DPAD_CENTER"]},
+            {"op": "current_app"},
+        ))
+        return result, fake.commands[commands:]
+
+    result, commands = asyncio.run(scenario())
+
+    assert result["status"] == "success" and result["round_trips"] == 2 and len(commands) == 2
+    assert [s["op"] for s in result["steps"]] == ["exit", "volume", "play", "wait", "keyevent", "current_app"]
+    assert "KEYCODE_BACK" in commands[0] and "media_session" in commands[0] and "am start" in commands[0]
+    assert result["steps"][1]["volume"]["level"] == 9 and tv.level == 9
+    assert result["steps"][5]["package"] == "com.google.android.youtube"
+
+
+def test_device_batch_stop_on_error_skips_rest(adb_server):
+    tv = FakeTvPipeline(sdk=30, level=2)
+    ip = device_ips(1)[0]
+    adb_server.add_device(ip, handler=tv)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        return await main.device_batch(device_ip=ip, batch=batch(
+            {"op": "shell", "command": "echo ok"},
+            {"op": "shell", "command": "false"},
+            {"op": "volume", "level": 7},
+            {"op": "wait", "ms": 10},
+            {"op": "exit"},
+            stop_on_error=True,
+        ))
+
+    result = asyncio.run(scenario())
+
+    assert result["status"] == "error"
+    assert [s["status"] for s in result["steps"]] == ["success", "error", "skipped", "skipped", "skipped"]
+    assert result["steps"][1]["exit_code"] == 1 and tv.level == 2
+
+
+def test_device_batch_validates_steps(adb_server):
+    ip = device_ips(1)[0]
+    adb_server.add_device(ip)
+
+    async def scenario():
+        await connect_all(adb_server, [ip])
+        errors = []
+        for step in ({"op": "jump"}, {"op": "keyevent", "keycodes": ["KEYCODE_HOME; reboot"]},
+                     {"op": "play", "video_url": "https://example.com"}, {"op": "volume"}):
+            try:
+                await main.device_batch(device_ip=ip, batch=batch(step))
+            except HTTPException as e:
+                errors.append(e.status_code)
+        return errors
+
+    assert asyncio.run(scenario()) == [400, 400, 400, 400]
+
+
+class CountingSigner:
+    """Firmante de prueba: cuenta las firmas del handshake"""
+
+    def __init__(self):
+        self.signed = 0
+
+    def Sign(self, data):
+        self.signed += 1
+        return b"\0" * 256
+
+    def GetPublicKey(self):
+        return "fake@host"
+
+
+@pytest.mark.parametrize("transport", main.ADB_TRANSPORT_MODES)
+def test_connections_share_one_signer(monkeypatch, transport):
+    """El firmante se carga una vez y firma el handshake de todas las conexiones"""
+    signer, loads = CountingSigner(), []
+    monkeypatch.setattr(main, "generate_adb_keys", lambda: loads.append(1) or [signer])
+    monkeypatch.setattr(main, "adb_keys", [])
+    monkeypatch.setattr(main, "ADB_TRANSPORT", transport)
+    ips = device_ips(5)
+
+    async def scenario(port):
+        connections = [main.DeviceConnection(ip, port) for ip in ips]
+        results = await asyncio.gather(*(c.connect() for c in connections))
+        reconnect = await connections[0].connect()
+        for connection in connections:
+            await connection.disconnect()
+        return results + [reconnect]
+
+    with FakeAdbServer(require_auth=True) as server:
+        fakes = [server.add_device(ip) for ip in ips]
+        results = asyncio.run(scenario(server.port))
+
+    assert all(r["status"] == "success" for r in results)
+    assert len(loads) == 1 and signer.signed == 6
+    assert [f.signatures for f in fakes] == [2, 1, 1, 1, 1]
+
+
+def test_signer_backends_produce_same_signature(tmp_path):
+    rsa = pytest.importorskip("cryptography.hazmat.primitives.asymmetric.rsa")
+    from cryptography.hazmat.primitives import serialization
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    (tmp_path / "adbkey").write_bytes(key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    (tmp_path / "adbkey.pub").write_text("QAAAA fake@host\n")
+
+    python_signer = main.create_adb_signer(str(tmp_path / "adbkey"), "python")
+    fast_signer = main.create_adb_signer(str(tmp_path / "adbkey"), "auto")
+
+    assert type(python_signer).__name__ == "PythonRSASigner"
+    assert type(fast_signer).__name__ == "CryptographySigner"
+    token = bytes(range(20))
+    assert fast_signer.Sign(token) == python_signer.Sign(token)
+
+
+@pytest.fixture
+def blackhole():
+    """Puerto que acepta la conexión TCP pero nunca responde al CNXN (TV colgada)"""
+    sock = socket.socket()
+    sock.bind(("0.0.0.0", 0))
+    sock.listen(16)
+    yield sock.getsockname()[1]
+    sock.close()
+
+
+def test_devices_listing_does_not_wait_for_offline_devices(adb_server, blackhole, monkeypatch):
+    monkeypatch.setattr(main, "KEEPALIVE_INTERVAL", 0)
+    online, offline = device_ips(2)
+    adb_server.add_device(online)
+
+    async def scenario():
+        await connect_all(adb_server, [online])
+        main.devices[offline] = main.DeviceConnection(offline, blackhole)
+        start = time.perf_counter()
+        listing = await main.list_devices(refresh=False, timeout=5, local=False)
+        elapsed = time.perf_counter() - start
+        reconnecting = offline in main.connection_supervisor.checks
+        await main.connection_supervisor.stop()
+        return listing, elapsed, reconnecting
+
+    listing, elapsed, reconnecting = asyncio.run(scenario())
+
+    assert elapsed < 0.1 and reconnecting
+    statuses = {d["ip"]: d["status"] for d in listing["devices"]}
+    assert statuses == {online: "connected", offline: "reconnecting"}
+
+
+def test_devices_refresh_probes_in_parallel_under_deadline(adb_server, blackhole):
+    ips = device_ips(4)
+    for ip in ips[:3]:
+        adb_server.add_device(ip, latency=0.1)
+
+    async def scenario():
+        await connect_all(adb_server, ips[:3])
+        main.devices[ips[3]] = main.DeviceConnection(ips[3], blackhole)
+        start = time.perf_counter()
+        listing = await main.list_devices(refresh=True, timeout=0.5, local=False)
+        return listing, time.perf_counter() - start
+
+    listing, elapsed = asyncio.run(scenario())
+
+    assert 0.5 <= elapsed < 0.8
+    entries = {d["ip"]: d for d in listing["devices"]}
+    assert all(entries[ip]["probe"] == "success" and entries[ip]["rtt_ms"] >= 100 for ip in ips[:3])
+    assert entries[ips[3]]["probe"] == "timeout" and entries[ips[3]]["status"] != "connected"
+
+
+def cluster_nodes(db_path, *urls):
+    """Nodos de cluster sobre la misma base, con el anillo ya armado en todos"""
+    nodes = [main.ClusterNode(str(db_path), url) for url in urls]
+    nodes[0]._init_db()
+    for node in nodes + nodes:
+        node.set_nodes(node._heartbeat())
+    return nodes
+
+
+def test_cluster_ring_assigns_devices_and_moves_on_node_death(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "CLUSTER_NODE_TTL", 0.3)
+    a, b = cluster_nodes(tmp_path / "cluster.sqlite", "http://127.0.0.1:9001", "http://127.0.0.1:9002")
+    ips = device_ips(40)
+
+    # Sin WAL: la base puede estar en un sistema de archivos de red
+    with a._db() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone() == ("delete",)
+
+    owners = {ip: a.owner(ip)[0] for ip in ips}
+    assert owners == {ip: b.owner(ip)[0] for ip in ips}
+    mine = [ip for ip in ips if owners[ip] == a.node_id]
+    assert 0 < len(mine) < len(ips)
+
+    held, _ = a._claim(dict.fromkeys(mine, 5555))
+    assert held == set(mine)
+    held, holders = b._claim(dict.fromkeys(mine, 5555))
+    assert held == set() and set(holders.values()) == {a.node_id}
+
+    # a deja de latir: al vencer su heartbeat b es dueño de todo y toma los leases vencidos
+    time.sleep(0.4)
+    b.set_nodes(b._heartbeat())
+    assert list(b.nodes) == [b.node_id]
+    assert all(b.is_owner(ip) for ip in ips)
+    held, _ = b._claim(dict.fromkeys(ips, 5555))
+    assert held == set(ips)
+
+
+def test_cluster_adopts_devices_of_dead_node(adb_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "CLUSTER_NODE_TTL", 0.3)
+    monkeypatch.setattr(main, "KEEPALIVE_INTERVAL", 0)
+    a, b = cluster_nodes(tmp_path / "cluster.sqlite", "http://127.0.0.1:9001", "http://127.0.0.1:9002")
+    ip = next(ip for ip in device_ips(20) if a.is_owner(ip))
+    adb_server.add_device(ip)
+
+    async def scenario():
+        monkeypatch.setattr(main, "cluster", a)
+        await main.connect_device(ip=ip, port=adb_server.port)
+        # El proceso de a muere sin liberar nada
+        await main.devices.pop(ip).disconnect()
+        await asyncio.sleep(0.4)
+        monkeypatch.setattr(main, "cluster", b)
+        await b.heartbeat()
+        await asyncio.gather(*b.adopting.values())
+        device = main.devices[ip]
+        result = await main.send_custom_command(device_ip=ip, command="echo ok")
+        await b.stop()
+        return device, result
+
+    device, result = asyncio.run(scenario())
+
+    assert device.port == adb_server.port and result["result"]["output"].strip() == "ok"
+
+
+def test_cluster_adopted_offline_device_keeps_lease(tmp_path, monkeypatch):
+    """Un dispositivo adoptado sin conexión sigue siendo de un solo nodo"""
+    monkeypatch.setattr(main, "CLUSTER_NODE_TTL", 0.3)
+    monkeypatch.setattr(main, "KEEPALIVE_INTERVAL", 0)
+    a, b = cluster_nodes(tmp_path / "cluster.sqlite", "http://127.0.0.1:9001", "http://127.0.0.1:9002")
+    ip = device_ips(1)[0]
+    a._claim({ip: 1})
+
+    async def scenario():
+        # a muere con el lease de un TV apagado
+        await asyncio.sleep(0.4)
+        monkeypatch.setattr(main, "cluster", b)
+        await b.heartbeat()
+        await asyncio.gather(*b.adopting.values())
+        registered = ip in main.devices
+        claim = a._claim({ip: 1})
+        await asyncio.sleep(0.4)
+        await b.heartbeat()
+        orphans = b._orphans()
+        await main.connection_supervisor.stop()
+        await b.stop()
+        return registered, claim, orphans
+
+    registered, (held, holders), orphans = asyncio.run(scenario())
+
+    assert registered and held == set() and holders == {ip: b.node_id}
+    # El heartbeat lo sigue renovando mientras está caído
+    assert orphans == {}
+
+
+def test_cluster_worker_url_reachable_from_other_hosts():
+    assert main.worker_node_url("", 9124) == ("http://127.0.0.1:9124", "127.0.0.1")
+    assert main.worker_node_url("http://192.168.0.10:9123/", 9125) == ("http://192.168.0.10:9125", "0.0.0.0")
+
+
+def test_cluster_connect_only_on_owner_node(adb_server, tmp_path, monkeypatch):
+    a, b = cluster_nodes(tmp_path / "cluster.sqlite", "http://127.0.0.1:9001", "http://127.0.0.1:9002")
+    monkeypatch.setattr(main, "cluster", a)
+    ips = device_ips(20)
+    local = [ip for ip in ips if a.is_owner(ip)][:2]
+    remote = next(ip for ip in ips if not a.is_owner(ip))
+    for ip in local:
+        adb_server.add_device(ip)
+    # El dueño anterior todavía tiene el lease del segundo dispositivo
+    b._claim({local[1]: 5555})
+
+    async def scenario():
+        result = await main.connect_device(ip=local[0], port=adb_server.port)
+        errors = []
+        for ip in (remote, local[1]):
+            try:
+                await main.connect_device(ip=ip, port=adb_server.port)
+            except HTTPException as e:
+                errors.append(e.status_code)
+        await main.disconnect_device(device_ip=local[0])
+        return result, errors
+
+    result, errors = asyncio.run(scenario())
+
+    assert result["status"] == "success"
+    assert errors == [421, 503]
+    assert remote not in main.devices and local[1] not in main.devices
+    # Al desconectar se libera el lease
+    held, _ = b._claim({local[0]: 5555})
+    assert held == {local[0]}
+
+
+def test_cluster_failed_connect_leaves_no_lease(adb_server, tmp_path, monkeypatch):
+    """Un connect fallido (IP mal escrita) no queda como dispositivo a adoptar"""
+    monkeypatch.setattr(main, "CLUSTER_NODE_TTL", 0.3)
+    monkeypatch.setattr(main, "KEEPALIVE_INTERVAL", 0)
+    (a,) = cluster_nodes(tmp_path / "cluster.sqlite", "http://127.0.0.1:9001")
+    monkeypatch.setattr(main, "cluster", a)
+
+    async def scenario():
+        result = await main.connect_device(ip="127.0.0.99", port=1)
+        await asyncio.sleep(0.4)
+        await a.heartbeat()
+        adopting = list(a.adopting)
+        await a.stop()
+        return result, adopting
+
+    result, adopting = asyncio.run(scenario())
+
+    assert result["status"] == "error"
+    assert adopting == [] and "127.0.0.99" not in main.devices
+    assert a._orphans() == {}
+
+
+def test_cluster_shares_tags_and_webhooks(tmp_path, monkeypatch):
+    """Etiquetas y webhooks de un nodo valen en todos; /events pide dispositivos de un nodo"""
+    a, b = cluster_nodes(tmp_path / "cluster.sqlite", "http://127.0.0.1:1", "http://127.0.0.1:2")
+    remote = next(ip for ip in device_ips(20) if not a.is_owner(ip))
+    monkeypatch.setattr(main, "device_tags", {})
+
+    async def on_node(node, call):
+        # Cada nodo es otro proceso: su propio bus de eventos
+        monkeypatch.setattr(main, "cluster", node)
+        monkeypatch.setattr(main, "event_bus", buses[node.node_id])
+        return await call
+
+    async def noop(ip):
+        return {"ok": ip}
+
+    async def scenario():
+        await on_node(a, main.set_device_tags(device_ip="127.0.0.3", tags="sala"))
+        main.device_tags.clear()
+        fleet = await on_node(b, main.fleet_response(None, "sala", None, "ndjson", noop))
+        created = await on_node(a, main.create_webhook(url="http://127.0.0.1:9/hook", device_ip=None, types=None))
+        listed = await on_node(b, main.list_webhooks(local=True))
+        await on_node(b, main.delete_webhook(created["webhook"]["id"]))
+        await on_node(a, a.sync_webhooks())
+        remaining = dict(buses[a.node_id].webhooks)
+        state = await on_node(a, main.get_events_state(device_ip=None, types=None, local=False))
+        errors = []
+        for device_ip in (None, remote):
+            try:
+                await main.stream_events(device_ip=device_ip, types=None, since_seq=None, last_event_id=None)
+            except HTTPException as e:
+                errors.append(e.status_code)
+        return await read_fleet(fleet), created, listed, remaining, state, errors
+
+    buses = {a.node_id: main.EventBus(), b.node_id: main.EventBus()}
+    fleet, created, listed, remaining, state, errors = asyncio.run(scenario())
+
+    assert [r["device"] for r in fleet if r["type"] == "result"] == ["127.0.0.3"]
+    assert [w["id"] for w in listed["webhooks"]] == [created["webhook"]["id"]]
+    assert remaining == {}
+    assert state["last_seq"] is None and [n["node"] for n in state["unreachable_nodes"]] == [b.url]
+    assert errors == [400, 421]
+
+
+def test_cluster_router_forwards_to_owner(tmp_path, monkeypatch):
+    seen = []
+
+    async def owner_node(reader, writer):
+        head = await reader.readuntil(b"\r\n\r\n")
+        length = int(next(l for l in head.split(b"\r\n") if l.lower().startswith(b"content-length")).split(b":")[1])
+        seen.append((head, await reader.readexactly(length)))
+        writer.write(b"HTTP/1.0 201 Created\r\ncontent-type: application/json\r\n\r\n{\"owner\": true}")
+        await writer.drain()
+        writer.close()
+
+    async def inner_app(scope, receive, send):
+        await JSONResponse({"owner": False})(scope, receive, send)
+
+    async def request(router, ip):
+        sent = []
+        messages = [{"type": "http.request", "body": b'{"steps": []}', "more_body": False}]
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await asyncio.sleep(3600)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": "POST", "path": "/device/batch", "raw_path": b"/device/batch",
+                 "query_string": f"device_ip={ip}".encode(), "headers": [(b"content-type", b"application/json")]}
+        await router(scope, receive, send)
+        return sent[0]["status"], b"".join(m.get("body", b"") for m in sent[1:]), dict(sent[0]["headers"])
+
+    async def scenario():
+        server = await asyncio.start_server(owner_node, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        a, b = cluster_nodes(tmp_path / "cluster.sqlite", "http://127.0.0.1:9001", f"http://127.0.0.1:{port}")
+        monkeypatch.setattr(main, "cluster", a)
+        ips = device_ips(20)
+        remote = next(ip for ip in ips if not a.is_owner(ip))
+        local = next(ip for ip in ips if a.is_owner(ip))
+        router = main.ClusterRouter(inner_app)
+        forwarded = await request(router, remote)
+        handled = await request(router, local)
+        server.close()
+        return remote, b, forwarded, handled
+
+    remote, b, forwarded, handled = asyncio.run(scenario())
+
+    status, body, headers = forwarded
+    assert status == 201 and json.loads(body) == {"owner": True}
+    assert headers[b"x-adb-api-node"] == b.node_id.encode()
+    head, request_body = seen[0]
+    assert head.startswith(f"POST /device/batch?device_ip={remote} HTTP/1.0".encode())
+    assert b"x-adb-api-forwarded: http://127.0.0.1:9001" in head and request_body == b'{"steps": []}'
+    assert len(seen) == 1 and handled[0] == 200 and json.loads(handled[1]) == {"owner": False}